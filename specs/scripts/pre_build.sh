@@ -15,3 +15,14 @@ mkdir -p "${WORK_INITRAMFS_ROOTFS_DIR}" || exit 1
 /usr/bin/rsync -a -x -H -A -X --delete-during \
     "${UBUILD_INITRAMFS_ROOTFS_DIR}"/ \
     "${WORK_INITRAMFS_ROOTFS_DIR}"/ || exit 1
+
+# When resuming a build (ubuild --resume), the pkg targets built by
+# the previous run are still in ${UBUILD_BUILD_DIR}: since the work
+# rootfs dir has just been mirrored again, let root_init merge them.
+for target_file in $(find "${UBUILD_BUILD_DIR}" -maxdepth 2 \
+    -name "${TARGET_TYPE_FILE}"); do
+
+    if [ "$(cat "${target_file}")" = "pkg" ]; then
+        rm -f "$(dirname "${target_file}")/${ROOT_INIT_FILE}" || exit 1
+    fi
+done
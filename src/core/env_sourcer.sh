@@ -1,5 +1,16 @@
 #!/bin/sh
+#
+# Usage: env_sourcer.sh <env file> [<env file> ...]
+#
+# Source every environment file in a separate subshell, from inside its
+# directory, and print the resulting environment, NUL-delimited, each
+# one terminated by an empty record. Stop at the first environment file
+# that cannot be sourced.
 
-. ${1} || exit 1
-
-/usr/bin/env
+for env_file in "${@}"; do
+    (
+        cd "${env_file%/*}/" && unset OLDPWD && . "${env_file}" && \
+            /usr/bin/env -0
+    ) || exit 1
+    printf '\0'
+done
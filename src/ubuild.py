@@ -18,25 +18,64 @@
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import argparse
+import base64
 import codecs
+import contextlib
+import copy
 import errno
+import fcntl
 import hashlib
+import itertools
+import json
 import logging
 import logging.config
+import multiprocessing
 import os
 import re
 import shlex
 import shutil
+import socket
+import sqlite3
 import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import http.client as httplib
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+    from urllib.parse import quote, unquote, urljoin, urlsplit
+except ImportError:
+    import httplib
+    import BaseHTTPServer
+    import SocketServer
+    from urllib import quote, unquote
+    from urlparse import urljoin, urlsplit
 
 
 class SpecPreprocessor(object):
 
     PREFIX = "#"
 
+    # expanded content of the files included by the specs parsed by
+    # this process, see _include_expander().
+    _includes = {}
+    _includes_lock = threading.Lock()
+
+    # files modified less than this many nanoseconds before their stat
+    # key is taken may change again without changing it (the
+    # filesystem timestamps granularity): their stat key is not
+    # trusted.
+    RACY_NS = 2 * 1000000000
+
     class PreprocessorError(Exception):
         """ Error while preprocessing file """
 
@@ -46,6 +85,14 @@ class SpecPreprocessor(object):
         self._expanders = {
             self.PREFIX + "include": self._include_expander,
         }
+        self._files = [os.path.abspath(spec_path)]
+
+    def files(self):
+        """
+        Return the list of the paths of the files read by parse(): the
+        spec file and the files it includes, recursively.
+        """
+        return list(self._files)
 
     def _recursive_expand(self, line, directory_path):
         """
@@ -72,7 +119,9 @@ class SpecPreprocessor(object):
 
     def _include_expander(self, line, directory_path):
         """
-        Expand, recursively, an #include <path> statement.
+        Expand, recursively, an #include <path> statement. The expanded
+        content of every included file is kept, and used again as long
+        as the file, and those it includes, are unchanged.
 
         Args:
           line: line to parse and expand, if needed.
@@ -96,18 +145,42 @@ class SpecPreprocessor(object):
             raise SpecPreprocessor.PreprocessorError(
                 "invalid preprocessor line: %s" % (line,))
 
+        key = (os.path.abspath(path), self._encoding)
+        with self._includes_lock:
+            cached = self._includes.get(key)
+        if cached is not None:
+            lines, files = cached
+            try:
+                unchanged = all([UbuildDigests._stat_key(x) == st_key
+                                 for x, st_key in files])
+            except OSError:
+                unchanged = False
+            if unchanged:
+                self._files.extend([x for x, _st_key in files])
+                return lines
+
+        start = len(self._files)
+        self._files.append(key[0])
         with codecs.open(path, "r", encoding=self._encoding) as spec_f:
             directory_path_new = os.path.dirname(path)
-            lines = None
+            lines = []
             for line in spec_f.readlines():
                 # call recursively
-                line = self._recursive_expand(line, directory_path_new)
-                if lines is None:
-                    lines = line
-                else:
-                    lines += line
+                lines.append(
+                    self._recursive_expand(line, directory_path_new))
+        lines = "".join(lines) + "\n"
 
-        return lines + "\n"
+        try:
+            files = [(x, UbuildDigests._stat_key(x))
+                     for x in self._files[start:]]
+        except OSError:
+            return lines
+        racy_ns = time.time() * 1000000000 - self.RACY_NS
+        if [x for x in files if x[1][2] >= racy_ns]:
+            return lines
+        with self._includes_lock:
+            self._includes[key] = (lines, files)
+        return lines
 
     def parse(self):
         """
@@ -116,24 +189,25 @@ class SpecPreprocessor(object):
         Returns:
           the parsed file content string.
         """
-        content = []
-        directory_path = os.path.dirname(self._spec_path)
-        with codecs.open(self._spec_path, "r",
-                         encoding=self._encoding) as spec_f:
-            for line in spec_f.readlines():
-                line = self._recursive_expand(line, directory_path)
-                content.append(line)
-
-        final_content = []
-        for line in content:
-            split_line = line.split(None, 1)
-            if split_line:
-                expander = self._expanders.get(split_line[0])
-                if expander is not None:
-                    line = expander(line, directory_path)
-            final_content.append(line)
-
-        return ("".join(final_content)).split("\n")
+        with _tracer.span("parse", "spec", {"path": self._spec_path}):
+            content = []
+            directory_path = os.path.dirname(self._spec_path)
+            with codecs.open(self._spec_path, "r",
+                             encoding=self._encoding) as spec_f:
+                for line in spec_f.readlines():
+                    line = self._recursive_expand(line, directory_path)
+                    content.append(line)
+
+            final_content = []
+            for line in content:
+                split_line = line.split(None, 1)
+                if split_line:
+                    expander = self._expanders.get(split_line[0])
+                    if expander is not None:
+                        line = expander(line, directory_path)
+                final_content.append(line)
+
+            return ("".join(final_content)).split("\n")
 
 
 class _SpecParser(dict):
@@ -174,6 +248,7 @@ class _SpecParser(dict):
         self._logger = logging.getLogger("ubuild.SpecParser")
         self._ordered_sections = []
         self._spec_file = spec_file
+        self._files_read = []
 
     def read(self):
         """
@@ -207,6 +282,7 @@ class _SpecParser(dict):
             self._logger.error(
                 "[%s] preprocessor error: %s", path, err)
             raise
+        self._files_read = preproc.files()
 
         section_name = None
         supported_keys = None
@@ -318,11 +394,20 @@ class SpecParser(_SpecParser):
     post = some/script4.sh arg5 arg6
     build_image = some/build.sh arg7
     cache_vars = PATH BAR BAZ
+    cache_backend = cas hardlink
+    cache_compression = zstd level=19 threads=0
+    cache_hash = blake2b
+    cache_max_size = 20G
+    cache_remote = http://cache.local:8765/ubuild readonly
+    cache_warm = 8G hardlink
     build_image = some/script.sh
+    parallel_targets = 4
+    jobs = 16
 
     [cross=<target>] # cross compiler target that builds a single component
     url = http://www.kernel.org/some.tarball.tar.xz
     url = http://www.kernel.org/some.other.tarball.tar.xz
+    checksum = sha256:<hex digest> some.tarball.tar.xz
     sources = some-version/
     patch = patches/0001-add-magic.patch
     patch = patches/0002-add-evil.patch
@@ -332,6 +417,11 @@ class SpecParser(_SpecParser):
     build = scripts/build_target_pt2.sh <target>
     pre = scripts/pre_target.sh <foo>
     post = scripts/post_target.sh <bar>
+    depends = <other target> cross=<another target>
+
+    [matrix=<VARIABLE>] # builds a spec variant per VARIABLE value
+    value = o2: -O2 -pipe
+    value = o3: -O3 -pipe
 
     As you can see, multiple statements for the same section
     are allowed.
@@ -357,12 +447,31 @@ class SpecParser(_SpecParser):
                 "missing parameters")
             self.params = params
 
-    def __init__(self, spec_file):
+    def __init__(self, spec_file, create_dirs=True):
+        """
+        Object constructor.
+
+        Args:
+          spec_file: the .spec file path.
+          create_dirs: if False, the directories that ubuild creates
+              when missing (build_dir, cache_dir, ...) are not created
+              while parsing.
+        """
         super(SpecParser, self).__init__(spec_file, encoding="UTF-8")
+        self._create_dirs = create_dirs
+        # paths whose existence has been checked by the manglers.
+        self._checked_paths = set()
+        # the variant label, variables and cross targets build_dir,
+        # see variants().
+        self._variant = None
+        self._variables = {}
+        self._cross_build_dir = None
 
         target_keys = {
             "build": self._mangle_argv0_executable,
             "cache_vars": self._mangle_cache_vars,
+            "checksum": self._mangle_checksum,
+            "depends": self._mangle_depends,
             "env": self._mangle_file,
             "patch": self._mangle_file,
             "post": self._mangle_argv0_executable,
@@ -374,8 +483,14 @@ class SpecParser(_SpecParser):
         self._SUPPORTED_KEYS = {
             "^ubuild$": {
                 "build_dir": self._mangle_create_directory,
+                "cache_backend": self._mangle_cache_backend,
+                "cache_compression": self._mangle_cache_compression,
                 "cache_dir": self._mangle_create_directory,
+                "cache_hash": self._mangle_cache_hash,
+                "cache_max_size": self._mangle_size,
+                "cache_remote": self._mangle_cache_remote,
                 "cache_vars": self._mangle_cache_vars,
+                "cache_warm": self._mangle_cache_warm,
                 "compile_dir": self._mangle_create_directory,
                 "cross_env": self._mangle_file,
                 "cross_post": self._mangle_argv0_executable,
@@ -383,6 +498,8 @@ class SpecParser(_SpecParser):
                 "destination_dir": self._mangle_create_directory,
                 "env": self._mangle_file,
                 "image_name": self._mangle_string,
+                "jobs": self._mangle_positive_integer,
+                "parallel_targets": self._mangle_positive_integer,
                 "post": self._mangle_argv0_executable,
                 "pre": self._mangle_argv0_executable,
                 "rootfs_dir": self._mangle_directory,
@@ -392,6 +509,9 @@ class SpecParser(_SpecParser):
             },
             "^cross=.*": target_keys,
             "^pkg=.*": target_keys,
+            "^matrix=.*": {
+                "value": self._mangle_matrix_value,
+            },
         }
         SpecParser._SUPPORTED_KEYS = self._SUPPORTED_KEYS
 
@@ -415,18 +535,165 @@ class SpecParser(_SpecParser):
             },
             "^cross=.*": target_vital,
             "^pkg=.*": target_vital,
+            "^matrix=.*": {
+                "value": None,
+            },
         }
 
+    # version of the compiled spec cache files, see _read_cache().
+    _CACHE_VERSION = 2
+
     def read(self):
         """
-        Overrides _SpecParser.read(), adds metadata validation.
+        Overrides _SpecParser.read(), adds metadata validation and the
+        compiled spec cache: the parsed metadata is stored into the
+        user cache directory and used again as long as the spec file,
+        the files it includes and the files and directories it refers
+        to are unchanged.
 
         Raises:
             SpecParser.MissingParametersError: when a parameter is missing.
         """
-        super(SpecParser, self).read()
+        if not self._read_cache():
+            super(SpecParser, self).read()
+            self._write_cache()
         self._validate()
 
+    @classmethod
+    def _cache_path(cls, spec_file):
+        """
+        Return the compiled spec cache file path of the given spec file,
+        inside $XDG_CACHE_HOME/ubuild/specs (~/.cache by default). The
+        file name depends on the spec file path, the Python version and
+        this module, whose parsing may change.
+        """
+        cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache")
+        key = repr((
+            os.path.abspath(spec_file), sys.version_info[:2],
+            UbuildDigests._stat_key(os.path.abspath(__file__))))
+        return os.path.join(
+            cache_home, "ubuild", "specs",
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle")
+
+    @classmethod
+    def _path_state(cls, path):
+        """
+        Return the type and executable bits of the file at path, as seen
+        by the manglers, or None if it does not exist.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (stat.S_IFMT(st.st_mode),
+                st.st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+
+    def _read_cache(self):
+        """
+        Read the metadata from the compiled spec cache, return True if
+        it is valid, False otherwise.
+        """
+        try:
+            path = self._cache_path(self._spec_file)
+            with open(path, "rb") as cache_f:
+                record = pickle.load(cache_f)
+        except (IOError, OSError):
+            return False
+        except Exception as err:
+            # a corrupted pickle can raise about anything.
+            self._logger.warning("invalid %s, ignoring: %s", path, err)
+            return False
+        if not isinstance(record, dict) or record.get(
+                "version") != self._CACHE_VERSION:
+            return False
+
+        changed = False
+        files = []
+        racy_ns = record["time"] * 1000000000 - SpecPreprocessor.RACY_NS
+        for file_path, st_key, digest in record["files"]:
+            try:
+                new_st_key = UbuildDigests._stat_key(file_path)
+                if new_st_key != st_key or new_st_key[2] >= racy_ns:
+                    if UbuildDigests.hash_file(file_path, "sha1") != digest:
+                        return False
+                    changed = changed or new_st_key != st_key
+            except (IOError, OSError):
+                return False
+            files.append((file_path, new_st_key, digest))
+        for checked_path, state in record["paths"].items():
+            if self._path_state(checked_path) != state:
+                return False
+
+        if self._create_dirs:
+            keys = self._SUPPORTED_KEYS["^ubuild$"]
+            for param, values in record["sections"].get(
+                    "ubuild", {}).items():
+                if keys.get(param) != self._mangle_create_directory:
+                    continue
+                for value in values:
+                    if self._mangle_create_directory(
+                            self._spec_file, "ubuild", param,
+                            value) is None:
+                        return False
+
+        self.update(record["sections"])
+        self._ordered_sections = list(record["ordered_sections"])
+        self._files_read = [x[0] for x in files]
+        self._checked_paths = set(record["paths"].keys())
+        if changed:
+            record["files"] = files
+            record["time"] = time.time()
+            self._save_cache(path, record)
+        return True
+
+    def _write_cache(self):
+        """
+        Store the parsed metadata into the compiled spec cache.
+        """
+        try:
+            path = self._cache_path(self._spec_file)
+            files = []
+            for file_path in self._files_read:
+                files.append((
+                    file_path, UbuildDigests._stat_key(file_path),
+                    UbuildDigests.hash_file(file_path, "sha1")))
+        except (IOError, OSError) as err:
+            self._logger.warning(
+                "cannot cache %s: %s", self._spec_file, err)
+            return
+        record = {
+            "version": self._CACHE_VERSION,
+            "time": time.time(),
+            "files": files,
+            "paths": dict([(x, self._path_state(x))
+                           for x in self._checked_paths]),
+            "sections": dict(self),
+            "ordered_sections": self._ordered_sections,
+            }
+        self._save_cache(path, record)
+
+    def _save_cache(self, path, record):
+        """
+        Write the given compiled spec cache record to path.
+        """
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            with open(tmp_path, "wb") as cache_f:
+                pickle.dump(record, cache_f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as err:
+            self._logger.warning("cannot write %s: %s", path, err)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
     @classmethod
     def _is_executable(cls, path):
         """
@@ -502,6 +769,296 @@ class SpecParser(_SpecParser):
         else:
             return elems[0], elems[1]
 
+    def _mangle_positive_integer(self, _spec_path, section_name, param, value):
+        """
+        Mangle a positive integer string.
+        Return None if invalid.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          the mangled integer.
+        """
+        try:
+            number = int(value)
+        except ValueError:
+            number = 0
+        if number < 1:
+            self._logger.error(
+                "[%s] %s: not a positive integer: '%s'",
+                section_name, param, value)
+            return None
+        return number
+
+    # size suffixes supported by _mangle_size().
+    _SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30,
+                   "T": 1 << 40}
+
+    def _mangle_size(self, _spec_path, section_name, param, value):
+        """
+        Mangle a size string: a positive number of bytes, optionally
+        followed by the K, M, G or T (power of 1024) suffix.
+        Return None if invalid.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          the size in bytes.
+        """
+        number = value.strip().upper()
+        unit = ""
+        if number[-1:] in self._SIZE_UNITS:
+            number, unit = number[:-1], number[-1]
+        try:
+            size = int(float(number) * self._SIZE_UNITS[unit])
+        except (ValueError, OverflowError):
+            size = 0
+        if size < 1:
+            self._logger.error(
+                "[%s] %s: not a valid size: '%s'",
+                section_name, param, value)
+            return None
+        return size
+
+    def _mangle_cache_compression(self, _spec_path, section_name, param,
+                                  value):
+        """
+        Mangle a cache compression string, made of a codec name
+        (see UbuildCache.CODECS) optionally followed by level=<n> and
+        threads=<n> (0 meaning one per CPU).
+        Return None if invalid.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          a dict containing the codec, level and threads keys.
+        """
+        items = value.split()
+        if not items or items[0] not in UbuildCache.CODECS:
+            self._logger.error(
+                "[%s] %s: unsupported codec: '%s', supported: %s",
+                section_name, param, value,
+                ", ".join(sorted(UbuildCache.CODECS.keys())))
+            return None
+
+        codec = UbuildCache.CODECS[items[0]]
+        compression = {
+            "codec": items[0],
+            "level": codec["level"],
+            "threads": UbuildCache.DEFAULT_COMPRESSION["threads"],
+            }
+        for item in items[1:]:
+            key, sep, number = item.partition("=")
+            try:
+                number = int(number)
+            except ValueError:
+                number = -1
+            max_number = codec["max_level"] if key == "level" else number
+            if key not in ("level", "threads") or not sep or not (
+                    0 <= number <= max_number):
+                self._logger.error(
+                    "[%s] %s: invalid setting: '%s'",
+                    section_name, param, item)
+                return None
+            compression[key] = number
+        return compression
+
+    def _mangle_cache_backend(self, _spec_path, section_name, param, value):
+        """
+        Mangle a cache backend string, made of a backend name (see
+        UbuildCache.BACKENDS) optionally followed, for the "cas"
+        backend, by "hardlink".
+        Return None if invalid.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          a dict containing the name and hardlink keys.
+        """
+        items = value.split()
+        if not items or items[0] not in UbuildCache.BACKENDS:
+            self._logger.error(
+                "[%s] %s: unsupported backend: '%s', supported: %s",
+                section_name, param, value,
+                ", ".join(UbuildCache.BACKENDS))
+            return None
+        if items[1:] and (items[0] != "cas" or items[1:] != ["hardlink"]):
+            self._logger.error(
+                "[%s] %s: invalid settings: '%s'",
+                section_name, param, " ".join(items[1:]))
+            return None
+        return {"name": items[0], "hardlink": len(items) > 1}
+
+    def _mangle_cache_remote(self, _spec_path, section_name, param, value):
+        """
+        Mangle a remote cache string, made of an http:// or https://
+        URL optionally followed by "readonly".
+        Return None if invalid.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          a dict containing the url and readonly keys.
+        """
+        items = value.split()
+        url = items[0] if items else ""
+        try:
+            parts = urlsplit(url)
+            # port raises ValueError if invalid.
+            valid = (parts.scheme in ("http", "https") and
+                     parts.hostname is not None and parts.port != 0)
+        except ValueError:
+            valid = False
+        if not valid or items[1:] not in ([], ["readonly"]):
+            self._logger.error(
+                "[%s] %s: invalid remote cache: '%s'",
+                section_name, param, value)
+            return None
+        return {"url": url, "readonly": len(items) > 1}
+
+    def _mangle_cache_warm(self, spec_path, section_name, param, value):
+        """
+        Mangle an extracted cache entries tier string, made of a size
+        (see _mangle_size()) optionally followed by "hardlink".
+        Return None if invalid.
+
+        Args:
+          spec_path: the .spec file path.
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          a dict containing the max_size and hardlink keys.
+        """
+        items = value.split()
+        if not items:
+            items = [""]
+        if items[1:] not in ([], ["hardlink"]):
+            self._logger.error(
+                "[%s] %s: invalid settings: '%s'",
+                section_name, param, " ".join(items[1:]))
+            return None
+        max_size = self._mangle_size(
+            spec_path, section_name, param, items[0])
+        if max_size is None:
+            return None
+        return {"max_size": max_size, "hardlink": len(items) > 1}
+
+    def _mangle_cache_hash(self, _spec_path, section_name, param, value):
+        """
+        Mangle a cache key hash algorithm name, see UbuildCache.HASHES.
+        Return None if invalid or not available.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          the hash algorithm name.
+        """
+        available = getattr(hashlib, "algorithms_available", ("sha1",))
+        if value not in UbuildCache.HASHES or value not in available:
+            self._logger.error(
+                "[%s] %s: unsupported hash algorithm: '%s', supported: %s",
+                section_name, param, value,
+                ", ".join([x for x in UbuildCache.HASHES
+                           if x in available]))
+            return None
+        return value
+
+    def _mangle_checksum(self, _spec_path, section_name, param, value):
+        """
+        Mangle a source tarball checksum, in the "<algorithm>:<hex digest>
+        [<tarball name>]" form. Return None if invalid.
+
+        Args:
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          a (algorithm, hex digest, tarball name or None) tuple.
+        """
+        elems = value.split(None, 1)
+        algorithm, _sep, digest = (elems or [""])[0].partition(":")
+        available = getattr(hashlib, "algorithms_available", ("sha1",))
+        if algorithm.lower() not in available or not re.match(
+                r"^[0-9a-fA-F]+$", digest):
+            self._logger.error(
+                "[%s] %s: invalid checksum: '%s'",
+                section_name, param, value)
+            return None
+        name = None
+        if len(elems) > 1:
+            name = elems[1].strip()
+        return algorithm.lower(), digest.lower(), name
+
+    def _mangle_matrix_value(self, _spec_path, section_name, param, value):
+        """
+        Mangle a matrix value, in the "<label>: <value>" form. The label
+        can be omitted if the value is a valid label itself.
+        Return None if invalid.
+
+        Args:
+          spec_path: the .spec file path that is being parsed.
+          section_name: the .ini section name.
+          param: the parameter name inside the section.
+          value: the parameter value to validate.
+
+        Returns:
+          a (label, value) tuple.
+        """
+        match = re.match(r"^([\w+-]+):(?:\s+(.*))?$", value)
+        if match:
+            return match.group(1), match.group(2) or ""
+        if re.match(r"^[\w+-]+$", value):
+            return value, value
+        self._logger.error(
+            "[%s] %s: missing label: '%s'",
+            section_name, param, value)
+        return None
+
+    @classmethod
+    def _mangle_depends(cls, _spec_path, section_name, _param, value):
+        """
+        Mangle a string containing space separated target names.
+        Target names without a type prefix (cross= or pkg=) are
+        considered of the same type of section_name. The special
+        "none" value declares a target without dependencies.
+
+        Args:
+          section_name: the .ini section name.
+          value: the parameter value to validate.
+
+        Returns:
+          the mangled list of target names.
+        """
+        target_type = section_name.split("=", 1)[0]
+        depends = []
+        for dep in value.split():
+            if dep != "none" and "=" not in dep:
+                dep = "%s=%s" % (target_type, dep)
+            depends.append(dep)
+        if depends:
+            return depends
+
     @classmethod
     def _mangle_cache_vars(cls, _spec_path, section_name, _param, value):
         """
@@ -533,6 +1090,7 @@ class SpecParser(_SpecParser):
           the mangled file path.
         """
         new_value = self._path_normalize(spec_path, value)
+        self._checked_paths.add(new_value)
         if not os.path.isfile(new_value):
             self._logger.error(
                 "[%s] %s: not found: '%s'",
@@ -555,6 +1113,7 @@ class SpecParser(_SpecParser):
           the mangled directory.
         """
         new_value = self._path_normalize(spec_path, value)
+        self._checked_paths.add(new_value)
         if not os.path.isdir(new_value):
             self._logger.error(
                 "[%s] %s: not found: '%s'",
@@ -577,6 +1136,8 @@ class SpecParser(_SpecParser):
           the mangled (and created if not found) directory.
         """
         new_value = self._path_normalize(spec_path, value)
+        if not self._create_dirs:
+            return new_value
 
         try:
             os.makedirs(new_value, 0o755)
@@ -607,6 +1168,7 @@ class SpecParser(_SpecParser):
             return None
 
         exe = self._path_normalize(spec_path, args[0])
+        self._checked_paths.add(exe)
         if not self._is_executable(exe):
             self._logger.error(
                 "[%s] %s: not executable: '%s'",
@@ -662,6 +1224,42 @@ class SpecParser(_SpecParser):
                 elif len(data[param]) > qty or len(data[param]) < qty:
                     missing.append("[%s].%s maximum %d occurrences" % (
                         section, param, qty))
+
+        cross_targets = self.cross_targets()
+        for targets in (cross_targets, self.pkg_targets()):
+            for index, target in enumerate(targets):
+                for dep in self.target_depends(target) or []:
+                    if dep in targets[:index]:
+                        continue
+                    if target.startswith("pkg=") and dep in cross_targets:
+                        continue
+                    missing.append(
+                        "[%s].depends %s is not a previously defined "
+                        "target" % (target, dep))
+                tarballs = [x for _url, x in self[target].get("url", [])]
+                for _algorithm, _digest, name in self[target].get(
+                        "checksum", []):
+                    if name is None and len(tarballs) != 1:
+                        missing.append(
+                            "[%s].checksum tarball name not set" % (
+                                target,))
+                    elif name is not None and name not in tarballs:
+                        missing.append(
+                            "[%s].checksum %s is not a tarball of the "
+                            "target" % (target, name))
+
+        for variable, values in self.matrix():
+            if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", variable):
+                missing.append(
+                    "[matrix=%s] invalid variable name" % (variable,))
+            if "matrix=%s" % (variable,) not in self:
+                missing.append("[matrix=%s].value not set" % (variable,))
+            labels = [label for label, _value in values]
+            for label in sorted(set(labels)):
+                if labels.count(label) > 1:
+                    missing.append("[matrix=%s].value %s defined %d "
+                                   "times" % (variable, label,
+                                              labels.count(label)))
         if missing:
             raise SpecParser.MissingParametersError(missing)
 
@@ -689,6 +1287,45 @@ class SpecParser(_SpecParser):
             cache_vars.update(lst)
         return sorted(cache_vars)
 
+    def target_checksums(self, target):
+        """
+        Return a dict mapping the tarball names of target to their
+        (algorithm, hex digest) checksum, if set.
+
+        Args:
+          the given build target.
+
+        Raises:
+          KeyError: if target is not found.
+        """
+        checksums = {}
+        urls = self[target].get("url", [])
+        for algorithm, digest, name in self[target].get("checksum", []):
+            if name is None:
+                name = urls[0][1]
+            checksums[name] = (algorithm, digest)
+        return checksums
+
+    def target_depends(self, target):
+        """
+        Return the list of targets that the given target depends on,
+        or None if no dependencies have been declared.
+
+        Args:
+          the given build target.
+
+        Raises:
+          KeyError: if target is not found.
+        """
+        if "depends" not in self[target]:
+            return None
+        depends = []
+        for lst in self[target]["depends"]:
+            for dep in lst:
+                if dep != "none" and dep not in depends:
+                    depends.append(dep)
+        return depends
+
     def ubuild(self):
         """
         Return the ubuild section metadata.
@@ -701,12 +1338,56 @@ class SpecParser(_SpecParser):
         """
         return self.ubuild()["build_dir"][0]
 
+    def cross_build_dir(self):
+        """
+        Return the build_dir of the cross targets: build_dir, or the
+        build_dir shared by the variants building the same cross
+        targets, see variants().
+        """
+        return self._cross_build_dir or self.build_dir()
+
     def build_image(self):
         """
         Return the build_image metadata value.
         """
         return self.ubuild()["build_image"][0]
 
+    def cache_backend(self):
+        """
+        Return the cache_backend metadata value, None if unset.
+        """
+        return self.ubuild().get("cache_backend", [None])[0]
+
+    def cache_remote(self):
+        """
+        Return the cache_remote metadata value, None if unset.
+        """
+        return self.ubuild().get("cache_remote", [None])[0]
+
+    def cache_warm(self):
+        """
+        Return the cache_warm metadata value, None if unset.
+        """
+        return self.ubuild().get("cache_warm", [None])[0]
+
+    def cache_compression(self):
+        """
+        Return the cache_compression metadata value, None if unset.
+        """
+        return self.ubuild().get("cache_compression", [None])[0]
+
+    def cache_hash(self):
+        """
+        Return the cache_hash metadata value, sha1 if unset.
+        """
+        return self.ubuild().get("cache_hash", ["sha1"])[0]
+
+    def cache_max_size(self):
+        """
+        Return the cache_max_size metadata value, in bytes, None if unset.
+        """
+        return self.ubuild().get("cache_max_size", [None])[0]
+
     def cache_dir(self):
         """
         Return the cache_dir metadata value.
@@ -737,6 +1418,18 @@ class SpecParser(_SpecParser):
         """
         return self.ubuild()["initramfs_rootfs_dir"][0]
 
+    def jobs(self):
+        """
+        Return the jobs metadata value, None if unset.
+        """
+        return self.ubuild().get("jobs", [None])[0]
+
+    def parallel_targets(self):
+        """
+        Return the parallel_targets metadata value, 1 if unset.
+        """
+        return self.ubuild().get("parallel_targets", [1])[0]
+
     def rootfs_dir(self):
         """
         Return the rootfs_dir metadata value.
@@ -767,157 +1460,3552 @@ class SpecParser(_SpecParser):
         """
         return [x for x in self._ordered_sections if x.startswith("pkg=")]
 
+    def matrix(self):
+        """
+        Return an ordered list of (variable, values) tuples, one per
+        [matrix=] section, where values is the list of (label, value)
+        tuples of the variable.
+        """
+        return [(x[len("matrix="):], self.get(x, {}).get("value", []))
+                for x in self._ordered_sections if x.startswith("matrix=")]
 
-class UbuildCache(object):
-    """
-    Ubuild compilation cache class.
+    def variant(self):
+        """
+        Return the variant label of this spec, or None if this is not a
+        variant, see variants().
+        """
+        return self._variant
 
-    This class is responsible of maintaining the compilation
-    cache of tarballs built through Ubuild. In particular,
-    it implements:
+    def variables(self):
+        """
+        Return a dict containing the environment variables set by the
+        variant, see variants().
+        """
+        return dict(self._variables)
 
-    - a lookup method to determine if the tarball is in cache.
-      The cache key is generated by taking into consideration
-      a set of elements: the tarball name, the sourced environment
-      (from the environment file) and the list of patches and
-      their checksums.
-    - a pack method that takes an image directory as input (together
-      with the parameters passed to lookup) and creates an entry in
-      the cache directory (basically, it creates a tarball there).
-    - an unpack method that takes an empty directory and a cache file
-      as input and populates it.
+    def variants(self):
+        """
+        Expand the [matrix=] sections into a list of SpecParser objects,
+        one per combination of their values, or [self] if no [matrix=]
+        sections are defined. Variants use their own build_dir,
+        compile_dir (suffixed with the variant label, the value labels
+        joined by dots) and image_name (prefixed with it). Their cross
+        targets share build_dir, suffixed only with the labels of the
+        variables that are cache_vars of the cross targets, see
+        cross_build_dir(). Return None if a variant directory cannot
+        be created.
+        """
+        matrix = self.matrix()
+        if not matrix:
+            return [self]
+
+        cross_vars = set(self.cache_vars())
+        for target in self.cross_targets():
+            cross_vars.update(self.target_cache_vars(target))
+
+        variants = []
+        for combination in itertools.product(
+                *[values for _variable, values in matrix]):
+            label = ".".join([x[0] for x in combination])
+            cross_label = ".".join([
+                x[0] for (variable, _values), x in zip(matrix, combination)
+                if variable in cross_vars])
+            build_dir = self.build_dir()
+            if cross_label:
+                build_dir = self._mangle_create_directory(
+                    self._spec_file, "ubuild", "build_dir",
+                    "%s.%s" % (build_dir.rstrip(os.sep), cross_label))
+                if build_dir is None:
+                    return None
+            ubuild = dict(self.ubuild())
+            for param in ("build_dir", "compile_dir"):
+                paths = []
+                for path in ubuild[param]:
+                    path = self._mangle_create_directory(
+                        self._spec_file, "ubuild", param,
+                        "%s.%s" % (path.rstrip(os.sep), label))
+                    if path is None:
+                        return None
+                    paths.append(path)
+                ubuild[param] = paths
+            ubuild["image_name"] = ["%s.%s" % (label, x)
+                                    for x in ubuild["image_name"]]
+
+            variant = copy.copy(self)
+            variant["ubuild"] = ubuild
+            variant._variant = label
+            variant._cross_build_dir = build_dir
+            variant._variables = dict([
+                (variable, value) for (variable, _values), (_label, value)
+                in zip(matrix, combination)])
+            variants.append(variant)
+        return variants
+
+
+class UbuildTracer(object):
+    """
+    Ubuild build timeline recorder.
+
+    Spans of the build timeline (spec parsing, environment sourcing,
+    build scripts, cache packing and unpacking, ...) are collected and
+    written into a Trace Event Format file, that can be loaded into
+    chrome://tracing or Perfetto. Each thread of execution is shown
+    as a separate track.
+    """
+
+    def __init__(self):
+        """
+        Object constructor. The tracer is disabled until enable() is
+        called.
+        """
+        self._enabled = False
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+
+    def enable(self):
+        """
+        Start recording spans.
+        """
+        self._enabled = True
+
+    def add(self, name, category, start, end, args=None):
+        """
+        Record a span of the current thread.
+
+        Args:
+          name: the span name.
+          category: the span category.
+          start: the span start time, as returned by time.time().
+          end: the span end time, as returned by time.time().
+          args: a dict of additional information about the span.
+        """
+        if not self._enabled:
+            return
+
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int(start * 1000000),
+            "dur": int(max(end - start, 0) * 1000000),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        """
+        Context manager recording a span lasting as long as its body.
+        See add().
+        """
+        if not self._enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), args=args)
+
+    def write(self, path):
+        """
+        Write the recorded spans to path.
+
+        Args:
+          path: the trace file path.
+
+        Returns:
+          an exit status.
+        """
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+
+        pid = os.getpid()
+        events.append({
+            "name": "process_name", "ph": "M", "pid": pid,
+            "args": {"name": "ubuild"},
+            })
+        for tid, name in threads.items():
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": name},
+                })
+
+        try:
+            with open(path, "w") as trace_f:
+                json.dump(
+                    {"traceEvents": events, "displayTimeUnit": "ms"},
+                    trace_f)
+        except (OSError, IOError) as err:
+            sys.stderr.write("Cannot write trace file %s: %s\n" % (
+                path, err))
+            return 1
+        return 0
+
+
+# the build timeline recorder, enabled by ubuild --trace.
+_tracer = UbuildTracer()
+
+
+class UbuildFileLock(object):
     """
+    Advisory, exclusive, file lock (see flock(2)), coordinating the
+    ubuild processes, and the build scripts, sharing a directory, like
+    sources_dir or cache_dir. Lock files are kept inside the LOCKS_DIR
+    subdirectory, which build.include uses as well.
+    """
+
+    LOCKS_DIR = ".ubuild_locks"
 
-    def __init__(self, seed, sources_dir, cache_dir, variables):
+    # lock polling interval, in seconds.
+    _POLL_INTERVAL = 0.5
+
+    def __init__(self, directory, name):
         """
         Object constructor.
 
         Args:
-          seed: seed string to feed the cache key hash generator with.
-          sources_dir: the directory in where source tarballs are downloaded.
-          cache_dir: the cache directory in where all the cached
-              tarballs are to be found.
-          variables: the environment variables used for cache validation.
+          directory: the shared directory.
+          name: the lock name, like the name of the shared file.
         """
-        self._seed = seed
-        self._sources_dir = sources_dir
-        self._dir = cache_dir
-        self._vars = variables
+        self._logger = logging.getLogger("ubuild.Handler")
+        self.path = os.path.join(directory, self.LOCKS_DIR, name + ".lock")
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """
+        Acquire the lock, waiting for it if blocking is True.
+        Return whether the lock has been acquired.
+
+        Raises:
+          OSError: if the lock file cannot be opened.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o666)
+        # not inherited by the build scripts.
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        logged = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._fd = fd
+                return True
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            if not blocking:
+                os.close(fd)
+                return False
+            if not logged:
+                self._logger.info(
+                    "waiting for another ubuild process holding %s",
+                    self.path)
+                logged = True
+            # poll, to keep KeyboardInterrupt working.
+            time.sleep(self._POLL_INTERVAL)
+
+    def release(self):
+        """
+        Release the lock, if acquired.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class UbuildDigests(object):
+    """
+    Ubuild persistent file digests index.
+
+    Digests of source tarballs and patches are stored into an index
+    file, together with the inode, size and modification time of the
+    files, so that unchanged files are never read again, across runs.
+    As done for the spec cache, the digests of files modified less than
+    SpecPreprocessor.RACY_NS before being hashed are not trusted, since
+    a rewrite within the mtime granularity would go unnoticed. The index
+    is shared by all the objects using the same index file, see get(),
+    and written by save().
+    """
+
+    INDEX_FILE = ".ubuild_digests"
+
+    # read size used when hashing files.
+    _BLOCK_SIZE = 1024 * 1024
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Object constructor.
+
+        Args:
+          path: the index file path.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+        self._hashing = {}
+
+    @classmethod
+    def get(cls, directory):
+        """
+        Return the UbuildDigests object whose index file is stored
+        inside directory.
+        """
+        path = os.path.join(os.path.abspath(directory), cls.INDEX_FILE)
+        with cls._instances_lock:
+            digests = cls._instances.get(path)
+            if digests is None:
+                digests = cls(path)
+                cls._instances[path] = digests
+            return digests
+
+    def _load(self):
+        """
+        Return the index file content. Must be called with the lock held.
+        """
+        try:
+            with open(self._path, "r") as index_f:
+                entries = json.load(index_f)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self._logger.warning("cannot read %s: %s", self._path, err)
+            return {}
+        except ValueError:
+            self._logger.warning("invalid %s, ignoring", self._path)
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def save(self):
+        """
+        Write the index file, if digests have been calculated since the
+        last call.
+        """
+        with self._lock:
+            if self._dirty:
+                self._save()
+                self._dirty = False
+
+    @classmethod
+    def save_all(cls):
+        """
+        Write the index files of all the UbuildDigests objects, see save().
+        """
+        with cls._instances_lock:
+            instances = list(cls._instances.values())
+        for digests in instances:
+            digests.save()
+
+    def _save(self):
+        """
+        Write the index file, merging it with the entries written by
+        other processes in the meantime. Must be called with the lock
+        held.
+        """
+        entries = self._load()
+        entries.update(self._entries)
+        self._entries = entries
+
+        tmp_path = "%s.%d.tmp" % (self._path, os.getpid())
+        try:
+            with open(tmp_path, "w") as index_f:
+                json.dump(entries, index_f, indent=1, sort_keys=True)
+            os.rename(tmp_path, self._path)
+        except (OSError, IOError) as err:
+            # the digests are recalculated next time.
+            self._logger.warning("cannot write %s: %s", self._path, err)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    @classmethod
+    def _stat_key(cls, path):
+        """
+        Return the [inode, size, mtime in nanoseconds] list identifying
+        the current content of the file at path.
+        """
+        st = os.stat(path)
+        mtime_ns = getattr(st, "st_mtime_ns", None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return [st.st_ino, st.st_size, mtime_ns]
 
-    def _sha1(self, path):
+    @classmethod
+    def hash_file(cls, path, algorithm):
         """
-        Calculate a SHA1 hash of given file at path.
+        Read the file at path and return its hex digest.
 
         Args:
           path: a file path.
+          algorithm: a hashlib algorithm name.
 
         Returns:
-          a SHA1 hash.
+          a hex digest string.
         """
-        m = hashlib.sha1()
+        m = hashlib.new(algorithm)
         with open(path, "rb") as readfile:
-            block = readfile.read(16384)
+            block = readfile.read(cls._BLOCK_SIZE)
             while block:
                 m.update(block)
-                block = readfile.read(16384)
+                block = readfile.read(cls._BLOCK_SIZE)
         return m.hexdigest()
 
-    def _generate_entry_name(self, tarball_names, builds, patches, environment):
+    def digest(self, path, algorithm="sha1"):
+        """
+        Return the hex digest of the file at path, reading it only if
+        its digest is not in the index or the file has changed.
+
+        Args:
+          path: a file path.
+          algorithm: a hashlib algorithm name.
+
+        Returns:
+          a hex digest string.
+        """
+        path = os.path.abspath(path)
+        stat_key = self._stat_key(path)
+        hashing_key = (path, algorithm)
+
+        while True:
+            with self._lock:
+                if self._entries is None:
+                    self._entries = self._load()
+                entry = self._entries.get(path)
+                if isinstance(entry, dict) and entry.get(
+                        "stat") == stat_key and not self._racy(entry):
+                    hexdigest = entry.get("digests", {}).get(algorithm)
+                    if hexdigest is not None:
+                        return hexdigest
+
+                # wait for another thread hashing the same file.
+                event = self._hashing.get(hashing_key)
+                if event is None:
+                    event = threading.Event()
+                    self._hashing[hashing_key] = event
+                    break
+            event.wait()
+
+        hexdigest = None
+        hash_time = time.time()
+        try:
+            hexdigest = self.hash_file(path, algorithm)
+            return hexdigest
+        finally:
+            with self._lock:
+                if hexdigest is not None:
+                    entry = self._entries.get(path)
+                    if not isinstance(entry, dict) or (
+                            entry.get("stat") != stat_key) or (
+                                self._racy(entry)):
+                        entry = {"stat": stat_key, "digests": {},
+                                 "time": hash_time}
+                        self._entries[path] = entry
+                    entry["digests"][algorithm] = hexdigest
+                    self._dirty = True
+                del self._hashing[hashing_key]
+                event.set()
+
+    @classmethod
+    def _racy(cls, entry):
+        """
+        Return whether the file of the given index entry was modified
+        too shortly before being hashed for its digests to be trusted.
+        """
+        hash_time = entry.get("time")
+        if not isinstance(hash_time, (int, float)):
+            return True
+        return entry["stat"][2] >= (
+            int(hash_time * 1000000000) - SpecPreprocessor.RACY_NS)
+
+    def prefetch(self, paths, algorithm, workers):
+        """
+        Calculate the digests of the given files in background threads.
+        Calls to digest() for the files being hashed wait for them. The
+        index file is written once all the files are hashed.
+
+        Args:
+          paths: a list of file paths.
+          algorithm: a hashlib algorithm name.
+          workers: the number of threads to use.
+        """
+        paths = list(paths)
+        lock = threading.Lock()
+        running = [min(workers, len(paths))]
+
+        def _worker():
+            while True:
+                with lock:
+                    if not paths:
+                        running[0] -= 1
+                        if running[0] == 0:
+                            break
+                        return
+                    path = paths.pop(0)
+                try:
+                    self.digest(path, algorithm)
+                except (OSError, IOError) as err:
+                    # reported by the build, if ever needed.
+                    self._logger.debug("cannot hash %s: %s", path, err)
+            self.save()
+
+        for _index in range(running[0]):
+            thread = threading.Thread(target=_worker)
+            thread.daemon = True
+            thread.start()
+
+
+class UbuildCacheIndex(object):
+    """
+    Ubuild cache index database.
+
+    The index is a SQLite database stored inside the cache directory,
+    recording, for every cache entry: the cache key inputs, the target
+    and spec that created it, its compressed and uncompressed size, the
+    time spent building, packing and unpacking it, its last access time
+    and the number of cache hits. Every cache lookup outcome is recorded
+    too, with the build time saved by cache hits. Each update is done
+    in its own transaction, so the index can be shared by concurrent
+    ubuild processes. Index errors are logged and ignored: cache files
+    stay the authority on what is cached.
+    """
+
+    INDEX_FILE = ".ubuild_cache.db"
+
+    # SQLite busy timeout, in seconds.
+    _TIMEOUT = 60.0
+
+    _SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            file TEXT NOT NULL,
+            target TEXT,
+            spec TEXT,
+            inputs TEXT,
+            size INTEGER,
+            unpacked_size INTEGER,
+            build_time REAL,
+            pack_time REAL,
+            unpack_time REAL,
+            created REAL,
+            last_access REAL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS lookups (
+            key TEXT NOT NULL,
+            target TEXT,
+            spec TEXT,
+            hit INTEGER NOT NULL,
+            saved REAL NOT NULL DEFAULT 0,
+            time REAL NOT NULL
+        )""",
+        """CREATE INDEX IF NOT EXISTS lookups_target
+            ON lookups (target)""",
+        )
+
+    def __init__(self, cache_dir):
+        """
+        Object constructor.
+
+        Args:
+          cache_dir: the cache directory.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._path = os.path.join(cache_dir, self.INDEX_FILE)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Context manager yielding a connection to the index database,
+        whose changes are committed on exit, or rolled back on error.
+        """
+        conn = sqlite3.connect(self._path, timeout=self._TIMEOUT)
+        try:
+            with conn:
+                for statement in self._SCHEMA:
+                    conn.execute(statement)
+                yield conn
+        finally:
+            conn.close()
+
+    def _execute(self, what, statements):
+        """
+        Execute the given (sql, parameters) statements in a transaction.
+        Return True on success.
+        """
+        try:
+            with self._transaction() as conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        except sqlite3.Error as err:
+            self._logger.warning(
+                "cannot %s in the cache index %s: %s", what, self._path, err)
+            return False
+        return True
+
+    def add(self, entry_path, target, spec, inputs, unpacked_size,
+            build_time, pack_time, size=None):
+        """
+        Record a new cache entry, and the cache miss that produced it.
+
+        Args:
+          entry_path: the cache entry file path.
+          target: the build target name.
+          spec: the spec file path.
+          inputs: a dict of the cache key inputs.
+          unpacked_size: the size of the packed files, in bytes.
+          build_time: the time spent building the entry, in seconds.
+          pack_time: the time spent packing the entry, in seconds.
+          size: the space taken by the entry in the cache directory,
+              in bytes, the cache file size if None.
+        """
+        key = UbuildCache.entry_key(entry_path)
+        if size is None:
+            try:
+                size = os.path.getsize(entry_path)
+            except OSError:
+                pass
+        now = time.time()
+        return self._execute("record %s" % (key,), (
+            ("INSERT OR REPLACE INTO entries (key, file, target, spec, "
+             "inputs, size, unpacked_size, build_time, pack_time, created, "
+             "last_access, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+             "0)", (key, os.path.basename(entry_path), target, spec,
+                    json.dumps(inputs, sort_keys=True), size, unpacked_size,
+                    build_time, pack_time, now, now)),
+            ("INSERT INTO lookups (key, target, spec, hit, time) "
+             "VALUES (?, ?, ?, 0, ?)", (key, target, spec, now)),
+            ))
+
+    def hit(self, entry_path, target, spec, unpack_time):
+        """
+        Record a cache hit of the given cache entry, which took
+        unpack_time seconds to unpack.
+        """
+        key = UbuildCache.entry_key(entry_path)
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                row = conn.execute(
+                    "SELECT build_time FROM entries WHERE key = ?",
+                    (key,)).fetchone()
+                if row is None:
+                    # created by an older ubuild or imported.
+                    conn.execute(
+                        "INSERT INTO entries (key, file, target, spec, "
+                        "size, created) VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, os.path.basename(entry_path), target, spec,
+                         os.path.getsize(entry_path), now))
+                saved = 0.0
+                if row is not None and row[0] is not None:
+                    saved = max(row[0] - unpack_time, 0.0)
+                conn.execute(
+                    "UPDATE entries SET hits = hits + 1, last_access = ?, "
+                    "unpack_time = ? WHERE key = ?",
+                    (now, unpack_time, key))
+                conn.execute(
+                    "INSERT INTO lookups (key, target, spec, hit, saved, "
+                    "time) VALUES (?, ?, ?, 1, ?, ?)",
+                    (key, target, spec, saved, now))
+        except (sqlite3.Error, OSError) as err:
+            self._logger.warning(
+                "cannot record the hit of %s in the cache index %s: %s",
+                key, self._path, err)
+            return False
+        return True
+
+    def copy(self, entry_path, other):
+        """
+        Copy the record of a cache entry from another UbuildCacheIndex,
+        if any, when the entry is imported from its cache directory.
+        """
+        key = UbuildCache.entry_key(entry_path)
+        try:
+            with other._transaction() as conn:
+                conn.row_factory = sqlite3.Row
+                row = conn.execute(
+                    "SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as err:
+            self._logger.warning(
+                "cannot read %s from the cache index %s: %s",
+                key, other._path, err)
+            return False
+        if row is None:
+            return False
+        names = [x for x in row.keys() if x not in ("hits", "last_access")]
+        return self._execute("import %s" % (key,), (
+            ("INSERT OR IGNORE INTO entries (%s) VALUES (%s)" % (
+                ", ".join(names), ", ".join(["?"] * len(names))),
+             tuple([row[x] for x in names])),
+            ))
+
+    def remove(self, keys):
+        """
+        Remove the records of the given cache entry keys.
+        """
+        return self._execute("remove %d entries" % (len(keys),), [
+            ("DELETE FROM entries WHERE key = ?", (x,)) for x in keys])
+
+    def last_access(self):
+        """
+        Return a dict mapping the recorded cache entry keys to their
+        last access (or creation) time.
+        """
+        try:
+            with self._transaction() as conn:
+                rows = conn.execute(
+                    "SELECT key, COALESCE(last_access, created) "
+                    "FROM entries").fetchall()
+        except sqlite3.Error as err:
+            self._logger.warning(
+                "cannot read the cache index %s: %s", self._path, err)
+            return {}
+        return dict([(x, y) for x, y in rows if y is not None])
+
+    def entries(self):
+        """
+        Return the list of the recorded cache entries, as dicts.
+        """
+        with self._transaction() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM entries ORDER BY target, key").fetchall()
+        return [dict(zip(x.keys(), tuple(x))) for x in rows]
+
+    def stats(self):
         """
-        Given a set of input information, generate a cache entry file name.
+        Return the cache lookup statistics of every target, as a list of
+        (target, lookups, hits, saved time) tuples.
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "SELECT target, COUNT(*), SUM(hit), SUM(saved) "
+                "FROM lookups GROUP BY target ORDER BY target").fetchall()
+
+
+class UbuildCasStore(object):
+    """
+    Ubuild content-addressed file store.
+
+    Cache entries packed by the "cas" cache backend are stored as a
+    manifest, listing the directories, symlinks, regular files and
+    hardlinks (to a regular file listed before) of the packed tree with
+    their metadata, while the content of regular files is stored once,
+    into a read-only blob named after its SHA1 digest, inside the store
+    directory. Blobs are copied into, and out of, the store by reflink
+    when the filesystem supports it, or, optionally, hardlinked out of
+    the store, in which case the unpacked files are read-only too.
+    """
+
+    STORE_DIR = ".ubuild_cas"
+
+    # version 2 adds hardlinks, version 1 manifests are still read.
+    MANIFEST_VERSION = 2
+    _MANIFEST_VERSIONS = (1, 2)
+
+    # read size used when hashing files.
+    _BLOCK_SIZE = 1024 * 1024
+
+    # linux/fs.h FICLONE ioctl.
+    _FICLONE = 0x40049409
+
+    class UnsupportedFileError(Exception):
+        """
+        Exception raised when packing a file that cannot be stored,
+        like device nodes, fifos or sockets.
+        """
+
+    def __init__(self, cache_dir):
+        """
+        Object constructor.
+
+        Args:
+          cache_dir: the cache directory containing the store.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._dir = os.path.join(cache_dir, self.STORE_DIR)
+
+    def blob_path(self, digest):
+        """
+        Return the path of the blob of the given digest.
+        """
+        return os.path.join(self._dir, digest[:2], digest)
+
+    @classmethod
+    def clone(cls, src, dst):
+        """
+        Copy the content of the src file into the new dst file, sharing
+        the data blocks by reflink if possible.
+        """
+        with open(src, "rb") as src_f:
+            with open(dst, "wb") as dst_f:
+                try:
+                    fcntl.ioctl(dst_f.fileno(), cls._FICLONE, src_f.fileno())
+                    return
+                except (IOError, OSError):
+                    pass
+                shutil.copyfileobj(src_f, dst_f, cls._BLOCK_SIZE)
+
+    @classmethod
+    def _hash_file(cls, path):
+        """
+        Return the SHA1 hex digest of the file at path.
         """
         sha = hashlib.sha1()
-        sha.update(self._seed)
-        sha.update("--")
-        for args in builds:
-            sha.update("--")
-            for arg in args:
-                sha.update(arg)
-            sha.update("--")
+        with open(path, "rb") as path_f:
+            data = path_f.read(cls._BLOCK_SIZE)
+            while data:
+                sha.update(data)
+                data = path_f.read(cls._BLOCK_SIZE)
+        return sha.hexdigest()
+
+    def _put(self, path, st):
+        """
+        Store the content of the regular file at path, whose lstat()
+        result is st, if not stored yet. Return a (digest, stored bytes)
+        tuple.
+        """
+        digest = self._hash_file(path)
+        blob_path = self.blob_path(digest)
+        try:
+            # refresh the blob ctime, so that gc() keeps it.
+            blob_st = os.lstat(blob_path)
+            os.chmod(blob_path, stat.S_IMODE(blob_st.st_mode) & ~0o222)
+            return digest, 0
+        except OSError:
+            pass
 
-        sha.update("--")
-        for patch in patches:
-            sha.update(self._sha1(patch))
+        blob_dir = os.path.dirname(blob_path)
+        try:
+            os.makedirs(blob_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=blob_dir, prefix=".%s." % (digest,))
+        os.close(tmp_fd)
+        try:
+            self.clone(path, tmp_path)
+            # blobs may be hardlinked out of the store, see unpack():
+            # writing them in place would change every cache entry.
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode) & ~0o222)
+            if os.geteuid() == 0:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            os.utime(tmp_path, (st.st_atime, st.st_mtime))
+            os.rename(tmp_path, blob_path)
+            tmp_path = None
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        return digest, st.st_size
 
-        sha.update("--")
-        for tarball in tarball_names:
-            sha.update(tarball)
-            path = os.path.join(self._sources_dir, tarball)
-            if os.path.isfile(path):
-                sha.update(self._sha1(path))
-            else:
-                sha.update(path) # if not found, just preserve a seat
+    def pack(self, tree_dir):
+        """
+        Store the regular files of the given directory tree, return
+        a (manifest, stored bytes) tuple. Files hardlinked to each other
+        within the tree are stored once and listed as hardlinks to the
+        first of them.
+
+        Raises:
+          UbuildCasStore.UnsupportedFileError: if the tree contains
+              files other than directories, symlinks and regular files.
+          OSError, IOError: in case of I/O errors.
+        """
+        entries = []
+        stored = 0
+        # the paths of the files having other hardlinks, by inode.
+        inodes = {}
+        for root, dirs, files in os.walk(tree_dir):
+            dirs.sort()
+            for name in sorted(dirs) + sorted(files):
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                entry = {
+                    "path": os.path.relpath(path, tree_dir),
+                    "mode": stat.S_IMODE(st.st_mode),
+                    "uid": st.st_uid,
+                    "gid": st.st_gid,
+                    "mtime": st.st_mtime,
+                    }
+                if stat.S_ISDIR(st.st_mode):
+                    entry["type"] = "d"
+                elif stat.S_ISLNK(st.st_mode):
+                    entry["type"] = "l"
+                    entry["target"] = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode) and (
+                        st.st_dev, st.st_ino) in inodes:
+                    entry = {
+                        "path": entry["path"],
+                        "type": "h",
+                        "target": inodes[(st.st_dev, st.st_ino)],
+                        }
+                elif stat.S_ISREG(st.st_mode):
+                    entry["type"] = "f"
+                    entry["size"] = st.st_size
+                    entry["digest"], size = self._put(path, st)
+                    stored += size
+                    if st.st_nlink > 1:
+                        inodes[(st.st_dev, st.st_ino)] = entry["path"]
+                else:
+                    raise self.UnsupportedFileError(path)
+                entries.append(entry)
+        return {"version": self.MANIFEST_VERSION, "entries": entries}, stored
+
+    def unpack(self, manifest, tree_dir, hardlink=False):
+        """
+        Materialise the tree described by the given manifest into the
+        (existing) tree_dir directory. Blobs are hardlinked if hardlink
+        is True and their metadata match, but for the write permissions
+        (blobs are read-only), otherwise they are copied (by reflink, if
+        possible). The hardlinks within the tree are recreated.
+
+        Raises:
+          OSError, IOError: in case of I/O errors, or missing blobs.
+        """
+        as_root = os.geteuid() == 0
+        dirs = []
+        for entry in manifest["entries"]:
+            path = os.path.join(tree_dir, entry["path"])
+            if entry["type"] == "d":
+                os.mkdir(path, 0o700)
+                dirs.append((path, entry))
+                continue
+
+            if entry["type"] == "l":
+                os.symlink(entry["target"], path)
+                if as_root:
+                    os.lchown(path, entry["uid"], entry["gid"])
+                continue
+
+            if entry["type"] == "h":
+                os.link(os.path.join(tree_dir, entry["target"]), path)
+                continue
+
+            blob_path = self.blob_path(entry["digest"])
+            if hardlink:
+                blob_st = os.lstat(blob_path)
+                if (stat.S_IMODE(blob_st.st_mode) ==
+                        entry["mode"] & ~0o222 and
+                        (not as_root or (blob_st.st_uid, blob_st.st_gid) ==
+                         (entry["uid"], entry["gid"]))):
+                    os.link(blob_path, path)
+                    continue
+            self.clone(blob_path, path)
+            if as_root:
+                os.chown(path, entry["uid"], entry["gid"])
+            os.chmod(path, entry["mode"])
+            os.utime(path, (entry["mtime"], entry["mtime"]))
+
+        # directories last, they may be read-only.
+        for path, entry in reversed(dirs):
+            if as_root:
+                os.chown(path, entry["uid"], entry["gid"])
+            os.chmod(path, entry["mode"])
+            os.utime(path, (entry["mtime"], entry["mtime"]))
+
+    def import_blobs(self, manifest, other):
+        """
+        Import the blobs of the given manifest from another
+        UbuildCasStore, hardlinking them if possible.
+
+        Raises:
+          OSError, IOError: in case of I/O errors, or missing blobs.
+        """
+        for digest in self.digests(manifest):
+            blob_path = self.blob_path(digest)
+            if os.path.lexists(blob_path):
+                continue
+            other_path = other.blob_path(digest)
+            blob_dir = os.path.dirname(blob_path)
+            try:
+                os.makedirs(blob_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            tmp_path = "%s.%d.tmp" % (blob_path, os.getpid())
+            try:
+                os.link(other_path, tmp_path)
+            except OSError:
+                self.clone(other_path, tmp_path)
+                shutil.copystat(other_path, tmp_path)
+            os.rename(tmp_path, blob_path)
+
+    @classmethod
+    def digests(cls, manifest):
+        """
+        Return the set of the blob digests referenced by a manifest.
+        """
+        return set([x["digest"] for x in manifest["entries"]
+                    if x["type"] == "f"])
+
+    @classmethod
+    def read_manifest(cls, path):
+        """
+        Read a manifest file.
+
+        Raises:
+          ValueError: if the manifest is invalid or unsupported.
+          OSError, IOError: in case of I/O errors.
+        """
+        with codecs.open(path, "r", "utf-8") as manifest_f:
+            manifest = json.load(manifest_f)
+        if manifest.get("version") not in cls._MANIFEST_VERSIONS:
+            raise ValueError("unsupported manifest version")
+        return manifest
+
+    def blobs(self):
+        """
+        Return a dict mapping the digests of the stored blobs to their
+        lstat() results.
+        """
+        blobs = {}
+        for root, _dirs, files in os.walk(self._dir):
+            for name in files:
+                if name.startswith(".") or name.endswith(".tmp"):
+                    continue
+                try:
+                    blobs[name] = os.lstat(os.path.join(root, name))
+                except OSError:
+                    pass
+        return blobs
+
+    def remove(self, digest):
+        """
+        Remove the blob of the given digest. Return True on success.
+        """
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError as err:
+            self._logger.warning(
+                "cannot remove blob %s: %s", digest, err)
+            return False
+        return True
+
+    def clean(self, age):
+        """
+        Remove the temporary files older than age seconds, left over
+        by interrupted pack() or import_blobs() calls. Return the
+        number of freed bytes.
+        """
+        freed = 0
+        now = time.time()
+        for root, _dirs, files in os.walk(self._dir):
+            for name in files:
+                if not (name.startswith(".") or name.endswith(".tmp")):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                    if now - st.st_mtime > age:
+                        os.remove(path)
+                        freed += st.st_size
+                except OSError:
+                    pass
+        return freed
+
+
+class UbuildWarmCache(object):
+    """
+    Ubuild extracted cache entries tier.
+
+    The first unpack of a tarball cache entry is copied, by reflink
+    (or copy), inside the warm directory of the cache directory, so
+    that later unpacks of the same cache entry copy the extracted tree,
+    by reflink (or copy) or, optionally, hardlink, instead of
+    decompressing the cache file. Extracted trees are stored read-only,
+    the write permissions being restored on the copies, but not on the
+    hardlinked files: writing them in place fails (unless running as
+    root) instead of corrupting the tree. The least recently used trees
+    are removed when their total size exceeds the size budget.
+    """
+
+    STORE_DIR = ".ubuild_warm"
+
+    # an extracted tree directory contains the tree, its size and the
+    # original modes of its read-only files and directories.
+    _TREE_DIR = "tree"
+    _SIZE_FILE = "size"
+    _MODES_FILE = "modes.json"
+
+    def __init__(self, cache_dir, max_size, hardlink=False):
+        """
+        Object constructor.
+
+        Args:
+          cache_dir: the cache directory containing the warm directory.
+          max_size: the size budget of the extracted trees in bytes, or
+              None.
+          hardlink: if True, files are hardlinked out of the warm
+              directory, thus read-only, instead of being copied.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._dir = os.path.join(cache_dir, self.STORE_DIR)
+        self._max_size = max_size
+        self._hardlink = hardlink
+
+    @classmethod
+    def copy_tree(cls, src, dst, hardlink=False):
+        """
+        Copy the content of the src directory into the existing dst
+        directory, preserving the file metadata. Regular files are
+        hardlinked if hardlink is True, otherwise they are copied by
+        reflink if possible, see UbuildCasStore.clone().
+
+        Returns:
+          the size of the copied regular files.
+
+        Raises:
+          OSError, IOError: in case of I/O errors.
+        """
+        def _raise(err):
+            raise err
+
+        as_root = os.geteuid() == 0
+        size = 0
+        dirs = []
+        for root, dir_names, file_names in os.walk(src, onerror=_raise):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            for name in dir_names + file_names:
+                src_path = os.path.join(root, name)
+                dst_path = os.path.normpath(os.path.join(dst_root, name))
+                st = os.lstat(src_path)
+                if stat.S_ISDIR(st.st_mode):
+                    os.mkdir(dst_path, 0o700)
+                    dirs.append((dst_path, st))
+                    continue
+
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src_path), dst_path)
+                    if as_root:
+                        os.lchown(dst_path, st.st_uid, st.st_gid)
+                    continue
+
+                if stat.S_ISREG(st.st_mode):
+                    size += st.st_size
+                    if hardlink:
+                        os.link(src_path, dst_path)
+                        continue
+                    UbuildCasStore.clone(src_path, dst_path)
+                else:
+                    os.mknod(dst_path, st.st_mode, st.st_rdev)
+                if as_root:
+                    os.chown(dst_path, st.st_uid, st.st_gid)
+                os.chmod(dst_path, stat.S_IMODE(st.st_mode))
+                os.utime(dst_path, (st.st_atime, st.st_mtime))
+
+        # directories last, they may be read-only.
+        for path, st in reversed(dirs):
+            if as_root:
+                os.chown(path, st.st_uid, st.st_gid)
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+            os.utime(path, (st.st_atime, st.st_mtime))
+        return size
+
+    @classmethod
+    def _make_read_only(cls, path):
+        """
+        Remove the write permissions of the files and directories inside
+        the given directory.
+
+        Returns:
+          a dict mapping the paths, relative to the given directory, of
+          the changed files and directories to their original mode.
+        """
+        modes = {}
+        for root, dir_names, file_names in os.walk(path, topdown=False):
+            for name in dir_names + file_names:
+                file_path = os.path.join(root, name)
+                st = os.lstat(file_path)
+                mode = stat.S_IMODE(st.st_mode)
+                if stat.S_ISLNK(st.st_mode) or not mode & 0o222:
+                    continue
+                os.chmod(file_path, mode & ~0o222)
+                modes[os.path.relpath(file_path, path)] = mode
+        return modes
+
+    def _restore_modes(self, entry_key, tree_dir):
+        """
+        Restore, inside the tree_dir copy of the extracted tree of the
+        given cache entry, the modes removed by _make_read_only(),
+        except for the hardlinked files, shared with the tree.
+        """
+        with open(os.path.join(self._dir, entry_key,
+                               self._MODES_FILE), "r") as modes_f:
+            modes = json.load(modes_f)
+        for name, mode in modes.items():
+            path = os.path.join(tree_dir, name)
+            if self._hardlink and not os.path.isdir(path):
+                continue
+            os.chmod(path, mode)
+
+    @classmethod
+    def _remove_tree(cls, path):
+        """
+        Remove the given directory tree, even if it contains read-only
+        directories.
+        """
+        for root, dirs, _files in os.walk(path):
+            for name in dirs:
+                dir_path = os.path.join(root, name)
+                if not os.path.islink(dir_path):
+                    try:
+                        os.chmod(dir_path, 0o700)
+                    except OSError:
+                        pass
+        shutil.rmtree(path, True)
+
+    def populate(self, entry_key, tree_dir):
+        """
+        Copy the extracted tree of the given cache entry into the
+        (empty) tree_dir directory.
+
+        Args:
+          entry_key: the cache entry key, see UbuildCache.entry_key().
+          tree_dir: the destination directory.
+
+        Returns:
+          True if the cache entry was extracted and copied, False
+          otherwise, in which case tree_dir is left empty.
+        """
+        path = os.path.join(self._dir, entry_key)
+        tree_path = os.path.join(path, self._TREE_DIR)
+        if not os.path.isdir(tree_path):
+            return False
+        try:
+            # the directory mtime tells the last use, see gc().
+            os.utime(path, None)
+            self.copy_tree(tree_path, tree_dir, hardlink=self._hardlink)
+            self._restore_modes(entry_key, tree_dir)
+        except (OSError, IOError, ValueError) as err:
+            self._logger.warning(
+                "cannot copy the extracted tree %s: %s", tree_path, err)
+            for name in os.listdir(tree_dir):
+                name_path = os.path.join(tree_dir, name)
+                if os.path.isdir(name_path) and not os.path.islink(
+                        name_path):
+                    self._remove_tree(name_path)
+                else:
+                    os.remove(name_path)
+            return False
+        return True
+
+    def store(self, entry_key, tree_dir):
+        """
+        Keep a read-only copy (never hardlinks, tree_dir files are then
+        used by the builds) of the given extracted cache entry tree,
+        unless already kept, then remove the least recently used
+        extracted trees exceeding the size budget. Failures are logged,
+        not raised.
+
+        Args:
+          entry_key: the cache entry key, see UbuildCache.entry_key().
+          tree_dir: the directory containing the extracted cache entry.
+        """
+        path = os.path.join(self._dir, entry_key)
+        if os.path.isdir(path):
+            return
+
+        tmp_dir = None
+        try:
+            try:
+                os.makedirs(self._dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            tmp_dir = tempfile.mkdtemp(
+                dir=self._dir, prefix=".%s." % (entry_key,))
+            tree_path = os.path.join(tmp_dir, self._TREE_DIR)
+            os.mkdir(tree_path, 0o700)
+            size = self.copy_tree(tree_dir, tree_path)
+            modes = self._make_read_only(tree_path)
+            with open(os.path.join(tmp_dir, self._MODES_FILE),
+                      "w") as modes_f:
+                json.dump(modes, modes_f)
+            with open(os.path.join(tmp_dir, self._SIZE_FILE), "w") as size_f:
+                size_f.write("%d\n" % (size,))
+            os.chmod(tmp_dir, 0o755)
+            try:
+                os.rename(tmp_dir, path)
+                tmp_dir = None
+            except OSError as err:
+                # stored by someone else meanwhile.
+                if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        except (OSError, IOError) as err:
+            self._logger.warning(
+                "cannot keep the extracted tree of %s: %s", entry_key, err)
+            return
+        finally:
+            if tmp_dir is not None:
+                self._remove_tree(tmp_dir)
+
+        self.gc(protected=(entry_key,))
+
+    def _remove(self, entry_key):
+        """
+        Remove the extracted tree of the given cache entry, moving it
+        away first so that it is never seen half removed.
+        """
+        path = os.path.join(self._dir, entry_key)
+        try:
+            doomed_dir = tempfile.mkdtemp(
+                dir=self._dir, prefix=".%s." % (entry_key,))
+        except OSError as err:
+            self._logger.warning("cannot remove %s: %s", path, err)
+            return False
+        try:
+            os.rename(path, os.path.join(doomed_dir, self._TREE_DIR))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                self._logger.warning("cannot remove %s: %s", path, err)
+            os.rmdir(doomed_dir)
+            return False
+        self._remove_tree(doomed_dir)
+        return True
+
+    def _size(self, entry_key):
+        """
+        Return the size of the extracted tree of the given cache entry.
+        """
+        try:
+            with open(os.path.join(self._dir, entry_key,
+                                   self._SIZE_FILE)) as size_f:
+                return int(size_f.read().strip())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def gc(self, entry_keys=None, age=None, protected=()):
+        """
+        Remove the extracted trees of the cache entries not in
+        entry_keys, if not None, and the least recently used ones
+        exceeding the size budget, except the protected ones. If age is
+        not None, also remove the temporary directories older than age
+        seconds, left over by interrupted store() calls.
+
+        Returns:
+          the number of freed bytes.
+        """
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return 0
+
+        freed = 0
+        now = time.time()
+        entries = []
+        for name in names:
+            path = os.path.join(self._dir, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if name.startswith("."):
+                if age is not None and now - st.st_mtime > age:
+                    self._remove_tree(path)
+                continue
+            size = self._size(name)
+            if entry_keys is not None and name not in entry_keys:
+                if name not in protected and self._remove(name):
+                    freed += size
+                continue
+            entries.append((st.st_mtime, name, size))
+
+        if self._max_size is None:
+            return freed
+        total = sum([x[2] for x in entries])
+        for _mtime, name, size in sorted(entries):
+            if total <= self._max_size:
+                break
+            if name in protected or not self._remove(name):
+                continue
+            self._logger.info(
+                "evicted the extracted tree of %s (%d bytes)", name, size)
+            total -= size
+            freed += size
+        return freed
+
+    def size(self):
+        """
+        Return the size of the extracted trees, in bytes.
+        """
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return 0
+        return sum([self._size(x) for x in names if not x.startswith(".")])
+
+
+class UbuildRemoteCache(object):
+    """
+    Ubuild remote cache tier client.
+
+    Cache files are downloaded from, and uploaded to, an HTTP server
+    (see UbuildCacheServer) by GET and PUT requests of their file name
+    relative to the remote cache URL, streaming their content. The
+    blobs referenced by the manifests of the "cas" cache backend are
+    transferred as .ubuild_cas/<2 digits>/<digest>. Uploads happen in
+    background, see wait().
+    """
+
+    # transfer size.
+    _BLOCK_SIZE = 1024 * 1024
+
+    # socket timeout, in seconds.
+    _TIMEOUT = 60.0
+
+    # the background uploads.
+    _uploads = []
+    _uploads_lock = threading.Lock()
+
+    # the errors of a request.
+    ERRORS = (IOError, OSError, ValueError, httplib.HTTPException,
+              socket.error)
+
+    def __init__(self, url, readonly=False):
+        """
+        Object constructor.
+
+        Args:
+          url: the remote cache URL, http:// or https://, optionally
+              containing the user:password@ basic authentication
+              credentials.
+          readonly: if True, cache files are never uploaded.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._url = url
+        self._readonly = readonly
+        parts = urlsplit(url)
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path.rstrip("/")
+        self._headers = {}
+        if parts.username is not None:
+            credentials = "%s:%s" % (
+                unquote(parts.username), unquote(parts.password or ""))
+            self._headers["Authorization"] = "Basic %s" % (
+                base64.b64encode(credentials.encode("utf-8")).decode(
+                    "ascii"),)
+
+    def _connect(self):
+        """
+        Return a new HTTP(S) connection to the remote cache.
+        """
+        if self._scheme == "https":
+            return httplib.HTTPSConnection(
+                self._host, self._port, timeout=self._TIMEOUT)
+        return httplib.HTTPConnection(
+            self._host, self._port, timeout=self._TIMEOUT)
+
+    def _request(self, conn, method, name, path=None):
+        """
+        Send a request for the given remote file name, with the content
+        of the file at path, if not None, as body. Return the response.
+        """
+        conn.putrequest(method, "%s/%s" % (self._path, quote(name)))
+        for key, value in self._headers.items():
+            conn.putheader(key, value)
+        if path is None:
+            if method == "PUT":
+                conn.putheader("Content-Length", "0")
+            conn.endheaders()
+            return conn.getresponse()
+
+        with open(path, "rb") as path_f:
+            conn.putheader(
+                "Content-Length", str(os.fstat(path_f.fileno()).st_size))
+            conn.endheaders()
+            data = path_f.read(self._BLOCK_SIZE)
+            while data:
+                conn.send(data)
+                data = path_f.read(self._BLOCK_SIZE)
+        return conn.getresponse()
+
+    @classmethod
+    def _mkstemp(cls, path):
+        """
+        Create a temporary file, unique across processes, next to path
+        and named so that UbuildCache.gc() removes it if left over.
+        Return a (file object, temporary file path) tuple.
+        """
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".",
+            suffix=".%s.tmp" % (os.path.basename(path),))
+        return os.fdopen(tmp_fd, "wb"), tmp_path
+
+    def _get(self, conn, name, path, digest=None, mode=0o644):
+        """
+        Download the given remote file into path, atomically. Return
+        False if it does not exist.
+
+        Args:
+          conn: the connection to use.
+          name: the remote file name.
+          path: the local file path.
+          digest: if not None, the SHA1 hex digest the downloaded file
+              must have.
+          mode: the mode of the downloaded file.
+
+        Raises:
+          one of ERRORS in case of failure.
+        """
+        resp = self._request(conn, "GET", name)
+        if resp.status == 404:
+            resp.read()
+            return False
+        if resp.status != 200:
+            resp.read()
+            raise IOError("GET %s: HTTP %d %s" % (
+                name, resp.status, resp.reason))
+
+        tmp_f, tmp_path = self._mkstemp(path)
+        try:
+            sha = hashlib.sha1()
+            with tmp_f:
+                data = resp.read(self._BLOCK_SIZE)
+                while data:
+                    tmp_f.write(data)
+                    sha.update(data)
+                    data = resp.read(self._BLOCK_SIZE)
+            if digest is not None and sha.hexdigest() != digest:
+                raise IOError("GET %s: SHA1 mismatch, got %s" % (
+                    name, sha.hexdigest()))
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, path)
+            tmp_path = None
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        return True
+
+    def _exists(self, conn, name):
+        """
+        Return whether the given remote file exists.
+        """
+        resp = self._request(conn, "HEAD", name)
+        resp.read()
+        if resp.status not in (200, 404):
+            raise IOError("HEAD %s: HTTP %d %s" % (
+                name, resp.status, resp.reason))
+        return resp.status == 200
+
+    def _put(self, conn, name, path):
+        """
+        Upload the file at path as the given remote file.
+        """
+        resp = self._request(conn, "PUT", name, path=path)
+        resp.read()
+        if resp.status not in (200, 201, 204):
+            raise IOError("PUT %s: HTTP %d %s" % (
+                name, resp.status, resp.reason))
+
+    @classmethod
+    def _blob_name(cls, digest):
+        """
+        Return the remote file name of a UbuildCasStore blob.
+        """
+        return "%s/%s/%s" % (UbuildCasStore.STORE_DIR, digest[:2], digest)
+
+    def _get_blobs(self, conn, manifest_path):
+        """
+        Download the missing blobs referenced by the given manifest.
+
+        Raises:
+          one of ERRORS in case of failure.
+        """
+        store = UbuildCasStore(os.path.dirname(manifest_path))
+        manifest = UbuildCasStore.read_manifest(manifest_path)
+        for digest in sorted(UbuildCasStore.digests(manifest)):
+            blob_path = store.blob_path(digest)
+            if os.path.lexists(blob_path):
+                continue
+            try:
+                os.makedirs(os.path.dirname(blob_path))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            if not self._get(conn, self._blob_name(digest), blob_path,
+                             digest=digest, mode=0o444):
+                raise IOError("missing blob %s" % (digest,))
+
+    def fetch(self, names, cache_dir):
+        """
+        Download the first existing remote cache file among names into
+        cache_dir, with the blobs it references, if it is a manifest.
+
+        Args:
+          names: a list of cache file names.
+          cache_dir: the local cache directory.
+
+        Returns:
+          the downloaded cache file path or None.
+        """
+        conn = self._connect()
+        try:
+            for name in names:
+                path = os.path.join(cache_dir, name)
+                if not name.endswith(UbuildCache.MANIFEST_EXTENSION):
+                    if self._get(conn, name, path):
+                        break
+                    continue
+
+                # the manifest is put in place after its blobs.
+                remote_f, remote_path = self._mkstemp(path)
+                remote_f.close()
+                try:
+                    if not self._get(conn, name, remote_path):
+                        continue
+                    self._get_blobs(conn, remote_path)
+                    os.rename(remote_path, path)
+                    remote_path = None
+                finally:
+                    if remote_path is not None:
+                        try:
+                            os.remove(remote_path)
+                        except OSError:
+                            pass
+                break
+            else:
+                return None
+        except self.ERRORS as err:
+            self._logger.warning(
+                "cannot download %s from %s: %s", name, self._url, err)
+            return None
+        finally:
+            conn.close()
+        self._logger.info("downloaded %s from %s", name, self._url)
+        return path
+
+    def _upload(self, path):
+        """
+        Upload a cache file, with the blobs it references, if it is
+        a manifest and they are missing. Return True on success.
+        """
+        name = os.path.basename(path)
+        conn = self._connect()
+        try:
+            if self._exists(conn, name):
+                return True
+            if name.endswith(UbuildCache.MANIFEST_EXTENSION):
+                store = UbuildCasStore(os.path.dirname(path))
+                manifest = UbuildCasStore.read_manifest(path)
+                for digest in sorted(UbuildCasStore.digests(manifest)):
+                    blob_name = self._blob_name(digest)
+                    if not self._exists(conn, blob_name):
+                        self._put(conn, blob_name, store.blob_path(digest))
+            self._put(conn, name, path)
+        except self.ERRORS as err:
+            self._logger.warning(
+                "cannot upload %s to %s: %s", name, self._url, err)
+            return False
+        finally:
+            conn.close()
+        self._logger.info("uploaded %s to %s", name, self._url)
+        return True
+
+    def upload(self, path):
+        """
+        Upload a cache file in background, unless read-only. See wait().
+        """
+        if self._readonly:
+            return
+        thread = threading.Thread(
+            target=self._upload, args=(path,),
+            name="upload %s" % (os.path.basename(path),))
+        thread.daemon = True
+        with self._uploads_lock:
+            self._uploads.append(thread)
+        thread.start()
+
+    @classmethod
+    def wait(cls):
+        """
+        Wait for the background uploads to complete.
+        """
+        while True:
+            with cls._uploads_lock:
+                if not cls._uploads:
+                    return
+                thread = cls._uploads.pop(0)
+            # join() with a timeout, to keep KeyboardInterrupt working.
+            while thread.is_alive():
+                thread.join(1.0)
+
+
+class UbuildFetcher(object):
+    """
+    Ubuild source tarballs downloader.
+
+    The source tarballs of the build targets are downloaded into
+    sources_dir concurrently, up to a maximum number of connections,
+    before building. Downloads are written to <tarball>.part files,
+    resumed by HTTP Range requests if interrupted, verified against the
+    checksum parameter, if set, and renamed in place. The tarball
+    UbuildFileLock, also taken by build.include, makes the processes
+    sharing sources_dir download every tarball once. Only http:// and
+    https:// URLs are downloaded, the others (git) are left to the
+    build scripts.
+    """
+
+    SCHEMES = ("http", "https")
+
+    # default maximum number of concurrent connections.
+    CONNECTIONS = 4
+
+    # transfer size.
+    _BLOCK_SIZE = 1024 * 1024
+
+    # socket timeout, in seconds.
+    _TIMEOUT = 60.0
+
+    # maximum number of HTTP redirects followed.
+    _MAX_REDIRECTS = 5
+
+    def __init__(self, connections=CONNECTIONS):
+        """
+        Object constructor.
+
+        Args:
+          connections: the maximum number of concurrent downloads.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._connections = connections
+
+    def _connect(self, parts):
+        """
+        Return a new HTTP(S) connection to the host of the given
+        urlsplit() result.
+        """
+        if parts.scheme == "https":
+            return httplib.HTTPSConnection(
+                parts.hostname, parts.port, timeout=self._TIMEOUT)
+        return httplib.HTTPConnection(
+            parts.hostname, parts.port, timeout=self._TIMEOUT)
+
+    def _download(self, url, part_path):
+        """
+        Download url into part_path, appending to the data already there
+        if the server supports Range requests.
+
+        Raises:
+          one of UbuildRemoteCache.ERRORS in case of failure.
+        """
+        redirects = 0
+        while True:
+            parts = urlsplit(url)
+            try:
+                offset = os.path.getsize(part_path)
+            except OSError:
+                offset = 0
+
+            conn = self._connect(parts)
+            try:
+                path = parts.path or "/"
+                if parts.query:
+                    path += "?" + parts.query
+                conn.putrequest("GET", path)
+                if offset:
+                    conn.putheader("Range", "bytes=%d-" % (offset,))
+                conn.endheaders()
+                resp = conn.getresponse()
+
+                location = resp.getheader("Location")
+                if resp.status in (301, 302, 303, 307, 308) and location:
+                    resp.read()
+                    redirects += 1
+                    if redirects > self._MAX_REDIRECTS:
+                        raise IOError("GET %s: too many redirects" % (
+                            url,))
+                    url = urljoin(url, location)
+                    continue
+                if resp.status == 416 and offset:
+                    # the partial download does not match the file.
+                    resp.read()
+                    os.remove(part_path)
+                    continue
+                if resp.status == 206 and offset:
+                    mode = "ab"
+                elif resp.status == 200:
+                    mode = "wb"
+                else:
+                    resp.read()
+                    raise IOError("GET %s: HTTP %d %s" % (
+                        url, resp.status, resp.reason))
+
+                length = resp.getheader("Content-Length")
+                received = 0
+                with open(part_path, mode) as part_f:
+                    data = resp.read(self._BLOCK_SIZE)
+                    while data:
+                        part_f.write(data)
+                        received += len(data)
+                        data = resp.read(self._BLOCK_SIZE)
+                if length is not None and received != int(length):
+                    raise IOError("GET %s: truncated download" % (url,))
+                return
+            finally:
+                conn.close()
+
+    def _verify(self, path, checksum, hexdigest):
+        """
+        Return whether hexdigest, the digest of the file at path, matches
+        the given (algorithm, hex digest) checksum.
+        """
+        if hexdigest == checksum[1]:
+            return True
+        self._logger.error(
+            "%s: %s checksum mismatch, expected %s, got %s",
+            path, checksum[0], checksum[1], hexdigest)
+        return False
+
+    def fetch_file(self, url, path, checksum=None):
+        """
+        Download url into path, unless it exists already, and verify it.
+
+        Args:
+          url: the tarball URL.
+          path: the tarball path, inside sources_dir.
+          checksum: the (algorithm, hex digest) tuple of the tarball,
+              or None.
+
+        Returns:
+          True on success (or if url is left to the build scripts),
+          False otherwise.
+        """
+        directory, name = os.path.split(path)
+        lock = None
+        if not os.path.isfile(path):
+            if urlsplit(url).scheme not in self.SCHEMES:
+                self._logger.debug("%s left to the build scripts", url)
+                return True
+            lock = UbuildFileLock(directory, name)
+            try:
+                lock.acquire()
+            except OSError as err:
+                self._logger.error("cannot lock %s: %s", lock.path, err)
+                return False
+
+        try:
+            if not os.path.isfile(path):
+                part_path = path + ".part"
+                start = time.time()
+                self._logger.info("downloading %s", url)
+                try:
+                    with _tracer.span(
+                            "download", "sources", {"url": url}):
+                        self._download(url, part_path)
+                    if checksum is not None and not self._verify(
+                            url, checksum, UbuildDigests.hash_file(
+                                part_path, checksum[0])):
+                        os.remove(part_path)
+                        return False
+                    os.rename(part_path, path)
+                except UbuildRemoteCache.ERRORS as err:
+                    # the partial download is resumed by the next run.
+                    self._logger.error("cannot download %s: %s", url, err)
+                    return False
+                self._logger.info(
+                    "downloaded %s (%s) in %s", url,
+                    _format_size(os.path.getsize(path)),
+                    _format_duration(time.time() - start))
+                return True
+        finally:
+            if lock is not None:
+                lock.release()
+
+        if checksum is None:
+            return True
+        try:
+            hexdigest = UbuildDigests.get(directory).digest(
+                path, checksum[0])
+        except (IOError, OSError) as err:
+            self._logger.error("cannot read %s: %s", path, err)
+            return False
+        return self._verify(path, checksum, hexdigest)
+
+    def fetch(self, downloads):
+        """
+        Download the given tarballs concurrently, see fetch_file().
+
+        Args:
+          downloads: a list of (url, path, checksum) tuples, duplicate
+              paths are downloaded once.
+
+        Returns:
+          an exit status.
+        """
+        pending = []
+        seen = set()
+        for url, path, checksum in downloads:
+            if path not in seen:
+                seen.add(path)
+                pending.append((url, path, checksum))
+        lock = threading.Lock()
+        failed = []
+
+        def _worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    url, path, checksum = pending.pop(0)
+                if not self.fetch_file(url, path, checksum=checksum):
+                    with lock:
+                        failed.append(url)
+
+        threads = []
+        for _index in range(min(self._connections, len(pending))):
+            thread = threading.Thread(target=_worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join() with a timeout, to keep KeyboardInterrupt working
+            while thread.is_alive():
+                thread.join(1.0)
+        if failed:
+            return 1
+        return 0
+
+
+class UbuildCacheServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    """
+    Ubuild remote cache reference HTTP server, serving the cache files
+    of a directory to UbuildRemoteCache: GET and HEAD download them
+    (a single byte range can be requested, to resume downloads, see
+    UbuildFetcher), PUT uploads them, atomically. Only the last
+    component of the request path (the last three for blobs) is
+    considered. There is no authentication: bind it to a trusted
+    network.
+    """
+
+    daemon_threads = True
+
+    class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """
+        UbuildCacheServer HTTP request handler.
+        """
+
+        protocol_version = "HTTP/1.1"
+
+        # a valid file name.
+        _NAME_RE = re.compile(r"^[\w+=,@-][\w.+=,@-]*$")
+
+        def log_message(self, fmt, *args):
+            logging.getLogger("ubuild.Handler").debug(
+                "%s: %s", self.address_string(), fmt % args)
+
+        def _file_path(self):
+            """
+            Return the local path of the requested cache file, or blob,
+            or None if the request path is invalid. Any path prefix is
+            ignored, the server can be mounted at any URL.
+            """
+            names = unquote(self.path.split("?", 1)[0]).split("/")
+            if len(names) > 3 and names[-3] == UbuildCasStore.STORE_DIR:
+                names = names[-2:]
+                directory = os.path.join(
+                    self.server.cache_dir, UbuildCasStore.STORE_DIR)
+            else:
+                names = names[-1:]
+                directory = self.server.cache_dir
+            for name in names:
+                if not self._NAME_RE.match(name):
+                    return None
+            return os.path.join(directory, *names)
+
+        def _reply(self, code):
+            self.send_response(code)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _get(self, body):
+            path = self._file_path()
+            if path is None:
+                self._reply(400)
+                return
+            try:
+                path_f = open(path, "rb")
+            except IOError:
+                self._reply(404)
+                return
+            with path_f:
+                size = os.fstat(path_f.fileno()).st_size
+                start, end = 0, size - 1
+                match = re.match(r"^bytes=(\d+)-(\d*)$",
+                                 self.headers.get("Range") or "")
+                if match:
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(end, int(match.group(2)))
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header(
+                            "Content-Range", "bytes */%d" % (size,))
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                        start, end, size))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                if not body:
+                    return
+                path_f.seek(start)
+                length = end - start + 1
+                while length > 0:
+                    data = path_f.read(
+                        min(length, UbuildRemoteCache._BLOCK_SIZE))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    length -= len(data)
+
+        def do_GET(self):
+            self._get(True)
+
+        def do_HEAD(self):
+            self._get(False)
+
+        def do_PUT(self):
+            path = self._file_path()
+            length = self.headers.get("Content-Length")
+            if path is None or length is None or not length.isdigit():
+                self.close_connection = True
+                self._reply(400 if path is None else 411)
+                return
+            length = int(length)
+
+            directory = os.path.dirname(path)
+            tmp_path = None
+            try:
+                try:
+                    os.makedirs(directory)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                tmp_fd, tmp_path = tempfile.mkstemp(
+                    dir=directory, prefix=".%s." % (os.path.basename(path),))
+                with os.fdopen(tmp_fd, "wb") as tmp_f:
+                    while length > 0:
+                        data = self.rfile.read(
+                            min(length, UbuildRemoteCache._BLOCK_SIZE))
+                        if not data:
+                            raise IOError("truncated upload")
+                        tmp_f.write(data)
+                        length -= len(data)
+                os.chmod(tmp_path, 0o644)
+                os.rename(tmp_path, path)
+                tmp_path = None
+            except (IOError, OSError) as err:
+                self.log_message("cannot store %s: %s", path, err)
+                self.close_connection = True
+                self._reply(500)
+                return
+            finally:
+                if tmp_path is not None:
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+            self._reply(201)
+
+    def __init__(self, address, cache_dir):
+        """
+        Object constructor.
+
+        Args:
+          address: the (host, port) tuple to listen on.
+          cache_dir: the directory containing the served cache files.
+        """
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, UbuildCacheServer.RequestHandler)
+        self.cache_dir = os.path.abspath(cache_dir)
+
+
+class UbuildCache(object):
+    """
+    Ubuild compilation cache class.
+
+    This class is responsible of maintaining the compilation
+    cache of tarballs built through Ubuild. In particular,
+    it implements:
+
+    - a lookup method to determine if the tarball is in cache.
+      The cache key is generated by taking into consideration
+      a set of elements: the tarball name, the sourced environment
+      (from the environment file) and the list of patches and
+      their checksums.
+    - a pack method that takes an image directory as input (together
+      with the parameters passed to lookup) and creates an entry in
+      the cache directory (basically, it creates a tarball there).
+    - an unpack method that takes an empty directory and a cache file
+      as input and populates it.
+
+    Cache files can be compressed using any of the supported CODECS,
+    whose file name extension tells the codec used, so that they can
+    be unpacked whatever the compression configured at the time.
+
+    With the "cas" backend, cache files are manifests of the files
+    stored in the UbuildCasStore of the cache directory, instead of
+    tarballs, see BACKENDS. Tarball cache files can also be kept
+    extracted in the UbuildWarmCache of the cache directory.
+    """
+
+    # supported compression codecs: file name extension, compressor
+    # and decompressor commands, default and maximum compression level.
+    CODECS = {
+        "xz": {
+            "extension": ".tar.xz",
+            "compress": ("xz", "-c", "-%(level)d", "-T%(threads)d"),
+            "decompress": ("xz", "-d", "-c", "-T0"),
+            "level": 6,
+            "max_level": 9,
+            },
+        "zstd": {
+            "extension": ".tar.zst",
+            "compress": ("zstd", "-c", "-q", "-%(level)d",
+                         "-T%(threads)d"),
+            "decompress": ("zstd", "-d", "-c", "-q"),
+            "level": 3,
+            "max_level": 19,
+            },
+        "none": {
+            "extension": ".tar",
+            "compress": None,
+            "decompress": None,
+            "level": 0,
+            "max_level": 0,
+            },
+        }
+
+    # xz level 6, like tar -J, but compressing blocks in parallel,
+    # one thread per CPU.
+    DEFAULT_COMPRESSION = {"codec": "xz", "level": 6, "threads": 0}
+
+    # cache backends: compressed tarballs, or manifests of the files
+    # stored in the content-addressed UbuildCasStore, unpacked by
+    # reflink (or copy) or, optionally, hardlink.
+    BACKENDS = ("tarball", "cas")
+    DEFAULT_BACKEND = {"name": "tarball", "hardlink": False}
+
+    MANIFEST_EXTENSION = ".manifest"
+
+    # names of the cache entries being produced in this process, see
+    # reserve(), promised to be produced, see promise(), and known to
+    # exist in some cache directory, see register().
+    _reserved = set()
+    _pending = set()
+    _known = {}
+    _reserved_cond = threading.Condition()
+
+    # background threads started by defer(), see wait().
+    _deferred = []
+    _deferred_lock = threading.Lock()
+
+    # cache key hash algorithms.
+    HASHES = ("sha1", "blake2b")
+
+    # age, in seconds, after which the temporary files left over by
+    # interrupted pack() calls are removed by gc().
+    _STALE_TMP_AGE = 3600
+
+    def __init__(self, seed, sources_dir, cache_dir, variables,
+                 compression=None, hash_algorithm="sha1", spec=None,
+                 backend=None, remote=None, warm=None):
+        """
+        Object constructor.
+
+        Args:
+          seed: seed string to feed the cache key hash generator with.
+          sources_dir: the directory in where source tarballs are downloaded.
+          cache_dir: the cache directory in where all the cached
+              tarballs are to be found.
+          variables: the environment variables used for cache validation.
+          compression: a dict containing the codec, level and threads
+              used to compress new cache files, DEFAULT_COMPRESSION if
+              None.
+          hash_algorithm: the cache key hash algorithm, one of HASHES.
+          spec: the path of the spec file building the cache entries,
+              recorded into the cache index.
+          backend: a dict containing the name (one of BACKENDS) and
+              hardlink keys of the backend used to pack new cache
+              entries, DEFAULT_BACKEND if None.
+          remote: a dict containing the url and readonly keys of the
+              remote cache tier (see UbuildRemoteCache), or None.
+          warm: a dict containing the max_size and hardlink keys of the
+              extracted cache entries tier (see UbuildWarmCache), or
+              None.
+        """
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._seed = seed
+        self._sources_dir = sources_dir
+        self._dir = cache_dir
+        self._vars = variables
+        self._digests = UbuildDigests.get(sources_dir)
+        self._hash_algorithm = hash_algorithm
+        if compression is None:
+            compression = self.DEFAULT_COMPRESSION
+        self._compression = compression
+        self._spec = spec
+        self._index = UbuildCacheIndex(cache_dir)
+        if backend is None:
+            backend = self.DEFAULT_BACKEND
+        self._backend = backend
+        self._store = UbuildCasStore(cache_dir)
+        self._remote = None
+        if remote is not None:
+            self._remote = UbuildRemoteCache(
+                remote["url"], readonly=remote["readonly"])
+        self._warm = None
+        if warm is not None:
+            self._warm = UbuildWarmCache(
+                cache_dir, warm["max_size"], hardlink=warm["hardlink"])
+        # the (entry name, UbuildFileLock) of the current reservation,
+        # see reserve() and defer().
+        self._reservation = None
+
+    def _file_digest(self, path):
+        """
+        Calculate the hash of given file at path, see UbuildDigests.
+
+        Args:
+          path: a file path.
+
+        Returns:
+          a hex digest.
+        """
+        return self._digests.digest(path, self._hash_algorithm)
+
+    class _Hash(object):
+        """
+        hashlib object wrapper accepting text strings as well.
+        """
+
+        def __init__(self, hash_obj):
+            self._hash = hash_obj
+
+        def update(self, data):
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            self._hash.update(data)
+
+        def hexdigest(self):
+            return self._hash.hexdigest()
+
+    def _generate_entry_name(self, tarball_names, builds, patches, environment):
+        """
+        Given a set of input information, generate a cache entry file
+        name, using the extension of the configured codec.
+        """
+        if self._hash_algorithm == "sha1":
+            sha = self._Hash(hashlib.sha1())
+        else:
+            # same entry names length of SHA1.
+            sha = self._Hash(hashlib.new(
+                self._hash_algorithm, digest_size=20))
+        sha.update(self._seed)
+        sha.update("--")
+        for args in builds:
+            sha.update("--")
+            for arg in args:
+                sha.update(arg)
+            sha.update("--")
+
+        sha.update("--")
+        for patch in patches:
+            sha.update(self._file_digest(patch))
+
+        sha.update("--")
+        for tarball in tarball_names:
+            sha.update(tarball)
+            path = os.path.join(self._sources_dir, tarball)
+            if os.path.isfile(path):
+                sha.update(self._file_digest(path))
+            else:
+                sha.update(path) # if not found, just preserve a seat
+
+        sha.update("--")
+        for k in self._vars:
+            v = environment.get(k, "")
+            sha.update("%s=%s\n" % (k, v))
+
+        sha.update("--")
+        tarball_names_str = "_".join(tarball_names)
+        if self._backend["name"] == "cas":
+            extension = self.MANIFEST_EXTENSION
+        else:
+            extension = self.CODECS[self._compression["codec"]]["extension"]
+        entry_name = "%s_%s%s" % (
+            tarball_names_str, sha.hexdigest(), extension)
+        entry_path = os.path.abspath(os.path.join(self._dir, entry_name))
+        return entry_path
+
+    def _inputs(self, tarball_names, builds, patches, environment):
+        """
+        Return a dict of the cache key inputs, for the cache index.
+        """
+        tarballs = {}
+        for tarball in tarball_names:
+            path = os.path.join(self._sources_dir, tarball)
+            tarballs[tarball] = None
+            if os.path.isfile(path):
+                tarballs[tarball] = self._file_digest(path)
+        return {
+            "hash": self._hash_algorithm,
+            "tarballs": tarballs,
+            "builds": [list(x) for x in builds],
+            "patches": dict([(x, self._file_digest(x)) for x in patches]),
+            "variables": dict(
+                [(k, environment.get(k, "")) for k in self._vars]),
+            }
+
+    @classmethod
+    def _tree_size(cls, path):
+        """
+        Return the size of the files inside the given directory.
+        """
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+    @classmethod
+    def _codec(cls, entry_path):
+        """
+        Return the name of the codec of the given cache file, or None.
+        """
+        for name, codec in cls.CODECS.items():
+            if entry_path.endswith(codec["extension"]):
+                return name
+
+    @classmethod
+    def _extensions(cls):
+        """
+        Return the list of the cache file name extensions.
+        """
+        return [x["extension"] for x in cls.CODECS.values()] + [
+            cls.MANIFEST_EXTENSION]
+
+    @classmethod
+    def entry_key(cls, entry_path):
+        """
+        Return the cache entry file name without the codec (or manifest)
+        extension, identifying the cache entry whatever the codec and
+        the backend.
+        """
+        entry_name = os.path.basename(entry_path)
+        for extension in cls._extensions():
+            if entry_name.endswith(extension):
+                return entry_name[:-len(extension)]
+        return entry_name
+
+    def _existing(self, entry_path):
+        """
+        Return the path of the cache file of the entry whose file name,
+        using the configured codec, is entry_path, if it exists in the
+        cache directory using any codec. Otherwise, return None.
+        """
+        if os.path.isfile(entry_path):
+            return entry_path
+        base_path = os.path.join(
+            os.path.dirname(entry_path), self.entry_key(entry_path))
+        for extension in self._extensions():
+            path = base_path + extension
+            if os.path.isfile(path):
+                return path
+
+    def lookup(self, tarball_names, builds, patches, environment):
+        """
+        Execute a cache lookup. Return a path to a tarball file.
+
+        Args:
+          tarball_names: list of names of the source tarballs.
+          builds: a list of build executable arguments for the target.
+          patches: list of patches to apply.
+          environment: current build environment.
+
+        Returns:
+          a valid file path.
+        """
+        entry_path = self._generate_entry_name(
+            tarball_names, builds, patches, environment)
+
+        cache_file = self._existing(entry_path)
+        if cache_file is not None:
+            self.register(cache_file)
+            return cache_file
+        cache_file = self._import(entry_path)
+        if cache_file is None:
+            cache_file = self._fetch(entry_path)
+        return cache_file
+
+    def prefetch(self, tarball_names, builds, patches, environment):
+        """
+        Look up a cache entry ahead of reserve(), so that its cache key
+        is computed and its cache file imported from another cache
+        directory or downloaded from the remote cache tier meanwhile,
+        for instance while the previous build target is unpacked.
+        Entries reserved or promised by other builders are skipped.
+
+        Args:
+          tarball_names: list of names of the source tarballs.
+          builds: a list of build executable arguments for the target.
+          patches: list of patches to apply.
+          environment: current build environment.
+
+        Returns:
+          a valid file path (as lookup()) or None.
+        """
+        entry_path = self._generate_entry_name(
+            tarball_names, builds, patches, environment)
+        entry_name = self.entry_key(entry_path)
+        with self._reserved_cond:
+            if entry_name in self._reserved or entry_name in self._pending:
+                return None
+        return self.lookup(tarball_names, builds, patches, environment)
+
+    def _fetch(self, entry_path):
+        """
+        Download the cache file of the entry whose file name is
+        entry_path from the remote cache tier, if any. Return the
+        downloaded cache file path or None.
+        """
+        if self._remote is None:
+            return None
+        extensions = self._extensions()
+        extension = entry_path[len(os.path.join(
+            os.path.dirname(entry_path), self.entry_key(entry_path))):]
+        # the configured codec first.
+        extensions.remove(extension)
+        extensions.insert(0, extension)
+        entry_name = self.entry_key(entry_path)
+        with _tracer.span("fetch", "cache", {"path": entry_path}):
+            cache_file = self._remote.fetch(
+                [entry_name + x for x in extensions],
+                os.path.dirname(entry_path))
+        if cache_file is not None:
+            self.register(cache_file)
+        return cache_file
+
+    @classmethod
+    def register(cls, entry_path):
+        """
+        Register a cache entry file as available, so that cache lookups
+        for the same entry done by other UbuildCache objects, using
+        a different cache directory, can reuse it.
+
+        Args:
+          entry_path: path to an existing cache entry file.
+        """
+        with cls._reserved_cond:
+            cls._known[cls.entry_key(entry_path)] = entry_path
+
+    @classmethod
+    def promise(cls, entry_names):
+        """
+        Promise that the given cache entries will be produced by one
+        of the builders of this process. Cache reservations of them
+        (see reserve()) wait until the promises are fulfilled.
+
+        Args:
+          entry_names: an iterable of cache entry keys, see entry_key().
+        """
+        with cls._reserved_cond:
+            cls._pending.update(entry_names)
+
+    @classmethod
+    def fulfil(cls, entry_name):
+        """
+        Fulfil (or give up) a promise made through promise().
+
+        Args:
+          entry_name: a cache entry key, see entry_key().
+        """
+        with cls._reserved_cond:
+            cls._pending.discard(entry_name)
+            cls._reserved_cond.notify_all()
+
+    def _import(self, entry_path):
+        """
+        Import a cache entry produced in another cache directory (see
+        register()) into this cache directory, hardlinking it if
+        possible. Return the imported cache file path or None.
+        """
+        with self._reserved_cond:
+            known_path = self._known.get(self.entry_key(entry_path))
+        if known_path is None or not os.path.isfile(known_path):
+            return None
+
+        # keep the codec of the known cache file.
+        entry_path = os.path.join(
+            os.path.dirname(entry_path), os.path.basename(known_path))
+        tmp_entry_path = entry_path + ".tmp"
+        try:
+            if entry_path.endswith(self.MANIFEST_EXTENSION):
+                self._store.import_blobs(
+                    UbuildCasStore.read_manifest(known_path),
+                    UbuildCasStore(os.path.dirname(known_path)))
+            try:
+                os.link(known_path, tmp_entry_path)
+            except OSError:
+                shutil.copy2(known_path, tmp_entry_path)
+            os.rename(tmp_entry_path, entry_path)
+        except (IOError, OSError, ValueError):
+            try:
+                os.remove(tmp_entry_path)
+            except OSError:
+                pass
+            return None
+        self._index.copy(
+            entry_path, UbuildCacheIndex(os.path.dirname(known_path)))
+        return entry_path
+
+    def entry_path(self, tarball_names, builds, patches, environment):
+        """
+        Return the path of the cache entry file of the given build
+        parameters: the existing cache file, whatever its codec, or the
+        path of the cache file to be created.
+
+        Args:
+          tarball_names: list of names of the source tarballs.
+          builds: a list of build executable arguments for the target.
+          patches: list of patches to apply.
+          environment: current build environment.
+
+        Returns:
+          a file path.
+        """
+        entry_path = self._generate_entry_name(
+            tarball_names, builds, patches, environment)
+        return self._existing(entry_path) or entry_path
+
+    @contextlib.contextmanager
+    def reserve(self, tarball_names, builds, patches, environment):
+        """
+        Context manager that executes a cache lookup and, in case of
+        cache miss, reserves the cache entry, so that other builders
+        of this process looking up the same entry wait for it to be
+        produced (or downloaded from the remote cache tier) rather
+        than building it again. The reservation is released on exit.
+        Entries are identified by their file name, so builders using
+        different cache directories are coordinated too: the entry
+        produced by one of them is imported into the cache directory
+        of the others. The reservation is extended to the other ubuild
+        processes sharing the cache directory through a UbuildFileLock:
+        they wait for the entry as well. The reservation can be handed
+        over to a background thread, see defer().
+
+        Args:
+          tarball_names: list of names of the source tarballs.
+          builds: a list of build executable arguments for the target.
+          patches: list of patches to apply.
+          environment: current build environment.
+
+        Returns:
+          a valid file path (as lookup()) or None if the entry has been
+          reserved and must be produced by the caller.
+        """
+        entry_path = self._generate_entry_name(
+            tarball_names, builds, patches, environment)
+        entry_name = self.entry_key(entry_path)
+
+        while True:
+            with self._reserved_cond:
+                waited = False
+                while (entry_name in self._reserved
+                       or entry_name in self._pending):
+                    waited = True
+                    # wait() with a timeout, to keep KeyboardInterrupt
+                    # working.
+                    self._reserved_cond.wait(1.0)
+                cache_file = None
+                if not waited:
+                    cache_file = self._existing(entry_path)
+                if cache_file is not None:
+                    self._known[entry_name] = cache_file
+                    break
+                if not waited and entry_name not in self._known:
+                    self._reserved.add(entry_name)
+                    cache_file = None
+                    break
+            # the entry name may have changed in the meantime, for
+            # instance because the source tarballs got downloaded,
+            # or the entry is to be imported from another cache
+            # directory. Both must happen outside the lock.
+            entry_path = self._generate_entry_name(
+                tarball_names, builds, patches, environment)
+            entry_name = self.entry_key(entry_path)
+            cache_file = self.lookup(
+                tarball_names, builds, patches, environment)
+            if cache_file is not None:
+                break
+            with self._reserved_cond:
+                if (entry_name not in self._reserved
+                        and entry_name not in self._pending):
+                    self._reserved.add(entry_name)
+                    break
+
+        if cache_file is not None:
+            yield cache_file
+            return
+
+        lock = UbuildFileLock(self._dir, entry_name)
+        self._reservation = (entry_name, lock)
+        try:
+            try:
+                lock.acquire()
+            except OSError as err:
+                self._logger.warning(
+                    "cannot lock %s, building it anyway: %s", lock.path, err)
+            # produced by another process in the meantime?
+            cache_file = self._existing(entry_path)
+            if cache_file is not None:
+                self.register(cache_file)
+            else:
+                cache_file = self._fetch(entry_path)
+            yield cache_file
+        finally:
+            reservation, self._reservation = self._reservation, None
+            if reservation is not None:
+                self._release(*reservation)
+
+    def _release(self, entry_name, lock):
+        """
+        Release the reservation of the given cache entry, see reserve().
+        """
+        lock.release()
+        with self._reserved_cond:
+            self._reserved.discard(entry_name)
+            self._reserved_cond.notify_all()
+
+    def defer(self, func, *args):
+        """
+        Call func(*args) in a background thread, see wait(). If called
+        inside reserve(), the reservation is handed over to the thread
+        and released once func returns, rather than on reserve() exit,
+        so that the other builders keep waiting for the cache entry
+        func produces, for instance through pack().
+        """
+        reservation, self._reservation = self._reservation, None
+
+        def _run():
+            try:
+                func(*args)
+            except Exception:
+                self._logger.exception(
+                    "[%s] background task of cache entry %s failed",
+                    self._seed, reservation[0] if reservation else None)
+            finally:
+                if reservation is not None:
+                    self._release(*reservation)
+
+        thread = threading.Thread(target=_run, name="defer %s" % (
+            reservation[0] if reservation else self._seed,))
+        thread.daemon = True
+        with self._deferred_lock:
+            self._deferred.append(thread)
+        thread.start()
+
+    @classmethod
+    def wait(cls):
+        """
+        Wait for the background threads started by defer() to complete.
+        """
+        while True:
+            with cls._deferred_lock:
+                if not cls._deferred:
+                    return
+                thread = cls._deferred.pop(0)
+            # join() with a timeout, to keep KeyboardInterrupt working.
+            while thread.is_alive():
+                thread.join(1.0)
+
+    def _pack_tarball(self, image_dir, entry_path):
+        """
+        Pack image_dir into the entry_path tarball. Return an exit status.
+        """
+        tmp_entry_path = entry_path + ".tmp"
+        compress = self.CODECS[self._compression["codec"]]["compress"]
+        commands = [("tar", "-c", "-p", "-f", "-", "./")]
+        if compress is not None:
+            commands.append(
+                tuple([x % self._compression for x in compress]))
+
+        with open(tmp_entry_path, "wb") as tmp_f:
+            exit_st = self._pipeline(commands, image_dir, stdout=tmp_f)
+        if exit_st == 0:
+            os.rename(tmp_entry_path, entry_path)
+        else:
+            try:
+                os.remove(tmp_entry_path)
+            except OSError:
+                pass
+        return exit_st
+
+    def _pack_cas(self, image_dir, entry_path):
+        """
+        Store the files of image_dir into the UbuildCasStore and write
+        their entry_path manifest. Return an exit status and the number
+        of bytes added to the cache directory.
+
+        Raises:
+          UbuildCasStore.UnsupportedFileError: if image_dir contains
+              files that cannot be stored.
+        """
+        tmp_entry_path = entry_path + ".tmp"
+        try:
+            manifest, stored = self._store.pack(image_dir)
+            with open(tmp_entry_path, "w") as tmp_f:
+                json.dump(manifest, tmp_f)
+            os.rename(tmp_entry_path, entry_path)
+            return 0, stored + os.path.getsize(entry_path)
+        except (OSError, IOError) as err:
+            self._logger.error("cannot store %s: %s", image_dir, err)
+            try:
+                os.remove(tmp_entry_path)
+            except OSError:
+                pass
+            return 1, 0
+
+    def pack(self, image_dir, tarball_names, builds, patches, environment,
+             build_time=None):
+        """
+        Compress the build directory into a tarball (or store it, using
+        the "cas" backend) and place it into the cache directory,
+        recording it into the cache index.
+
+        Args:
+          image_dir: the directory in where the tarball has been built.
+          tarball_names: list of names of the source tarballs.
+          builds: a list of build executable arguments for the target.
+          patches: list of patches to apply.
+          environment: current build environment.
+          build_time: the time spent building the tarball, in seconds.
+
+        Returns:
+          An exit status.
+        """
+        entry_path = self._generate_entry_name(
+            tarball_names, builds, patches, environment)
+
+        start = time.time()
+        size = None
+        with _tracer.span("pack", "cache", {"path": entry_path}):
+            exit_st = None
+            if self._backend["name"] == "cas":
+                try:
+                    exit_st, size = self._pack_cas(image_dir, entry_path)
+                except UbuildCasStore.UnsupportedFileError as err:
+                    self._logger.warning(
+                        "cannot store %s, packing a tarball instead", err)
+                    entry_path = os.path.join(
+                        os.path.dirname(entry_path),
+                        self.entry_key(entry_path) +
+                        self.CODECS[self._compression["codec"]]["extension"])
+            if exit_st is None:
+                exit_st = self._pack_tarball(image_dir, entry_path)
+
+        if exit_st == 0:
+            pack_time = time.time() - start
+            self.register(entry_path)
+            if self._remote is not None:
+                self._remote.upload(entry_path)
+            self._index.add(
+                entry_path, self._seed, self._spec,
+                self._inputs(tarball_names, builds, patches, environment),
+                self._tree_size(image_dir), build_time, pack_time,
+                size=size)
+        return exit_st
+
+    def unpack(self, unpack_dir, cache_file):
+        """
+        Unpack a cache file (returned by lookup()) into the given
+        directory, recording the cache hit into the cache index.
+        Tarball cache files are copied out of the UbuildWarmCache, if
+        enabled and kept there, otherwise they are kept there once
+        unpacked.
+
+        Args:
+          build_dir: the directory in where the tarball will be unpacked.
+          cache_file: the compressed cache file.
+
+        Returns:
+          An exit status.
+        """
+        warm = None
+        if not cache_file.endswith(self.MANIFEST_EXTENSION):
+            warm = self._warm
+
+        start = time.time()
+        with _tracer.span("unpack", "cache", {"path": cache_file}):
+            if cache_file.endswith(self.MANIFEST_EXTENSION):
+                exit_st = self._unpack_cas(unpack_dir, cache_file)
+            elif warm is not None and warm.populate(
+                    self.entry_key(cache_file), unpack_dir):
+                exit_st = 0
+                warm = None
+            else:
+                exit_st = self._unpack_tarball(unpack_dir, cache_file)
+        if exit_st != 0:
+            return exit_st
+
+        self._index.hit(
+            cache_file, self._seed, self._spec, time.time() - start)
+        if warm is not None:
+            with _tracer.span("warm", "cache", {"path": cache_file}):
+                warm.store(self.entry_key(cache_file), unpack_dir)
+        return 0
+
+    def _unpack_tarball(self, unpack_dir, cache_file):
+        """
+        Extract the given tarball cache file into unpack_dir. Return an
+        exit status.
+        """
+        codec = self._codec(cache_file)
+        if codec is None:
+            self._logger.error("unsupported cache file: %s", cache_file)
+            return 1
+
+        decompress = self.CODECS[codec]["decompress"]
+        commands = [("tar", "-x", "-f", "-")]
+        if decompress is not None:
+            commands.insert(0, decompress)
+
+        with open(cache_file, "rb") as cache_f:
+            return self._pipeline(commands, unpack_dir, stdin=cache_f)
+
+    def _unpack_cas(self, unpack_dir, manifest_path):
+        """
+        Materialise the files listed by the given manifest into
+        unpack_dir, see UbuildCasStore.unpack(). Return an exit status.
+        """
+        try:
+            manifest = UbuildCasStore.read_manifest(manifest_path)
+            self._store.unpack(
+                manifest, unpack_dir, hardlink=self._backend["hardlink"])
+        except (OSError, IOError, ValueError) as err:
+            self._logger.error("cannot unpack %s: %s", manifest_path, err)
+            return 1
+        return 0
+
+    def _files(self):
+        """
+        Return a list of (path, stat result) tuples of the cache files
+        and of the temporary files inside the cache directory.
+        """
+        extensions = tuple(
+            self._extensions() + [x + ".tmp" for x in self._extensions()])
+        files = []
+        try:
+            names = os.listdir(self._dir)
+        except OSError as err:
+            self._logger.warning("cannot list %s: %s", self._dir, err)
+            return files
+        for name in names:
+            if not name.endswith(extensions):
+                continue
+            path = os.path.join(self._dir, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append((path, st))
+        return files
+
+    def size(self):
+        """
+        Return the size of the cache files and of the blobs of the
+        UbuildCasStore, in bytes.
+        """
+        return sum([x[1].st_size for x in self._files()]) + sum(
+            [x.st_size for x in self._store.blobs().values()])
+
+    def gc(self, max_size, protected=()):
+        """
+        Collect the cache directory garbage: remove the temporary files
+        left over by interrupted pack() calls, the UbuildCasStore blobs
+        not referenced by any manifest and, if max_size is not None, the
+        least recently used cache files until their total size fits
+        max_size. The cache entries used by this process (see
+        register(), reserve() and promise()) and the protected ones are
+        never removed, neither are blobs stored or reused during the
+        last _STALE_TMP_AGE seconds, which may belong to the manifest
+        being written by a concurrent pack(). The UbuildWarmCache is
+        cleaned up as well, see UbuildWarmCache.gc().
+
+        Args:
+          max_size: the cache size budget in bytes, or None.
+          protected: an iterable of cache entry keys, see entry_key().
+
+        Returns:
+          a (removed cache files, freed bytes) tuple.
+        """
+        protected = set(protected)
+        with self._reserved_cond:
+            protected.update(self._reserved)
+            protected.update(self._pending)
+            protected.update(self._known.keys())
+
+        removed = []
+        freed = 0
+        entries = []
+        now = time.time()
+        for path, st in self._files():
+            if not path.endswith(".tmp"):
+                entries.append((path, st))
+            elif now - st.st_mtime > self._STALE_TMP_AGE:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._logger.info("removed stale cache file %s", path)
+                freed += st.st_size
+
+        freed += self._store.clean(self._STALE_TMP_AGE)
+        blobs = self._store.blobs()
+        refs = dict([(x, 0) for x in blobs.keys()])
+        manifests = {}
+        for path, _st in entries:
+            if not path.endswith(self.MANIFEST_EXTENSION):
+                continue
+            try:
+                digests = UbuildCasStore.digests(
+                    UbuildCasStore.read_manifest(path))
+            except (OSError, IOError, ValueError):
+                digests = set()
+            manifests[path] = digests
+            for digest in digests:
+                refs[digest] = refs.get(digest, 0) + 1
+
+        def _release(digests):
+            # remove the unreferenced blobs, return the freed bytes.
+            blobs_freed = 0
+            for digest in digests:
+                blob_st = blobs.get(digest)
+                if (blob_st is None or refs[digest] > 0 or
+                        now - blob_st.st_ctime <= self._STALE_TMP_AGE):
+                    continue
+                if self._store.remove(digest):
+                    del blobs[digest]
+                    blobs_freed += blob_st.st_size
+            return blobs_freed
+
+        orphans_freed = _release(list(refs.keys()))
+        freed += orphans_freed
+        size = sum([x[1].st_size for x in entries]) + sum(
+            [x.st_size for x in blobs.values()])
+        if max_size is not None and size > max_size:
+            last_access = self._index.last_access()
+            entries.sort(key=lambda x: last_access.get(
+                self.entry_key(x[0]), x[1].st_mtime))
+            for path, st in entries:
+                if size <= max_size:
+                    break
+                key = self.entry_key(path)
+                if key in protected:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as err:
+                    self._logger.warning("cannot remove %s: %s", path, err)
+                    continue
+                entry_freed = st.st_size
+                digests = manifests.get(path, ())
+                for digest in digests:
+                    refs[digest] -= 1
+                entry_freed += _release(digests)
+                self._logger.info(
+                    "evicted cache file %s (%d bytes)", path, entry_freed)
+                removed.append(key)
+                size -= entry_freed
+                freed += entry_freed
+            if size > max_size:
+                self._logger.warning(
+                    "cache directory %s is %d bytes, over its %d bytes "
+                    "budget, because of the cache files in use",
+                    self._dir, size, max_size)
+
+        # drop the records, and the extracted trees, of the cache files
+        # removed by anyone.
+        keys = self._index.last_access().keys()
+        existing = set([self.entry_key(x[0]) for x in self._files()])
+        stale = [x for x in keys if x not in existing]
+        if stale:
+            self._index.remove(stale)
+        warm = self._warm
+        if warm is None:
+            warm = UbuildWarmCache(self._dir, None)
+        freed += warm.gc(
+            entry_keys=existing, age=self._STALE_TMP_AGE, protected=protected)
+        return len(removed), freed
+
+    def _pipeline(self, commands, cwd, stdin=None, stdout=None):
+        """
+        Execute a pipeline of commands.
+
+        Args:
+          commands: a list of command arguments.
+          cwd: the working directory of the commands.
+          stdin: file object to read the pipeline input from.
+          stdout: file object to write the pipeline output to.
+
+        Returns:
+          An exit status, the first non zero one of the pipeline.
+        """
+        procs = []
+        try:
+            for index, args in enumerate(commands):
+                proc_stdout = subprocess.PIPE
+                if index == len(commands) - 1:
+                    proc_stdout = stdout
+                proc_stdin = stdin
+                if procs:
+                    proc_stdin = procs[-1].stdout
+                procs.append(subprocess.Popen(
+                    args, cwd=cwd, stdin=proc_stdin, stdout=proc_stdout))
+                if len(procs) > 1:
+                    # only the next process must hold the pipe open.
+                    procs[-2].stdout.close()
+        except OSError as err:
+            self._logger.error(
+                "cannot execute %s: %s", " ".join(args), err)
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            return 1
+
+        exit_st = 0
+        for proc in procs:
+            proc_st = proc.wait()
+            if exit_st == 0:
+                exit_st = proc_st
+        return exit_st
+
+
+class UbuildJobServer(object):
+    """
+    GNU make jobserver shared across all the build targets.
+
+    The jobserver is a pipe filled with one token per job. Every make
+    process started by the build scripts (through bmake) gets the
+    jobserver file descriptors via the UBUILD_MAKEFLAGS environment
+    variable and must acquire a token from the pipe before starting a
+    job other than the first one. The token for the first job is the
+    one acquired by Ubuild on behalf of each target while it's being
+    built. This way, the total number of jobs stays constant,
+    regardless of how many targets are built concurrently.
+    """
+
+    def __init__(self, jobs):
+        """
+        Object constructor.
+
+        Args:
+          jobs: the total number of jobs.
+        """
+        self._jobs = jobs
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            if hasattr(os, "set_inheritable"):
+                os.set_inheritable(fd, True)
+        os.write(self._write_fd, b"+" * jobs)
+
+    def jobs(self):
+        """
+        Return the total number of jobs.
+        """
+        return self._jobs
+
+    def makeflags(self):
+        """
+        Return the MAKEFLAGS string that makes make use this jobserver.
+        """
+        return "-j --jobserver-fds=%d,%d" % (self._read_fd, self._write_fd)
+
+    def popen_kwargs(self):
+        """
+        Return the subprocess.Popen keyword arguments required to pass
+        the jobserver file descriptors to child processes.
+        """
+        if sys.version_info[0] >= 3:
+            return {"pass_fds": (self._read_fd, self._write_fd)}
+        return {"close_fds": False}
+
+    @contextlib.contextmanager
+    def token(self):
+        """
+        Context manager that acquires a job token, blocking until one is
+        available, and releases it on exit.
+        """
+        token = b""
+        while not token:
+            try:
+                token = os.read(self._read_fd, 1)
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
+        try:
+            yield
+        finally:
+            os.write(self._write_fd, token)
+
+    def close(self):
+        """
+        Close the jobserver file descriptors.
+        """
+        for fd in (self._read_fd, self._write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class UbuildSampler(object):
+    """
+    Ubuild process tree resource usage sampler.
+
+    A thread periodically walks the process tree rooted at the given
+    pid through /proc and keeps track of the peak resident memory of
+    the whole tree and of the bytes read from and written to storage.
+    CPU time is accounted precisely by the caller through the rusage
+    of the reaped process, see collect().
+    """
+
+    _PROC_DIR = "/proc"
+
+    def __init__(self, pid, interval):
+        """
+        Object constructor.
+
+        Args:
+          pid: the root process id.
+          interval: the sampling interval, in seconds. Sampling is
+              disabled if interval is not positive or /proc is not
+              available.
+        """
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._peak_rss = 0
+        self._read_bytes = 0
+        self._write_bytes = 0
+        try:
+            self._page_size = os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            self._page_size = 4096
+
+    def start(self):
+        """
+        Start sampling.
+        """
+        proc_dir = os.path.join(self._PROC_DIR, str(self._pid))
+        if self._interval <= 0 or not os.path.isdir(proc_dir):
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        """
+        Sampling thread body.
+        """
+        while True:
+            self.sample()
+            if self._stop.wait(self._interval):
+                break
+
+    @classmethod
+    def _read(cls, pid, name):
+        """
+        Return the content of /proc/<pid>/<name> or None.
+        """
+        try:
+            with open(os.path.join(cls._PROC_DIR, pid, name), "r") as proc_f:
+                return proc_f.read()
+        except (OSError, IOError):
+            return None
+
+    def _tree(self):
+        """
+        Return the list of pids (as strings) of the process tree.
+        """
+        children = {}
+        try:
+            pids = [x for x in os.listdir(self._PROC_DIR) if x.isdigit()]
+        except OSError:
+            return []
+        for pid in pids:
+            stat = self._read(pid, "stat")
+            if not stat:
+                continue
+            # the process name may contain spaces and parentheses.
+            fields = stat[stat.rfind(")") + 2:].split()
+            if len(fields) > 1:
+                children.setdefault(fields[1], []).append(pid)
+
+        tree = [str(self._pid)]
+        index = 0
+        while index < len(tree):
+            tree.extend(children.get(tree[index], []))
+            index += 1
+        return tree
+
+    def sample(self):
+        """
+        Take a sample of the resource usage of the process tree.
+        """
+        rss = 0
+        read_bytes = 0
+        write_bytes = 0
+        for pid in self._tree():
+            statm = self._read(pid, "statm")
+            if statm:
+                try:
+                    rss += int(statm.split()[1]) * self._page_size
+                except (IndexError, ValueError):
+                    pass
+            # /proc/<pid>/io includes the processes already reaped by
+            # pid, while live children are accounted separately.
+            for line in (self._read(pid, "io") or "").splitlines():
+                key, _sep, value = line.partition(":")
+                if key == "read_bytes":
+                    read_bytes += int(value)
+                elif key == "write_bytes":
+                    write_bytes += int(value)
+
+        self._peak_rss = max(self._peak_rss, rss)
+        self._read_bytes = max(self._read_bytes, read_bytes)
+        self._write_bytes = max(self._write_bytes, write_bytes)
+
+    def collect(self, rusage):
+        """
+        Return the resource usage of the process tree.
+
+        Args:
+          rusage: the resource usage of the reaped root process, as
+              returned by os.wait4().
+
+        Returns:
+          a dict containing the user and system CPU time, in seconds,
+          the maximum resident memory of a single process ("max_rss")
+          and, if sampled, the peak resident memory of the whole tree
+          ("peak_rss") and the bytes read and written, in bytes.
+        """
+        usage = {
+            "user": rusage.ru_utime,
+            "sys": rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss * 1024,
+            }
+        if self._thread is not None:
+            # short lived processes may have been missed by sampling.
+            usage["peak_rss"] = max(self._peak_rss, usage["max_rss"])
+            usage["read_bytes"] = self._read_bytes
+            usage["write_bytes"] = self._write_bytes
+        return usage
+
+    @classmethod
+    def add(cls, total, usage):
+        """
+        Add the usage dict returned by collect() to total.
+        """
+        for key, value in usage.items():
+            if key in ("max_rss", "peak_rss"):
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+    @classmethod
+    def summary(cls, usage):
+        """
+        Return a human readable summary of a usage dict.
+        """
+        mib = 1024.0 * 1024.0
+        items = ["user %.1fs" % (usage["user"],),
+                 "sys %.1fs" % (usage["sys"],)]
+        rss = usage.get("peak_rss", usage["max_rss"])
+        items.append("peak rss %.1f MiB" % (rss / mib,))
+        if "read_bytes" in usage:
+            items.append("read %.1f MiB" % (usage["read_bytes"] / mib,))
+            items.append(
+                "written %.1f MiB" % (usage["write_bytes"] / mib,))
+        return ", ".join(items)
+
+
+class UbuildScheduler(object):
+    """
+    Ubuild build targets scheduler.
+
+    Targets are built following the dependency graph declared through
+    the "depends" parameter. Targets without dependencies declared are
+    considered dependent on the previous target, so that the build
+    order defined in the .spec file is retained. Up to workers targets
+    whose dependencies have been built are run concurrently.
+
+    When running more than one worker (or if requested), the output of
+    each build target is collected into a log file that is written to
+    stdout, in the .spec file order, once the target is complete. The
+    records logged by the thread building a target (cache hits and
+    misses, packing and unpacking, ...) go into the same log file,
+    interleaved with the build output as they happen.
+    """
+
+    class _LogCapture(logging.Filter):
+        """
+        Logger filter diverting the records logged by a thread to the
+        build log file it has been assigned, see capture(). Records
+        are formatted by the handler they would have been emitted by.
+        """
 
-        sha.update("--")
-        for k in self._vars:
-            v = environment.get(k, "")
-            sha.update("%s=%s\n" % (k, v))
+        def __init__(self):
+            logging.Filter.__init__(self)
+            self._local = threading.local()
 
-        sha.update("--")
-        tarball_names_str = "_".join(tarball_names)
-        entry_name = "%s_%s.tar.xz" % (tarball_names_str, sha.hexdigest(),)
-        entry_path = os.path.abspath(os.path.join(self._dir, entry_name))
-        return entry_path
+        @contextlib.contextmanager
+        def capture(self, log_f):
+            """
+            Divert the records logged by the calling thread to the
+            given log file object while in the context.
+            """
+            self._local.log_f = log_f
+            try:
+                yield
+            finally:
+                self._local.log_f = None
+
+        def filter(self, record):
+            log_f = getattr(self._local, "log_f", None)
+            if log_f is None:
+                return True
+
+            handler = None
+            logger = logging.getLogger(record.name)
+            while logger is not None:
+                if logger.handlers:
+                    handler = logger.handlers[0]
+                    break
+                if not logger.propagate:
+                    break
+                logger = logger.parent
+            if handler is None:
+                # like logging.lastResort.
+                handler = logging.StreamHandler()
+                handler.setLevel(logging.WARNING)
+
+            if record.levelno >= handler.level:
+                msg = handler.format(record) + "\n"
+                if not isinstance(msg, bytes):
+                    msg = msg.encode("utf-8", "replace")
+                # the build scripts write to the same file descriptor,
+                # bypass the file object buffering.
+                os.write(log_f.fileno(), msg)
+            return False
 
-    def lookup(self, tarball_names, builds, patches, environment):
+    _log_capture = _LogCapture()
+    _LOGGERS = ("ubuild.Handler", "ubuild.SpecParser")
+
+    def __init__(self, spec, targets, workers, buffer_logs=False):
         """
-        Execute a cache lookup. Return a path to a tarball file.
+        Object constructor.
 
         Args:
-          tarball_names: list of names of the source tarballs.
-          builds: a list of build executable arguments for the target.
-          patches: list of patches to apply.
-          environment: current build environment.
-
-        Returns:
-          a valid file path.
+          spec: a SpecParser object.
+          targets: ordered list of build targets.
+          workers: maximum number of targets to build concurrently.
+          buffer_logs: if True, the build output is collected even
+              when running a single worker.
         """
-        entry_path = self._generate_entry_name(
-            tarball_names, builds, patches, environment)
-
-        if os.path.isfile(entry_path):
-            return entry_path
-
-    def pack(self, image_dir, tarball_names, builds, patches, environment):
+        self._logger = logging.getLogger("ubuild.Handler")
+        self._spec = spec
+        self._targets = targets
+        self._workers = workers
+        self._buffer_logs = buffer_logs
+        self._depends = {}
+        for index, target in enumerate(targets):
+            depends = spec.target_depends(target)
+            if depends is None:
+                depends = targets[max(index - 1, 0):index]
+            self._depends[target] = [x for x in depends if x in targets]
+
+    def run(self, build_func):
         """
-        Compress the build directory into a tarball and place it
-        into the cache directory.
+        Build all the targets.
+
+        Once a build fails, no more targets are started, the ones
+        already running are waited for.
 
         Args:
-          image_dir: the directory in where the tarball has been built.
-          tarball_names: list of names of the source tarballs.
-          builds: a list of build executable arguments for the target.
-          patches: list of patches to apply.
-          environment: current build environment.
+          build_func: a function accepting a target name and a file
+              object (or None) to write the build output to and
+              returning an exit status.
 
         Returns:
-          An exit status.
+          an exit status.
         """
-        entry_path = self._generate_entry_name(
-            tarball_names, builds, patches, environment)
+        if self._workers < 2 and not self._buffer_logs:
+            for target in self._targets:
+                exit_st = build_func(target, None)
+                if exit_st != 0:
+                    return exit_st
+            return 0
 
-        tmp_entry_path = entry_path + ".tmp"
-        args = ("tar", "-c", "-J", "-p", "-f", tmp_entry_path, "./")
-        exit_st = subprocess.call(args, cwd=image_dir)
-        if exit_st == 0:
-            os.rename(tmp_entry_path, entry_path)
+        for name in self._LOGGERS:
+            logging.getLogger(name).addFilter(self._log_capture)
+
+        cond = threading.Condition()
+        status = {}
+        logs = {}
+        running = set()
+
+        def _worker(target):
+            exit_st = 1
+            try:
+                with self._log_capture.capture(logs[target]):
+                    try:
+                        exit_st = build_func(target, logs[target])
+                    except Exception:
+                        self._logger.exception(
+                            "[%s] unhandled error building %s",
+                            self._spec.path(), target)
+            finally:
+                with cond:
+                    running.discard(target)
+                    status[target] = exit_st
+                    cond.notify_all()
+
+        exit_st = 0
+        flushed = 0
+        try:
+            with cond:
+                while True:
+                    if exit_st == 0:
+                        for target in self._targets:
+                            if len(running) >= self._workers:
+                                break
+                            if target in status or target in running:
+                                continue
+                            if not all(status.get(x) == 0
+                                       for x in self._depends[target]):
+                                continue
+                            logs[target] = tempfile.TemporaryFile(
+                                dir=self._spec.build_dir(),
+                                prefix=".ubuild_log.")
+                            running.add(target)
+                            thread = threading.Thread(
+                                target=_worker, args=(target,),
+                                name="%s %s" % (
+                                    os.path.basename(self._spec.path()),
+                                    target))
+                            thread.daemon = True
+                            thread.start()
+
+                    # flush the logs of completed targets, in order
+                    while flushed < len(self._targets):
+                        target = self._targets[flushed]
+                        if target not in status:
+                            break
+                        self._flush_log(logs.pop(target))
+                        flushed += 1
+
+                    for target in self._targets:
+                        if status.get(target, 0) != 0:
+                            exit_st = status[target]
+                            break
+                    if not running:
+                        break
+                    # wait() with a timeout, to keep KeyboardInterrupt working
+                    cond.wait(1.0)
+        finally:
+            for target in self._targets:
+                log_f = logs.pop(target, None)
+                if log_f is not None and target not in running:
+                    self._flush_log(log_f)
+
+        if exit_st == 0 and len(status) != len(self._targets):
+            self._logger.error(
+                "[%s] cannot schedule targets: %s",
+                self._spec.path(),
+                ", ".join([x for x in self._targets if x not in status]))
+            exit_st = 1
         return exit_st
 
-    def unpack(self, unpack_dir, cache_file):
+    def critical_path(self, durations):
         """
-        Unpack a cache file (returned by lookup()) into the given directory.
+        Return the duration of the longest chain of dependent targets,
+        that is, the minimum time needed to build all the targets with
+        an unlimited number of workers.
 
         Args:
-          build_dir: the directory in where the tarball will be unpacked.
-          cache_file: the compressed cache file.
+          durations: a dict mapping targets to their build duration,
+              targets missing from it are considered instantaneous.
 
         Returns:
-          An exit status.
+          a duration.
         """
-        exit_st = subprocess.call(
-            ("tar", "-x", "-J", "-f", cache_file),
-            cwd=unpack_dir)
-        return exit_st
+        finish = {}
+        for target in self._targets:
+            start = max([finish[x] for x in self._depends[target]] or [0])
+            finish[target] = start + durations.get(target, 0)
+        return max(list(finish.values()) or [0])
+
+    @classmethod
+    def _flush_log(cls, log_f):
+        """
+        Write the content of the given build log file object to
+        stdout and close it.
+        """
+        try:
+            log_f.seek(0)
+            sys.stdout.flush()
+            stdout = getattr(sys.stdout, "buffer", sys.stdout)
+            shutil.copyfileobj(log_f, stdout)
+            sys.stdout.flush()
+        finally:
+            log_f.close()
 
 
 class Ubuild(object):
@@ -935,18 +5023,69 @@ class Ubuild(object):
     else:
         logging.basicConfig()
 
-    def __init__(self, spec, files):
+    # file inside build_dir recording the build targets completed there.
+    _STATE_FILE = ".ubuild_state.json"
+
+    # environments of the environment files sourced by this process,
+    # see _env_source().
+    _env_sourced = {}
+    _env_sourced_lock = threading.Lock()
+    # guards the cross_builds dicts, see _build_shared_cross().
+    _cross_builds_lock = threading.Lock()
+
+    def __init__(self, spec, files, jobserver=None, buffer_logs=False,
+                 promises=None, resume=False, sample_interval=1.0,
+                 cross_builds=None):
         """
         Ubuild constructor.
 
         Args:
           spec: a SpecParser object.
           files: a list of file paths that have been used to generate spec.
+          jobserver: a UbuildJobServer object shared with other Ubuild
+              instances. If None, one is created if the jobs parameter
+              is set.
+          buffer_logs: if True, the output of each build target is
+              collected and written to stdout once the target is
+              complete, even when targets are built one at a time.
+          promises: a dict mapping build targets to the cache entry
+              names promised (see UbuildCache.promise()) to other
+              Ubuild instances, fulfilled once the targets are built.
+          resume: if True, build_dir is not cleaned and the build
+              targets completed there by a previous run, with the same
+              cache key, are skipped.
+          sample_interval: the resource usage sampling interval of the
+              build scripts, in seconds, see UbuildSampler.
+          cross_builds: a dict shared by the Ubuild instances building
+              the variants of a matrix spec, through which they build
+              their shared cross targets once, see _build_shared_cross().
         """
         self._logger = logging.getLogger("ubuild.Handler")
         self._spec = spec
         self._files = files
         self._spec_name = ", ".join(self._files)
+        if spec.variant() is not None:
+            self._spec_name += " [%s]" % (spec.variant(),)
+        self._jobserver = jobserver
+        self._buffer_logs = buffer_logs
+        self._promises = dict(promises or {})
+        self._resume = resume
+        self._sample_interval = sample_interval
+        if cross_builds is None:
+            cross_builds = {}
+        self._cross_builds = cross_builds
+        self._state = {}
+        self._state_lock = threading.Lock()
+        # the cache entries protected from the automatic cache garbage
+        # collection, see _build_image().
+        self._referenced_entries = None
+        # the targets being built by _build_targets() and their base
+        # environment, and the lookups of the targets started ahead,
+        # see _prefetch().
+        self._lookahead = None
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        self._report = {"steps": {}, "resources": {}, "targets": {}}
 
     def _cacher(self, target):
         """
@@ -964,11 +5103,24 @@ class Ubuild(object):
 
         target_cache_vars = self._spec.target_cache_vars(target)
         ubuild_cache_vars = self._spec.cache_vars()
-        cache_vars = sorted((set(ubuild_cache_vars) | set(target_cache_vars)))
+        cache_vars = set(ubuild_cache_vars) | set(target_cache_vars)
+        if target.startswith("cross="):
+            # cross toolchains embed build_dir (their sysroot) and are
+            # not relocatable: they can only be shared by specs using
+            # the same build_dir.
+            cache_vars.add("UBUILD_BUILD_DIR")
+        cache_vars = sorted(cache_vars)
         sources_dir = self._spec.sources_dir()
-        return UbuildCache(target, sources_dir, cache_dir, cache_vars)
-
-    def _setup_environment(self, base_env):
+        return UbuildCache(
+            target, sources_dir, cache_dir, cache_vars,
+            compression=self._spec.cache_compression(),
+            hash_algorithm=self._spec.cache_hash(),
+            spec=self._spec.path(),
+            backend=self._spec.cache_backend(),
+            remote=self._spec.cache_remote(),
+            warm=self._spec.cache_warm())
+
+    def _setup_environment(self, base_env, cross=False):
         """
         Generate a base environment for child processes.
         The generated environment will inherit the given
@@ -976,11 +5128,14 @@ class Ubuild(object):
 
         Args:
           base_env: the base environment.
+          cross: if True, the environment is meant for the cross
+              targets, built into SpecParser.cross_build_dir().
         """
         env = base_env.copy()
         env_keys = (
             ("UBUILD_SPEC_PATH", "path"),
             ("UBUILD_BUILD_DIR", "build_dir"),
+            ("UBUILD_CROSS_BUILD_DIR", "cross_build_dir"),
             ("UBUILD_COMPILE_DIR", "compile_dir"),
             ("UBUILD_INITRAMFS_ROOTFS_DIR", "initramfs_rootfs_dir"),
             ("UBUILD_ROOTFS_DIR", "rootfs_dir"),
@@ -1000,168 +5155,723 @@ class Ubuild(object):
                 self._logger.warning(
                     "%s won't be set, becuse %s is unset",
                     env_var, env_meta)
+        if cross:
+            env["UBUILD_BUILD_DIR"] = env["UBUILD_CROSS_BUILD_DIR"]
+
+        for env_var, value in sorted(self._spec.variables().items()):
+            env[env_var] = value
+        if self._spec.variant() is not None:
+            env["UBUILD_VARIANT"] = self._spec.variant()
+
+        if self._jobserver is not None:
+            env["UBUILD_JOBS"] = str(self._jobserver.jobs())
+            env["UBUILD_MAKEFLAGS"] = self._jobserver.makeflags()
         return env
 
-    def _env_source(self, env_file):
+    def _spawn(self, args, env, cwd, log_file, usage):
+        """
+        Execute a build script, passing the jobserver to it, if any.
+
+        Args:
+          args: the script arguments.
+          env: the script environment.
+          cwd: the script working directory.
+          log_file: file object where to write the script output to,
+              if None, stdout and stderr are inherited.
+          usage: dict updated with the resource usage of the script
+              process tree, see UbuildSampler.
+
+        Returns:
+          an exit status.
+        """
+        kwargs = {}
+        if self._jobserver is not None:
+            kwargs.update(self._jobserver.popen_kwargs())
+        with _tracer.span(
+                os.path.basename(args[0]), "script", {"args": list(args)}):
+            proc = subprocess.Popen(
+                args, env=env, cwd=cwd, stdout=log_file, stderr=log_file,
+                **kwargs)
+            sampler = UbuildSampler(proc.pid, self._sample_interval)
+            sampler.start()
+            try:
+                while True:
+                    try:
+                        _pid, status, rusage = os.wait4(proc.pid, 0)
+                        break
+                    except OSError as err:
+                        if err.errno != errno.EINTR:
+                            raise
+            finally:
+                sampler.stop()
+
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        usage.clear()
+        usage.update(sampler.collect(rusage))
+        return proc.returncode
+
+    @contextlib.contextmanager
+    def _job_token(self):
+        """
+        Context manager that holds a jobserver token, if a jobserver
+        is in use.
+        """
+        if self._jobserver is None:
+            yield
+        else:
+            with self._jobserver.token():
+                yield
+
+    @classmethod
+    def _env_key(cls, env_file, env):
+        """
+        Return the key of the environment file sourced in the given
+        environment, see _env_source().
+        """
+        with open(env_file, "rb") as env_f:
+            digest = hashlib.sha1(env_f.read()).hexdigest()
+        return (os.path.abspath(env_file), digest,
+                tuple(sorted(env.items())))
+
+    def _env_source(self, env_files):
+        """
+        Source the environment files, each one in a separate shell
+        environment, and build the dicts containing the environment
+        variables set by them. Environment files are sourced once per
+        process, for a given content and input environment: those not
+        sourced yet are sourced together, by a single shell.
+        Return None if an environment file cannot be sourced.
+
+        Args:
+          env_files: the environment files to source.
+
+        Returns:
+          a list of environment dicts, one per environment file.
+        """
+        env_sourcer = os.path.abspath(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            "core", "env_sourcer.sh"))
+        assert os.path.isfile(env_sourcer), "%s not found" % (env_sourcer,)
+
+        env_env = self._setup_environment({})
+        keys = []
+        missing = []
+        for env_file in env_files:
+            try:
+                key = self._env_key(env_file, env_env)
+            except (OSError, IOError) as err:
+                self._logger.error(
+                    "[%s] cannot read env file: %s: %s",
+                    self._spec_name, env_file, err)
+                return None
+            with self._env_sourced_lock:
+                if key not in self._env_sourced and key not in keys:
+                    missing.append((key, env_file))
+            keys.append(key)
+
+        if missing:
+            args = [env_sourcer] + [x[1] for x in missing]
+            self._logger.info(
+                "[%s] sourcing: %s", self._spec_name, " ".join(args[1:]))
+            with _tracer.span(
+                    ", ".join([os.path.basename(x) for x in args[1:]]),
+                    "env", {"paths": args[1:]}):
+                proc = subprocess.Popen(
+                    args, stdout=subprocess.PIPE, env=env_env)
+                output = proc.communicate()[0]
+            exit_st = proc.returncode
+
+            if not isinstance(output, str):
+                # same decoding of os.environ.
+                output = output.decode(
+                    sys.getfilesystemencoding(), "surrogateescape")
+
+            # NUL-delimited variables, an empty record ending the
+            # environment of each file.
+            envs = []
+            env = {}
+            for record in output.split("\0")[:-1]:
+                if not record:
+                    envs.append(env)
+                    env = {}
+                    continue
+                var, sep, value = record.partition("=")
+                if sep:
+                    env[var] = value
+
+            with self._env_sourced_lock:
+                for (key, _env_file), env in zip(missing, envs):
+                    self._env_sourced[key] = env
+            if exit_st != 0 or len(envs) != len(missing):
+                self._logger.error(
+                    "[%s] error sourcing env file: %s, exit status: %d",
+                    self._spec_name,
+                    missing[min(len(envs), len(missing) - 1)][1], exit_st)
+                return None
+
+        with self._env_sourced_lock:
+            return [dict(self._env_sourced[x]) for x in keys]
+
+    @classmethod
+    @contextlib.contextmanager
+    def _timed(cls, steps, name):
+        """
+        Context manager that adds the time spent inside it, in seconds,
+        to the steps dict item called name.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            steps[name] = steps.get(name, 0.0) + time.time() - start
+
+    def _target_steps(self, target):
+        """
+        Return the dict of the timed steps of a target build report.
+        """
+        return self._report["targets"][target]["steps"]
+
+    def _report_path(self):
+        """
+        Return the path of the JSON build report file.
+        """
+        return os.path.join(
+            self._spec.destination_dir(),
+            "%s.report.json" % (self._spec.image_name(),))
+
+    def history(self):
+        """
+        Return the build duration history of the targets, read from the
+        last build report.
+
+        Returns:
+          a dict mapping build targets to dicts mapping their outcome
+          ("built", "cached") to the duration of the last build that
+          had such outcome, in seconds.
+        """
+        path = self._report_path()
+        try:
+            with open(path, "r") as report_f:
+                history = json.load(report_f).get("history", {})
+        except (OSError, IOError, ValueError, AttributeError):
+            return {}
+        if not isinstance(history, dict):
+            return {}
+        return history
+
+    def _write_report(self):
+        """
+        Write the build report to the path returned by _report_path().
+        """
+        history = self.history()
+        for target, record in self._report["targets"].items():
+            result = record.get("result")
+            if record.get("exit_status") == 0 and result in (
+                    "built", "cached"):
+                history.setdefault(target, {})[result] = record["duration"]
+        self._report["history"] = history
+
+        path = self._report_path()
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as report_f:
+                json.dump(self._report, report_f, indent=2, sort_keys=True)
+            os.rename(tmp_path, path)
+        except (OSError, IOError):
+            self._logger.exception("cannot write build report %s", path)
+            return
+        self._logger.info(
+            "[%s] build report written to %s", self._spec_name, path)
+
+    @classmethod
+    def _read_timings(cls, path):
+        """
+        Read the build phases timings file written by the build scripts
+        (see main() in build.include). Each line is:
+        <phase> <start time> <end time> <exit status>
+
+        Returns:
+          a list of (phase, start time, end time) tuples.
+        """
+        timings = []
+        with open(path, "r") as timings_f:
+            for line in timings_f:
+                try:
+                    phase, start, end, _exit_st = line.split()
+                    timings.append((phase, float(start), float(end)))
+                except ValueError:
+                    continue
+        return timings
+
+    def _pre_post_build(self, args, env, log_file=None, usage=None,
+                        cross=False):
+        """
+        Execute a {cross_,}{pre,post}_build script, if any is set.
+
+        Args:
+          args: {cross_,}pre_build script arguments or None.
+          log_file: file object where to write the script output to,
+              if None, stdout and stderr are inherited.
+          usage: dict to add the script resource usage to, if not None.
+          cross: True for the cross_{pre,post} scripts and those of the
+              cross targets, see _setup_environment().
+
+        Returns:
+          an exit status.
+        """
+        if not args:
+            return 0
+
+        self._logger.info(
+            "[%s] spawning: %s",
+            self._spec_name,
+            " ".join(args)
+            )
+
+        script_dir = os.path.dirname(args[0])
+        env = self._setup_environment(env, cross=cross)
+        script_usage = {}
+        exit_st = self._spawn(args, env, script_dir, log_file, script_usage)
+        if usage is not None:
+            UbuildSampler.add(usage, script_usage)
+
+        log_func = self._logger.info
+        if exit_st != 0:
+            log_func = self._logger.error
+        log_func(
+            "[%s] exit status: %d (%s)",
+            self._spec_name,
+            exit_st,
+            UbuildSampler.summary(script_usage)
+            )
+        return exit_st
+
+    def _setup(self):
+        """
+        Setup build_dir and initializes other build directories.
+        """
+        build_dir = self._spec.build_dir()
+        if self._resume:
+            self._state = self._load_state()
+            self._logger.info(
+                "[%s] resuming build in build_dir %s, %d targets completed",
+                self._spec_name, build_dir, len(self._state))
+            return 0
+
+        self._state = {}
+        return self._clean_build_dir(build_dir)
+
+    def _clean_build_dir(self, build_dir):
+        """
+        Remove the content of the given build_dir.
+
+        Returns:
+          an exit status.
+        """
+        if os.path.isdir(build_dir):
+            self._logger.info(
+                "[%s] cleaning build_dir %s",
+                self._spec_name, build_dir)
+            try:
+                dir_cont = os.listdir(build_dir)
+            except OSError:
+                self._logger.exception("cannot list build_dir content")
+                return 1
+
+            for sub in dir_cont:
+                path = os.path.join(build_dir, sub)
+                shutil.rmtree(path, True)
+        return 0
+
+    def _load_state(self):
+        """
+        Load the build targets state saved in build_dir by _save_state().
+
+        Returns:
+          a dict mapping build targets to their state.
+        """
+        path = os.path.join(self._spec.build_dir(), self._STATE_FILE)
+        try:
+            with open(path, "r") as state_f:
+                state = json.load(state_f)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self._logger.warning(
+                    "[%s] cannot read %s: %s", self._spec_name, path, err)
+            return {}
+        except ValueError as err:
+            self._logger.warning(
+                "[%s] invalid %s, ignoring: %s", self._spec_name, path, err)
+            return {}
+
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+    def _save_state(self):
+        """
+        Save the build targets state into build_dir. Must be called with
+        the state lock held.
+        """
+        path = os.path.join(self._spec.build_dir(), self._STATE_FILE)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as state_f:
+                json.dump(self._state, state_f, indent=2, sort_keys=True)
+            os.rename(tmp_path, path)
+        except (OSError, IOError):
+            # only --resume is affected.
+            self._logger.exception("cannot write %s", path)
+
+    def _set_target_state(self, target, key, outputs):
+        """
+        Record the state of a build target.
+
+        Args:
+          target: the build target name.
+          key: the cache entry name of the completed build target,
+              or None if the target is not complete.
+          outputs: a list of the build_dir entries built by the target.
+        """
+        with self._state_lock:
+            if key is None:
+                self._state.pop(target, None)
+            else:
+                self._state[target] = {
+                    "key": key,
+                    "outputs": sorted(outputs),
+                    }
+            self._save_state()
+
+    def _target_build_dir(self, target):
+        """
+        Return the build_dir of the given target, see
+        SpecParser.cross_build_dir().
+        """
+        if target.startswith("cross="):
+            return self._spec.cross_build_dir()
+        return self._spec.build_dir()
+
+    def _completed(self, target, key):
+        """
+        Return True if the build target, whose cache entry name is key,
+        has been completed by a previous run and its outputs are still
+        in build_dir.
+        """
+        with self._state_lock:
+            state = self._state.get(target)
+        if not isinstance(state, dict) or state.get("key") != key:
+            return False
+        outputs = state.get("outputs")
+        if not outputs:
+            return False
+
+        build_dir = self._target_build_dir(target)
+        for name in outputs:
+            if not os.path.lexists(os.path.join(build_dir, name)):
+                return False
+        return True
+
+    def _discard_target(self, target):
+        """
+        Forget the state of a build target and remove its outputs
+        left in build_dir by a previous run, if any.
+        """
+        with self._state_lock:
+            state = self._state.get(target)
+        if not isinstance(state, dict):
+            return
+
+        build_dir = self._target_build_dir(target)
+        for name in state.get("outputs", []):
+            path = os.path.join(build_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, True)
+            elif os.path.lexists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._set_target_state(target, None, None)
+
+    @classmethod
+    def _merge_tree(cls, src, dst):
+        """
+        Move src to dst, merging it into dst if both are directories.
+        """
+        if not os.path.lexists(dst):
+            os.rename(src, dst)
+            return
+
+        src_dir = os.path.isdir(src) and not os.path.islink(src)
+        dst_dir = os.path.isdir(dst) and not os.path.islink(dst)
+        if src_dir and dst_dir:
+            for name in os.listdir(src):
+                cls._merge_tree(
+                    os.path.join(src, name), os.path.join(dst, name))
+            return
+
+        if dst_dir:
+            shutil.rmtree(dst)
+        else:
+            os.remove(dst)
+        os.rename(src, dst)
+
+    def _unpack(self, target, cacher, cache_file, outputs):
         """
-        Source the environment file and build a dict containing
-        the environment variables set by it.
-        Return None if environment file cannot be sourced.
+        Unpack the cache file of a target into its build_dir.
 
         Args:
-          env_file: the environment file to source.
+          target: the build target name.
+          cacher: the UbuildCache object of the target.
+          cache_file: the cache file returned by UbuildCache.lookup().
+          outputs: list where the names of the unpacked build_dir
+              entries are appended to.
 
         Returns:
-          an environment dict.
+          an exit status.
         """
-        env_sourcer = os.path.abspath(os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            "core", "env_sourcer.sh"))
-        assert os.path.isfile(env_sourcer), "%s not found" % (env_sourcer,)
-
         self._logger.info(
-            "[%s] sourcing: %s", self._spec_name, env_file)
-        args = (env_sourcer, env_file)
-        tmp_fd, tmp_path = None, None
+            "[%s] Build of %s cached to %s",
+            self._spec_name, target, cache_file)
+        build_dir = self._target_build_dir(target)
 
+        unpack_dir = None
         try:
-            tmp_fd, tmp_path = tempfile.mkstemp(
-                dir=self._spec.build_dir(),
-                prefix="ubuild._source")
+            # unpack into a staging directory first, in order to know
+            # what the cache file contains.
+            unpack_dir = tempfile.mkdtemp(
+                dir=build_dir, prefix=".ubuild_unpack.")
 
-            env_dir = os.path.dirname(env_file)
-            env_env = self._setup_environment({})
-            exit_st = subprocess.call(
-                args, stdout=tmp_fd, env=env_env, cwd=env_dir)
+            with self._timed(self._target_steps(target), "unpack"):
+                exit_st = cacher.unpack(unpack_dir, cache_file)
             if exit_st != 0:
                 self._logger.error(
-                    "[%s] error sourcing env file: %s, exit status: %d",
-                    self._spec_name, env_file, exit_st)
-                return None
+                    "[%s] unpack of %s failed with exit status: %d",
+                    self._spec_name, cache_file, exit_st)
+                return exit_st
 
-            # this way buffers are flushed out
-            os.close(tmp_fd)
-            tmp_fd = None
-            env = {}
+            for name in os.listdir(unpack_dir):
+                self._merge_tree(
+                    os.path.join(unpack_dir, name),
+                    os.path.join(build_dir, name))
+                outputs.append(name)
+
+        except (OSError, IOError):
+            self._logger.exception(
+                "[%s] cannot unpack %s into build_dir",
+                self._spec_name, cache_file)
+            return 1
 
-            with open(tmp_path, "r") as tmp_r:
-                line = tmp_r.readline()
+        finally:
+            if unpack_dir is not None:
+                shutil.rmtree(unpack_dir, True)
 
-                while line:
-                    params = line.rstrip().split("=", 1)
-                    if len(params) == 2:
-                        var, value = params
-                        env[var] = value
-                    line = tmp_r.readline()
+        return 0
 
-            return env
+    def _pack(self, target, env, metadata, cacher, image_dir, protected):
+        """
+        Pack the outcome of a target into the cache, then remove
+        image_dir. Called in background, see _compile().
 
+        Args:
+          target: the build target name.
+          env: the build environment.
+          metadata: the build target metadata.
+          cacher: the UbuildCache object of the target.
+          image_dir: the directory containing the outcome.
+          protected: the cache entry keys that the cache garbage
+              collection must not evict, see _referenced().
+        """
+        record = self._report["targets"][target]
+        tarball_names = [x[1] for x in metadata.get("url", [])]
+        try:
+            with self._timed(record["steps"], "pack"):
+                exit_st = cacher.pack(
+                    image_dir, tarball_names, metadata["build"],
+                    metadata.get("patch", []), env,
+                    build_time=record["steps"].get("build"))
+            if exit_st != 0:
+                self._logger.error(
+                    "[%s] pack of %s failed with exit status: %d",
+                    self._spec_name, target, exit_st)
+                # ignore failure.
+
+            max_size = self._spec.cache_max_size()
+            if max_size is not None and cacher.size() > max_size:
+                with self._timed(record["steps"], "gc"):
+                    cacher.gc(max_size, protected=protected)
         finally:
-            if tmp_fd is not None:
-                try:
-                    os.close(tmp_fd)
-                except OSError:
-                    pass
-            if tmp_path is not None:
-                try:
-                    os.remove(tmp_path)
-                except OSError as err:
-                    if err.errno != errno.ENOENT:
-                        raise
+            shutil.rmtree(image_dir, True)
 
-    def _pre_post_build(self, args, env):
+    def _compile(self, target, env, metadata, cacher, log_file,
+                 outputs=None):
         """
-        Execute a {cross_,}{pre,post}_build script, if any is set.
+        Run the build scripts of a target and pack their outcome
+        into the cache, if cacher is not None. Packing happens in
+        background, see UbuildCache.defer(), so that the next targets
+        are built meanwhile.
 
         Args:
-          args: {cross_,}pre_build script arguments or None.
+          target: the build target name.
+          env: the build environment.
+          metadata: the build target metadata.
+          cacher: the UbuildCache object of the target, or None.
+          log_file: file object where to write the build output to,
+              if None, stdout and stderr are inherited.
+          outputs: list where the names of the build_dir entries built
+              by the target are appended to, if cacher is not None.
 
         Returns:
           an exit status.
         """
-        if not args:
-            return 0
+        scripts = metadata["build"]
+        build_dir = self._target_build_dir(target)
+        record = self._report["targets"][target]
 
-        self._logger.info(
-            "[%s] spawning: %s",
-            self._spec_name,
-            " ".join(args)
-            )
+        image_dir = None
+        timings_file = None
+        try:
+            try:
+                image_dir = tempfile.mkdtemp(
+                    dir=build_dir, prefix=".ubuild_image.")
+                timings_fd, timings_file = tempfile.mkstemp(
+                    dir=build_dir, prefix=".ubuild_timings.")
+                os.close(timings_fd)
+            except (OSError, IOError):
+                self._logger.exception(
+                    "cannot create image_dir inside build_dir")
+                return 1
 
-        script_dir = os.path.dirname(args[0])
-        env = self._setup_environment(env)
-        exit_st = subprocess.call(args, env=env, cwd=script_dir)
+            self._logger.debug("Setting UBUILD_IMAGE_DIR=%s", image_dir)
+            env["UBUILD_IMAGE_DIR"] = image_dir
+            self._logger.debug(
+                "Setting UBUILD_TIMINGS_FILE=%s", timings_file)
+            env["UBUILD_TIMINGS_FILE"] = timings_file
 
-        log_func = self._logger.info
-        if exit_st != 0:
-            log_func = self._logger.error
-        log_func(
-            "[%s] exit status: %d",
-            self._spec_name,
-            exit_st
-            )
-        return exit_st
+            with self._job_token():
+                for args in scripts:
+                    script = args[0]
+                    script_dir = os.path.dirname(script)
+                    script_usage = {}
+                    with self._timed(record["steps"], "build"):
+                        exit_st = self._spawn(
+                            args, env, script_dir, log_file, script_usage)
+                    UbuildSampler.add(
+                        record.setdefault("resources", {}), script_usage)
+                    try:
+                        timings = self._read_timings(timings_file)
+                        # start over with the next build script.
+                        open(timings_file, "w").close()
+                    except (OSError, IOError):
+                        self._logger.exception(
+                            "cannot read %s", timings_file)
+                        timings = []
 
-    def _setup(self):
+                    phases = record.setdefault("phases", {})
+                    for phase, start, end in timings:
+                        phases[phase] = phases.get(phase, 0.0) + end - start
+                        _tracer.add(phase, "phase", start, end)
+
+                    log_func = self._logger.info
+                    if exit_st != 0:
+                        log_func = self._logger.error
+                    log_func("[%s] %s exit status: %d (%s)",
+                             self._spec_name, script,
+                             exit_st, UbuildSampler.summary(script_usage))
+                    if exit_st != 0:
+                        return exit_st
+
+            if cacher:
+
+                # ensure that the build script has moved the content
+                # to UBUILD_IMAGE_DIR.
+                try:
+                    content = os.listdir(image_dir)
+                except (OSError, IOError):
+                    self._logger.exception(
+                        "Cannot get content of %s", image_dir)
+                    content = None
+                if not content:
+                    self._logger.error(
+                        "[%s] %s built files have not been "
+                        "moved to UBUILD_IMAGE_DIR, scripts: %s",
+                        self._spec_name, target,
+                        ", ".join([x[0] for x in scripts]))
+                    return 1
+                if outputs is not None:
+                    outputs.extend(content)
+
+                cacher.defer(
+                    self._pack, target, dict(env), metadata, cacher,
+                    image_dir, self._referenced_entries or ())
+                image_dir = None
+
+        finally:
+            if image_dir is not None:
+                shutil.rmtree(image_dir, True)
+            if timings_file is not None:
+                try:
+                    os.remove(timings_file)
+                except OSError:
+                    pass
+
+        return 0
+
+    def _source_env_files(self, env, env_files, what):
         """
-        Setup build_dir and initializes other build directories.
+        Source the given environment files and update env with the
+        environment variables set by them.
+
+        Args:
+          env: the environment dict to update.
+          env_files: a list of environment files.
+          what: description of the environment files, for logging.
+
+        Returns:
+          True if all the environment files have been sourced,
+          False otherwise.
         """
-        build_dir = self._spec.build_dir()
-        if os.path.isdir(build_dir):
+        for env_f in env_files:
             self._logger.info(
-                "[%s] cleaning build_dir %s",
-                self._spec_name, build_dir)
-            try:
-                dir_cont = os.listdir(build_dir)
-            except OSError:
-                self._logger.exception("cannot list build_dir content")
-                return 1
-
-            for sub in dir_cont:
-                path = os.path.join(build_dir, sub)
-                shutil.rmtree(path, True)
-        return 0
+                "[%s] reading %s: %s",
+                self._spec_name, what, env_f)
+        file_envs = self._env_source(env_files)
+        if file_envs is None:
+            self._logger.error(
+                "[%s] cannot source %s files: %s",
+                self._spec_name, what, ", ".join(env_files))
+            return False
+        for file_env in file_envs:
+            env.update(file_env)
+        return True
 
-    def _build(self, target, base_env, metadata):
+    def _target_environment(self, target, base_env, metadata):
         """
-        Build a single target.
+        Generate the build environment of a single target.
+        Return None if the target environment files cannot be sourced.
 
         Args:
           target: the build target name.
+          base_env: the base environment of the target.
           metadata: the build target metadata.
 
         Returns:
-           an exit status.
+          an environment dict.
         """
         env = base_env.copy()
-        env_fs = metadata.get("env", [])
-        for env_f in env_fs:
-            self._logger.info(
-                "[%s] reading package env: %s",
-                self._spec_name, env_f)
-            file_env = self._env_source(env_f)
-            if file_env is None:
-                self._logger.error(
-                    "[%s] cannot source env file: %s",
-                    self._spec_name, env_f)
-                return 1
-            env.update(file_env)
+        if not self._source_env_files(
+                env, metadata.get("env", []), "package env"):
+            return None
 
-        scripts = metadata["build"]
         urls = metadata.get("url", [])
         patches = metadata.get("patch", [])
-        build_dir = self._spec.build_dir()
-
-        self._logger.info(
-            "[%s] building...", self._spec_name)
-        for url, rename in urls:
-            self._logger.info("  URL: %s -> %s", url, rename)
-        for args in scripts:
-            self._logger.info("  build script: %s", " ".join(args))
-        for patch in patches:
-            self._logger.info("  patch: %s", patch)
 
-        env = self._setup_environment(env)
+        env = self._setup_environment(
+            env, cross=target.startswith("cross="))
 
         patches_str = " ".join(patches)
         if patches_str:
@@ -1180,224 +5890,800 @@ class Ubuild(object):
         self._logger.debug(
             "Setting UBUILD_SOURCES='%s'", target_sources_dir)
         env["UBUILD_SOURCES"] = target_sources_dir
+        return env
+
+    def _prefetch(self, target):
+        """
+        Start looking up, in a background thread, the cache entry of
+        the build target following the given one, unless it has been
+        started already, see UbuildCache.prefetch(). Called while the
+        given target is unpacked, the next target waits for the lookup
+        in _build().
+        """
+        with self._prefetch_lock:
+            if self._lookahead is None:
+                return
+            targets, base_env = self._lookahead
+            index = targets.index(target) + 1
+            if index >= len(targets):
+                return
+            next_target = targets[index]
+            if (next_target in self._prefetched
+                    or next_target in self._report["targets"]):
+                return
+
+            thread = threading.Thread(
+                target=self._prefetch_target, args=(next_target, base_env),
+                name="prefetch %s" % (next_target,))
+            thread.daemon = True
+            self._prefetched[next_target] = thread
+        thread.start()
+
+    def _prefetch_target(self, target, base_env):
+        """
+        Look up the cache entry of a build target, see _prefetch().
+        """
+        metadata = self._spec[target]
+        try:
+            env = self._target_environment(target, base_env, metadata)
+            cacher = self._cacher(target)
+            if env is None or cacher is None:
+                return
+            with _tracer.span("prefetch", "cache", {"target": target}):
+                cacher.prefetch(
+                    [x[1] for x in metadata.get("url", [])],
+                    metadata["build"], metadata.get("patch", []), env)
+        except Exception:
+            # the lookup is done again by _build().
+            self._logger.exception(
+                "[%s] cannot look up %s ahead", self._spec_name, target)
+
+    def _wait_prefetch(self, target=None):
+        """
+        Wait for the lookup of the given build target started by
+        _prefetch(), if any, or for all of them if target is None.
+        """
+        with self._prefetch_lock:
+            if target is None:
+                threads = list(self._prefetched.values())
+                self._prefetched.clear()
+            else:
+                threads = [x for x in [self._prefetched.pop(target, None)]
+                           if x is not None]
+        for thread in threads:
+            # join() with a timeout, to keep KeyboardInterrupt working.
+            while thread.is_alive():
+                thread.join(1.0)
+
+    def _build(self, target, base_env, metadata, log_file=None):
+        """
+        Build a single target.
+
+        Args:
+          target: the build target name.
+          metadata: the build target metadata.
+          log_file: file object where to write the build output to,
+              if None, stdout and stderr are inherited.
+
+        Returns:
+           an exit status.
+        """
+        record = self._report["targets"][target]
+        steps = record["steps"]
+        with self._timed(steps, "env"):
+            env = self._target_environment(target, base_env, metadata)
+        if env is None:
+            return 1
+
+        scripts = metadata["build"]
+        urls = metadata.get("url", [])
+        patches = metadata.get("patch", [])
+
+        self._logger.info(
+            "[%s] building %s...", self._spec_name, target)
+        for url, rename in urls:
+            self._logger.info("  URL: %s -> %s", url, rename)
+        for args in scripts:
+            self._logger.info("  build script: %s", " ".join(args))
+        for patch in patches:
+            self._logger.info("  patch: %s", patch)
 
         pre = metadata.get("pre", [])
         for args in pre:
-            exit_st = self._pre_post_build(args, env)
+            with self._timed(steps, "pre"):
+                exit_st = self._pre_post_build(
+                    args, env, log_file=log_file,
+                    usage=record.setdefault("resources", {}),
+                    cross=target.startswith("cross="))
             if exit_st != 0:
                 return exit_st
 
         tarball_names = [x[1] for x in urls]
         cacher = self._cacher(target)
-        cache_file = None
-        if cacher:
-            cache_file = cacher.lookup(
-                tarball_names, scripts,
-                patches, env)
-
-        if cache_file:
+        promise = self._promises.pop(target, None)
+        if promise is not None:
+            UbuildCache.fulfil(promise)
+
+        if cacher is None:
+            self._discard_target(target)
+            record["result"] = "built"
+            exit_st = self._compile(target, env, metadata, None, log_file)
+
+        elif self._resume and self._completed(
+                target, UbuildCache.entry_key(cacher.entry_path(
+                    tarball_names, scripts, patches, env))):
             self._logger.info(
-                "[%s] Build of %s cached to %s",
-                self._spec_name, target, cache_file)
-            exit_st = cacher.unpack(build_dir, cache_file)
+                "[%s] %s already built in build_dir, skipping",
+                self._spec_name, target)
+            record["result"] = "skipped"
+            exit_st = 0
+
+        else:
+            self._discard_target(target)
+            outputs = []
+            lookup_start = time.time()
+            self._wait_prefetch(target)
+            with cacher.reserve(
+                    tarball_names, scripts, patches, env) as cache_file:
+                # includes the time spent waiting for other builders.
+                lookup_end = time.time()
+                steps["lookup"] = lookup_end - lookup_start
+                _tracer.add("lookup", "cache", lookup_start, lookup_end)
+                if cache_file:
+                    record["result"] = "cached"
+                    # look the next target up meanwhile.
+                    self._prefetch(target)
+                    exit_st = self._unpack(
+                        target, cacher, cache_file, outputs)
+                else:
+                    record["result"] = "built"
+                    exit_st = self._compile(
+                        target, env, metadata, cacher, log_file,
+                        outputs=outputs)
+                    # the source tarballs may have been downloaded.
+                    cache_file = cacher.entry_path(
+                        tarball_names, scripts, patches, env)
+            if exit_st == 0:
+                self._set_target_state(
+                    target, UbuildCache.entry_key(cache_file), outputs)
+
+        if exit_st != 0:
+            return exit_st
+
+        post = metadata.get("post", [])
+        for args in post:
+            with self._timed(steps, "post"):
+                exit_st = self._pre_post_build(
+                    args, env, log_file=log_file,
+                    usage=record.setdefault("resources", {}),
+                    cross=target.startswith("cross="))
             if exit_st != 0:
-                self._logger.error(
-                    "[%s] unpack of %s failed with exit status: %d",
-                    self._spec_name, cache_file, exit_st)
                 return exit_st
 
-        else:
+        self._logger.info("")
 
-            image_dir = None
-            try:
-                try:
-                    image_dir = tempfile.mkdtemp(
-                        dir=build_dir, prefix=".ubuild_image.")
-                except (OSError, IOError):
-                    self._logger.exception(
-                        "cannot create image_dir inside build_dir")
-                    return 1
+        return 0
 
-                self._logger.debug("Setting UBUILD_IMAGE_DIR=%s", image_dir)
-                env["UBUILD_IMAGE_DIR"] = image_dir
+    def _build_targets(self, targets, base_env):
+        """
+        Build the given targets through UbuildScheduler.
 
-                for args in scripts:
-                    script = args[0]
-                    script_dir = os.path.dirname(script)
-                    exit_st = subprocess.call(
-                        args, env=env, cwd=script_dir)
+        Args:
+          targets: ordered list of build targets.
+          base_env: the base environment of the targets.
 
-                    log_func = self._logger.info
-                    if exit_st != 0:
-                        log_func = self._logger.error
-                    log_func("[%s] %s exit status: %d",
-                             self._spec_name, script,
-                             exit_st)
-                    if exit_st != 0:
-                        return exit_st
+        Returns:
+          an exit status.
+        """
+        def _build_func(target, log_file):
+            record = {"steps": {}}
+            self._report["targets"][target] = record
+            start = time.time()
+            exit_st = 1
+            try:
+                exit_st = self._build(
+                    target, base_env, self._spec[target], log_file=log_file)
+                return exit_st
+            finally:
+                end = time.time()
+                record["duration"] = end - start
+                record["exit_status"] = exit_st
+                _tracer.add(target, "target", start, end, {
+                    "spec": self._files,
+                    "result": record.get("result"),
+                    "exit_status": exit_st,
+                    })
+
+        scheduler = UbuildScheduler(
+            self._spec, targets, self._spec.parallel_targets(),
+            buffer_logs=self._buffer_logs)
+        with self._prefetch_lock:
+            self._lookahead = (list(targets), base_env)
+        try:
+            return scheduler.run(_build_func)
+        finally:
+            with self._prefetch_lock:
+                self._lookahead = None
+            # lookups of targets not built because of a failure.
+            self._wait_prefetch()
 
-                if cacher:
+    def build(self):
+        """
+        Build an image using the provided build information.
 
-                    # ensure that the build script has moved the content
-                    # to UBUILD_IMAGE_DIR.
-                    try:
-                        content = os.listdir(image_dir)
-                    except (OSError, IOError):
-                        self._logger.exception(
-                            "Cannot get content of %s", image_dir)
-                        content = None
-                    if not content:
-                        self._logger.error(
-                            "[%s] %s built files have not been "
-                            "moved to UBUILD_IMAGE_DIR, scripts: %s",
-                            self._spec_name, target,
-                            ", ".join([x[0] for x in scripts]))
-                        return 1
-
-                    exit_st = cacher.pack(
-                        image_dir, tarball_names, scripts, patches, env)
-                    if exit_st != 0:
-                        self._logger.error(
-                            "[%s] pack of %s failed with exit status: %d",
-                            self._spec_name, target, exit_st)
-                        # ignore failure.
+        Args:
+          parser: a SpecParser object containing instructions on what to build.
+
+        Return:
+          an exit status.
+        """
+        start = time.time()
+        self._report = {
+            "spec": self._files,
+            "image": self._spec.image_name(),
+            "resume": self._resume,
+            "started": start,
+            "steps": {},
+            "resources": {},
+            "targets": {},
+            }
+        exit_st = 1
+        try:
+            jobs = self._spec.jobs()
+            if jobs is None or self._jobserver is not None:
+                exit_st = self._build_image()
+                return exit_st
 
+            self._logger.info(
+                "[%s] using a jobserver with %d jobs", self._spec_name, jobs)
+            self._jobserver = UbuildJobServer(jobs)
+            try:
+                exit_st = self._build_image()
+                return exit_st
             finally:
-                if image_dir is not None:
-                    shutil.rmtree(image_dir, True)
+                self._jobserver.close()
+                self._jobserver = None
+        finally:
+            # let other builders waiting for them go ahead.
+            for promise in self._promises.values():
+                UbuildCache.fulfil(promise)
+            self._promises.clear()
+            # packs first, they upload their cache files.
+            UbuildCache.wait()
+            UbuildRemoteCache.wait()
+            UbuildDigests.save_all()
+
+            self._report["duration"] = time.time() - start
+            self._report["exit_status"] = exit_st
+            self._write_report()
+
+    def plan(self):
+        """
+        Compute the cache entry of every build target, without
+        building anything.
 
-        post = metadata.get("post", [])
-        for args in post:
-            exit_st = self._pre_post_build(args, env)
+        Returns:
+          a list of (target, cache entry path, cached) tuples, in build
+          order, or None if the environment files cannot be sourced.
+          Targets whose cache is disabled are not listed.
+        """
+        metadata = self._spec.ubuild()
+        env = os.environ.copy()
+        phases = (
+            (self._spec.cross_targets(), "cross_env"),
+            (self._spec.pkg_targets(), "env"),
+            )
+
+        plan = []
+        for targets, env_param in phases:
+            if not self._source_env_files(
+                    env, metadata.get(env_param, []), env_param):
+                return None
+
+            for target in targets:
+                data = self._spec[target]
+                target_env = self._target_environment(target, env, data)
+                if target_env is None:
+                    return None
+                cacher = self._cacher(target)
+                if cacher is None:
+                    continue
+                entry_path = cacher.entry_path(
+                    [x[1] for x in data.get("url", [])], data["build"],
+                    data.get("patch", []), target_env)
+                plan.append((target, entry_path, os.path.isfile(entry_path)))
+        return plan
+
+    def _referenced(self):
+        """
+        Return the set of the cache entry keys of the build targets,
+        which must not be evicted from the cache, see UbuildCache.gc().
+        """
+        plan = self.plan() or []
+        return set([UbuildCache.entry_key(x[1]) for x in plan])
+
+    def _build_cross(self, cross_env):
+        """
+        Build the cross targets, running the cross_pre and cross_post
+        scripts, see _build_image().
+
+        Args:
+          cross_env: the base environment of the cross targets.
+
+        Return:
+          an exit status.
+        """
+        steps = self._report["steps"]
+        resources = self._report["resources"]
+        metadata = self._spec.ubuild()
+
+        cross_pre = metadata.get("cross_pre", [])
+        for args in cross_pre:
+            with self._timed(steps, "cross_pre"):
+                exit_st = self._pre_post_build(
+                    args, cross_env,
+                    usage=resources.setdefault("cross_pre", {}),
+                    cross=True)
+            if exit_st != 0:
+                return exit_st
+
+        with self._timed(steps, "cross_targets"):
+            exit_st = self._build_targets(
+                self._spec.cross_targets(), cross_env)
+        if exit_st != 0:
+            return exit_st
+
+        cross_post = metadata.get("cross_post", [])
+        for args in cross_post:
+            with self._timed(steps, "cross_post"):
+                exit_st = self._pre_post_build(
+                    args, cross_env,
+                    usage=resources.setdefault("cross_post", {}),
+                    cross=True)
             if exit_st != 0:
                 return exit_st
 
-        self._logger.info("")
-
         return 0
 
-    def build(self):
+    def _build_shared_cross(self, cross_env):
         """
-        Build an image using the provided build information.
+        Build the cross targets into the build_dir shared with the
+        other variants of a matrix spec (see SpecParser.variants()),
+        unless one of them has already built them.
 
         Args:
-          parser: a SpecParser object containing instructions on what to build.
+          cross_env: the base environment of the cross targets.
+
+        Return:
+          an exit status.
+        """
+        cross_build_dir = self._spec.cross_build_dir()
+        with self._cross_builds_lock:
+            shared = self._cross_builds.setdefault(
+                cross_build_dir, [threading.Lock(), None])
+
+        with shared[0]:
+            if shared[1] is not None:
+                self._logger.info(
+                    "[%s] cross targets built into %s by another variant, "
+                    "exit status: %d",
+                    self._spec_name, cross_build_dir, shared[1])
+                return shared[1]
+
+            exit_st = 0
+            if not self._resume:
+                exit_st = self._clean_build_dir(cross_build_dir)
+            if exit_st == 0:
+                exit_st = self._build_cross(cross_env)
+            shared[1] = exit_st
+        return exit_st
+
+    def _build_image(self):
+        """
+        Build an image, see build().
 
         Return:
           an exit status.
         """
-        exit_st = self._setup()
+        steps = self._report["steps"]
+        resources = self._report["resources"]
+        with self._timed(steps, "setup"):
+            exit_st = self._setup()
         if exit_st != 0:
             return exit_st
 
         metadata = self._spec.ubuild()
         base_env = os.environ.copy()
 
-        env_fs = metadata.get("cross_env", [])
         cross_env = base_env
-        for env_f in env_fs:
-            self._logger.info(
-                "[%s] reading cross_env: %s",
-                self._spec_name, env_f)
-            file_env = self._env_source(env_f)
-            if file_env is None:
-                self._logger.error(
-                    "[%s] cannot source env file: %s",
-                    self._spec_name, env_f)
+        with self._timed(steps, "cross_env"):
+            if not self._source_env_files(
+                    cross_env, metadata.get("cross_env", []), "cross_env"):
                 return 1
-            cross_env.update(file_env)
-
-        cross_pre = metadata.get("cross_pre", [])
-        for args in cross_pre:
-            exit_st = self._pre_post_build(args, cross_env)
-            if exit_st != 0:
-                return exit_st
 
-        cross_targets = self._spec.cross_targets()
-        for target in cross_targets:
-            data = self._spec[target]
-            exit_st = self._build(target, cross_env, data)
-            if exit_st != 0:
-                return exit_st
+        if self._spec.cache_max_size() is not None:
+            # computed once, before the targets are scheduled, rather
+            # than by the background pack threads.
+            self._referenced_entries = self._referenced()
 
-        cross_post = metadata.get("cross_post", [])
-        for args in cross_post:
-            exit_st = self._pre_post_build(args, cross_env)
-            if exit_st != 0:
-                return exit_st
+        if self._spec.cross_build_dir() == self._spec.build_dir():
+            exit_st = self._build_cross(cross_env)
+        else:
+            exit_st = self._build_shared_cross(cross_env)
+        if exit_st != 0:
+            return exit_st
 
-        env_fs = metadata.get("env", [])
         env = base_env
-        for env_f in env_fs:
-            self._logger.info(
-                "[%s] reading env: %s",
-                self._spec_name, env_f)
-            file_env = self._env_source(env_f)
-            if file_env is None:
-                self._logger.error(
-                    "[%s] cannot source env file: %s",
-                    self._spec_name, env_f)
+        with self._timed(steps, "env"):
+            if not self._source_env_files(
+                    env, metadata.get("env", []), "env"):
                 return 1
-            env.update(file_env)
 
         pre = metadata.get("pre", [])
         for args in pre:
-            exit_st = self._pre_post_build(args, env)
+            with self._timed(steps, "pre"):
+                exit_st = self._pre_post_build(
+                    args, env,
+                    usage=resources.setdefault("pre", {}))
             if exit_st != 0:
                 return exit_st
 
-        pkg_targets = self._spec.pkg_targets()
-        for target in pkg_targets:
-            data = self._spec[target]
-            exit_st = self._build(target, env, data)
-            if exit_st != 0:
-                return exit_st
+        with self._timed(steps, "pkg_targets"):
+            exit_st = self._build_targets(self._spec.pkg_targets(), env)
+        if exit_st != 0:
+            return exit_st
 
         post = metadata.get("post", [])
         for args in post:
-            exit_st = self._pre_post_build(args, env)
+            with self._timed(steps, "post"):
+                exit_st = self._pre_post_build(
+                    args, env,
+                    usage=resources.setdefault("post", {}))
             if exit_st != 0:
                 return exit_st
 
         build_env = self._setup_environment(base_env)
         args = self._spec.build_image()
         if args:
-            exit_st = self._pre_post_build(args, build_env)
+            with self._timed(steps, "build_image"), _tracer.span(
+                    "build_image", "image", {"spec": self._files}):
+                exit_st = self._pre_post_build(
+                    args, build_env,
+                    usage=resources.setdefault("build_image", {}))
             if exit_st != 0:
                 return exit_st
 
         return 0
 
 
-def main(argv):
+def _prehash(specs):
     """
-    The main Ubuild main() ;-)
+    Start hashing, concurrently and in background, the source tarballs
+    and the patches of all the targets of the given specs, so that the
+    cache keys are ready (or almost) when the targets are built.
 
     Args:
-      argv: a full and bloated *argv[]
+      specs: a list of (SpecParser, files) tuples.
+    """
+    jobs = {}
+    for spec, _files in specs:
+        digests = UbuildDigests.get(spec.sources_dir())
+        paths = jobs.setdefault((digests, spec.cache_hash()), set())
+        for target in spec.cross_targets() + spec.pkg_targets():
+            metadata = spec[target]
+            paths.update(metadata.get("patch", []))
+            for _url, tarball in metadata.get("url", []):
+                path = os.path.join(spec.sources_dir(), tarball)
+                if os.path.isfile(path):
+                    paths.add(path)
+
+    # hashlib releases the GIL while hashing.
+    workers = multiprocessing.cpu_count()
+    for (digests, algorithm), paths in jobs.items():
+        digests.prefetch(sorted(paths), algorithm, workers)
+
+
+def _fetch_specs(specs, connections):
+    """
+    Download the source tarballs of all the targets of the given specs,
+    see UbuildFetcher.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+      connections: the maximum number of concurrent downloads.
 
     Returns:
       an exit status.
     """
-    parser = argparse.ArgumentParser(
-        description="Automated Embedded System Images Builder")
+    downloads = []
+    for spec, _files in specs:
+        for target in spec.cross_targets() + spec.pkg_targets():
+            checksums = spec.target_checksums(target)
+            for url, tarball in spec[target].get("url", []):
+                downloads.append((
+                    url, os.path.join(spec.sources_dir(), tarball),
+                    checksums.get(tarball)))
+    with _tracer.span("fetch", "sources"):
+        exit_st = UbuildFetcher(connections).fetch(downloads)
+    UbuildDigests.save_all()
+    return exit_st
+
+
+def _format_duration(seconds):
+    """
+    Return a human readable duration.
+    """
+    if seconds < 60:
+        return "%.1fs" % (seconds,)
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return "%dm%02ds" % (minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return "%dh%02dm%02ds" % (hours, minutes, seconds)
 
-    parser.add_argument(
-        "spec", nargs="+", metavar="<spec>", type=file,
-        help="ubuild spec file")
 
+def _plan_specs(specs):
+    """
+    Print, for every target of the given specs, whether it is in cache
+    (HIT) or has to be built (MISS), its cache file name and its
+    estimated build duration, based on the previous build reports.
+    Nothing is built and build_dir is not touched.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+
+    Returns:
+      an exit status.
+    """
+    exit_st = 0
+    for spec, files in specs:
+        builder = Ubuild(spec, files)
+        plan = builder.plan()
+        if plan is None:
+            exit_st = 1
+            continue
+        history = builder.history()
+
+        sys.stdout.write("%s (%s):\n" % (", ".join(files), spec.image_name()))
+        width = max([len(x[0]) for x in plan] or [0])
+        durations = {}
+        hits = 0
+        for target, entry_path, cached in plan:
+            if cached:
+                hits += 1
+            estimate = history.get(target, {}).get(
+                "cached" if cached else "built")
+            estimate_str = "?"
+            if estimate is not None:
+                durations[target] = estimate
+                estimate_str = "~%s" % (_format_duration(estimate),)
+            sys.stdout.write("  %-4s  %-*s  %s  %s\n" % (
+                "HIT" if cached else "MISS", width, target,
+                os.path.basename(entry_path), estimate_str))
+
+        estimate = sum(durations.values())
+        critical_path = sum(
+            UbuildScheduler(spec, targets, 1).critical_path(durations)
+            for targets in (spec.cross_targets(), spec.pkg_targets()))
+        sys.stdout.write(
+            "  %d hits, %d misses, estimated targets build time: %s "
+            "(critical path: %s)" % (
+                hits, len(plan) - hits, _format_duration(estimate),
+                _format_duration(critical_path)))
+        unknown = len(plan) - len(durations)
+        if unknown:
+            sys.stdout.write(", %d targets without history" % (unknown,))
+        sys.stdout.write("\n")
+    return exit_st
+
+
+def _check_isolation(specs):
+    """
+    Verify that the given specs can be built concurrently, that is,
+    they use different build directories and images.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+
+    Returns:
+      a list of error strings.
+    """
+    errors = []
+    seen = {}
+    for spec, files in specs:
+        paths = (
+            ("build_dir", spec.build_dir()),
+            ("compile_dir", spec.compile_dir()),
+            ("image", os.path.join(
+                spec.destination_dir(), spec.image_name())),
+            )
+        for param, path in paths:
+            other = seen.setdefault((param, path), files)
+            if other is not files:
+                errors.append("%s and %s share the same %s: %s" % (
+                    ", ".join(other), ", ".join(files), param, path))
+    return errors
+
+
+def _share_cache_entries(specs):
+    """
+    Plan the build of the given specs, so that identical build targets
+    (for instance, the same kernel shared by several images, or the same
+    cross toolchain, if they use the same build_dir), having the same
+    cache entry name, are built once: the first spec
+    needing a missing cache entry builds it, the others wait for it and
+    import it into their cache directory.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+
+    Returns:
+      a list of promises dicts (see Ubuild), one per spec.
+    """
+    logger = logging.getLogger("ubuild.Handler")
+    plans = []
+    cross_build_dirs = set()
+    for spec, files in specs:
+        plan = Ubuild(spec, files).plan()
+        if plan is None:
+            # errors are reported again at build time.
+            plan = []
+        cross_build_dir = spec.cross_build_dir()
+        if cross_build_dir != spec.build_dir():
+            if cross_build_dir in cross_build_dirs:
+                # built once, by one of the variants sharing it, see
+                # Ubuild._build_shared_cross().
+                plan = [x for x in plan if not x[0].startswith("cross=")]
+            cross_build_dirs.add(cross_build_dir)
+        plans.append(plan)
+
+    for plan in plans:
+        for _target, entry_path, cached in plan:
+            if cached:
+                UbuildCache.register(entry_path)
+
+    total = 0
+    cached_names = set()
+    users = {}
+    producers = {}
+    for index, plan in enumerate(plans):
+        for target, entry_path, cached in plan:
+            total += 1
+            entry_name = UbuildCache.entry_key(entry_path)
+            if cached:
+                cached_names.add(entry_name)
+                continue
+            users[entry_name] = users.get(entry_name, 0) + 1
+            producers.setdefault(entry_name, (index, target))
+
+    promises = [{} for _spec in specs]
+    for entry_name, (index, target) in producers.items():
+        if entry_name in cached_names:
+            continue
+        if users[entry_name] > 1:
+            promises[index][target] = entry_name
+
+    shared = sum(len(x) for x in promises)
+    logger.info(
+        "%d cached build targets across %d specs, %d distinct cache "
+        "entries, %d of them shared", total, len(specs),
+        len(cached_names | set(users.keys())), shared)
+    for entry_names in promises:
+        UbuildCache.promise(entry_names.values())
+    return promises
+
+
+def _build_specs(specs, parallel_specs, resume=False, sample_interval=1.0):
+    """
+    Build the given specs, up to parallel_specs of them concurrently.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+      parallel_specs: the maximum number of specs to build concurrently.
+      resume: resume the previous build of the specs, see Ubuild.
+      sample_interval: the resource usage sampling interval, see Ubuild.
+
+    Returns:
+      an exit status.
+    """
+    cross_builds = {}
+    if parallel_specs < 2 or len(specs) < 2:
+        promises = [{} for _spec in specs]
+        if len(specs) > 1:
+            promises = _share_cache_entries(specs)
+        exit_st = 0
+        for (spec, files), spec_promises in zip(specs, promises):
+            if exit_st == 0:
+                exit_st = Ubuild(
+                    spec, files, promises=spec_promises, resume=resume,
+                    sample_interval=sample_interval,
+                    cross_builds=cross_builds).build()
+            else:
+                for entry_name in spec_promises.values():
+                    UbuildCache.fulfil(entry_name)
+        return exit_st
+
+    errors = _check_isolation(specs)
+    if errors:
+        sys.stderr.write("Cannot build specs concurrently:\n")
+        for error in errors:
+            sys.stderr.write(" - %s\n" % (error,))
+        return 2
+
+    promises = _share_cache_entries(specs)
+
+    jobserver = None
+    jobs = [spec.jobs() for spec, _files in specs if spec.jobs()]
+    if jobs:
+        jobserver = UbuildJobServer(max(jobs))
+
+    cond = threading.Condition()
+    status = {}
+    running = set()
+
+    def _worker(index, spec, files):
+        exit_st = 1
+        try:
+            exit_st = Ubuild(
+                spec, files, jobserver=jobserver, buffer_logs=True,
+                promises=promises[index], resume=resume,
+                sample_interval=sample_interval,
+                cross_builds=cross_builds).build()
+        finally:
+            with cond:
+                running.discard(index)
+                status[index] = exit_st
+                cond.notify_all()
+
+    pending = list(enumerate(specs))
     try:
-        nsargs = parser.parse_args(argv[1:])
-    except IOError as err:
-        if err.errno == errno.ENOENT:
-            sys.stderr.write("%s: %s\n" % (err.strerror, err.filename))
-            return 1
-        raise
+        with cond:
+            while pending or running:
+                failed = [x for x in status.values() if x != 0]
+                while pending and not failed and (
+                        len(running) < parallel_specs):
+                    index, (spec, files) = pending.pop(0)
+                    running.add(index)
+                    thread = threading.Thread(
+                        target=_worker, args=(index, spec, files),
+                        name=", ".join(
+                            [os.path.basename(x) for x in files]))
+                    thread.daemon = True
+                    thread.start()
+                if failed and not running:
+                    break
+                # wait() with a timeout, to keep KeyboardInterrupt working
+                cond.wait(1.0)
+    finally:
+        if jobserver is not None and not running:
+            jobserver.close()
+        with cond:
+            for index, _spec in pending:
+                for entry_name in promises[index].values():
+                    UbuildCache.fulfil(entry_name)
+
+    for index in sorted(status.keys()):
+        if status[index] != 0:
+            return status[index]
+    return 0
+
+
+def _read_specs(spec_files, create_dirs=True):
+    """
+    Parse the given spec files.
+
+    Args:
+      spec_files: a list of spec file objects.
+      create_dirs: see SpecParser.
 
+    Returns:
+      a tuple composed by a list of (SpecParser, files) tuples and
+      an exit status.
+    """
     specs = []
     exit_st = 0
-    for spec_f in nsargs.spec:
-        parser = SpecParser(spec_f.name)
+    for spec_f in spec_files:
+        parser = SpecParser(spec_f.name, create_dirs=create_dirs)
         try:
             parser.read()
         except SpecParser.MissingParametersError as err:
@@ -1411,21 +6697,375 @@ def main(argv):
                 spec_f.name, err))
             exit_st = 2
             continue
-        specs.append((parser, [spec_f.name]))
+        variants = parser.variants()
+        if variants is None:
+            exit_st = 2
+            continue
+        specs.extend([(x, [spec_f.name]) for x in variants])
+    return specs, exit_st
 
-    if exit_st != 0:
-        return exit_st
 
+def _format_size(size):
+    """
+    Return a human readable size.
+    """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "TiB"
+    if unit == "B":
+        return "%d%s" % (size, unit)
+    return "%.1f%s" % (size, unit)
+
+
+def _cache_dirs(specs):
+    """
+    Group the given specs by cache directory.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+
+    Returns:
+      a list of (cache directory, list of (SpecParser, files) tuples)
+      tuples, in spec order.
+    """
+    cache_dirs = []
+    cache_specs = {}
     for spec, files in specs:
+        cache_dir = spec.cache_dir()
+        if cache_dir is None:
+            sys.stderr.write(
+                "cache_dir is unset in %s\n" % (", ".join(files),))
+            continue
+        if cache_dir not in cache_specs:
+            cache_dirs.append(cache_dir)
+        cache_specs.setdefault(cache_dir, []).append((spec, files))
+    return [(x, cache_specs[x]) for x in cache_dirs]
+
+
+def _cache_stats(specs):
+    """
+    Print the cache hit rate and the build time saved by cache hits,
+    for every target built using the cache directory of the given
+    specs, see UbuildCacheIndex.
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+
+    Returns:
+      an exit status.
+    """
+    exit_st = 0
+    for cache_dir, cache_specs in _cache_dirs(specs):
+        index = UbuildCacheIndex(cache_dir)
         try:
-            exit_st = Ubuild(spec, files).build()
-        except KeyboardInterrupt:
+            stats = index.stats()
+            entries = index.entries()
+        except sqlite3.Error as err:
+            sys.stderr.write(
+                "cannot read the cache index of %s: %s\n" % (cache_dir, err))
+            exit_st = 1
+            continue
+
+        sys.stdout.write("%s (%s):\n" % (
+            cache_dir, ", ".join([", ".join(x[1]) for x in cache_specs])))
+        width = max([len(x[0] or "?") for x in stats] + [len("total")])
+        row_fmt = "  %-*s  %8s  %8s  %8s  %10s\n"
+        sys.stdout.write(row_fmt % (
+            width, "target", "lookups", "hits", "hit rate", "time saved"))
+        total = [0, 0, 0.0]
+        for target, lookups, hits, saved in stats:
+            hits = hits or 0
+            saved = saved or 0.0
+            total[0] += lookups
+            total[1] += hits
+            total[2] += saved
+            sys.stdout.write(row_fmt % (
+                width, target or "?", lookups, hits,
+                "%d%%" % (100 * hits // lookups,),
+                _format_duration(saved)))
+        lookups, hits, saved = total
+        sys.stdout.write(row_fmt % (
+            width, "total", lookups, hits,
+            "%d%%" % (100 * hits // lookups,) if lookups else "-",
+            _format_duration(saved)))
+
+        size = 0
+        unpacked_size = 0
+        count = 0
+        for entry in entries:
+            if not os.path.isfile(os.path.join(cache_dir, entry["file"])):
+                continue
+            count += 1
+            size += entry["size"] or 0
+            unpacked_size += entry["unpacked_size"] or 0
+        sys.stdout.write("  %d cache entries, %s (%s unpacked)\n" % (
+            count, _format_size(size), _format_size(unpacked_size)))
+    return exit_st
+
+
+def _cache_gc(specs):
+    """
+    Collect the garbage of the cache directories of the given specs,
+    evicting the least recently used cache files until the cache
+    directories fit their cache_max_size (the smallest one among the
+    specs sharing them), if set, and the least recently used extracted
+    trees exceeding cache_warm, likewise. The cache files of the build targets
+    of the given specs are never evicted. See UbuildCache.gc().
+
+    Args:
+      specs: a list of (SpecParser, files) tuples.
+
+    Returns:
+      an exit status.
+    """
+    protected = set()
+    for spec, files in specs:
+        plan = Ubuild(spec, files).plan()
+        if plan is None:
             return 1
-        if exit_st != 0:
-            return exit_st
+        protected.update([UbuildCache.entry_key(x[1]) for x in plan])
+
+    for cache_dir, cache_specs in _cache_dirs(specs):
+        sizes = [x[0].cache_max_size() for x in cache_specs]
+        sizes = [x for x in sizes if x is not None]
+        max_size = min(sizes) if sizes else None
+        warms = [x[0].cache_warm() for x in cache_specs]
+        warms = [x for x in warms if x is not None]
+        warm = None
+        if warms:
+            warm = min(warms, key=lambda x: x["max_size"])
+
+        spec = cache_specs[0][0]
+        cacher = UbuildCache(
+            None, spec.sources_dir(), cache_dir, [], warm=warm)
+        removed, freed = cacher.gc(max_size, protected=protected)
+        budget = ""
+        if max_size is not None:
+            budget = ", budget: %s" % (_format_size(max_size),)
+        sys.stdout.write(
+            "%s: %d cache files evicted, %s freed, %s used%s\n" % (
+                cache_dir, removed, _format_size(freed),
+                _format_size(cacher.size()), budget))
+    return 0
+
+
+def _cache_serve(directory, bind, port):
+    """
+    Serve the cache files of the given directory, see UbuildCacheServer.
 
+    Returns:
+      an exit status.
+    """
+    logger = logging.getLogger("ubuild.Handler")
+    try:
+        server = UbuildCacheServer((bind, port), directory)
+    except (socket.error, OSError) as err:
+        sys.stderr.write("cannot listen on %s:%d: %s\n" % (bind, port, err))
+        return 1
+    logger.info(
+        "serving %s on http://%s:%d/", directory,
+        *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
     return 0
 
+
+def _cache_main(argv):
+    """
+    The "ubuild cache" command main().
+
+    Args:
+      argv: a full and bloated *argv[], argv[1] being "cache".
+
+    Returns:
+      an exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog="ubuild cache", description="Ubuild cache management")
+    subparsers = parser.add_subparsers(dest="command", metavar="<command>")
+    subparsers.required = True
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="print the cache hit rate and the time saved "
+        "per target")
+    stats_parser.add_argument(
+        "spec", nargs="+", metavar="<spec>", type=open,
+        help="ubuild spec file using the cache directory")
+
+    gc_parser = subparsers.add_parser(
+        "gc", help="remove the stale temporary files and evict the least "
+        "recently used cache files exceeding cache_max_size")
+    gc_parser.add_argument(
+        "spec", nargs="+", metavar="<spec>", type=open,
+        help="ubuild spec file using the cache directory, whose cache "
+        "files are never evicted")
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="serve the cache files of a directory over HTTP, "
+        "for the cache_remote parameter")
+    serve_parser.add_argument(
+        "directory", metavar="<directory>",
+        help="directory containing the served cache files")
+    serve_parser.add_argument(
+        "--bind", metavar="<address>", default="127.0.0.1",
+        help="address to listen on (default: 127.0.0.1)")
+    serve_parser.add_argument(
+        "--port", metavar="<port>", type=int, default=8765,
+        help="port to listen on (default: 8765)")
+
+    try:
+        nsargs = parser.parse_args(argv[2:])
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            sys.stderr.write("%s: %s\n" % (err.strerror, err.filename))
+            return 1
+        raise
+
+    if nsargs.command == "serve":
+        if not os.path.isdir(nsargs.directory):
+            sys.stderr.write("not a directory: %s\n" % (nsargs.directory,))
+            return 1
+        return _cache_serve(nsargs.directory, nsargs.bind, nsargs.port)
+
+    specs, exit_st = _read_specs(nsargs.spec, create_dirs=False)
+    if exit_st != 0:
+        return exit_st
+    if nsargs.command == "gc":
+        return _cache_gc(specs)
+    return _cache_stats(specs)
+
+
+def _fetch_main(argv):
+    """
+    The "ubuild fetch" command main().
+
+    Args:
+      argv: a full and bloated *argv[], argv[1] being "fetch".
+
+    Returns:
+      an exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog="ubuild fetch",
+        description="Download the source tarballs of ubuild spec files")
+    parser.add_argument(
+        "spec", nargs="+", metavar="<spec>", type=open,
+        help="ubuild spec file")
+    parser.add_argument(
+        "--connections", metavar="<N>", type=int,
+        default=UbuildFetcher.CONNECTIONS,
+        help="maximum number of concurrent downloads (default: %d)" % (
+            UbuildFetcher.CONNECTIONS,))
+
+    try:
+        nsargs = parser.parse_args(argv[2:])
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            sys.stderr.write("%s: %s\n" % (err.strerror, err.filename))
+            return 1
+        raise
+
+    specs, exit_st = _read_specs(nsargs.spec, create_dirs=False)
+    if exit_st != 0:
+        return exit_st
+    return _fetch_specs(specs, nsargs.connections)
+
+
+def main(argv):
+    """
+    The main Ubuild main() ;-)
+
+    Args:
+      argv: a full and bloated *argv[]
+
+    Returns:
+      an exit status.
+    """
+    if argv[1:2] == ["cache"]:
+        return _cache_main(argv)
+    if argv[1:2] == ["fetch"]:
+        return _fetch_main(argv)
+
+    parser = argparse.ArgumentParser(
+        description="Automated Embedded System Images Builder")
+
+    parser.add_argument(
+        "spec", nargs="+", metavar="<spec>", type=open,
+        help="ubuild spec file")
+
+    parser.add_argument(
+        "--parallel-specs", metavar="<N>", type=int, default=1,
+        help="number of spec files to build concurrently")
+
+    parser.add_argument(
+        "--trace", metavar="<file>", default=None,
+        help="write the build timeline to <file>, in the Trace Event "
+        "Format (chrome://tracing, Perfetto)")
+
+    parser.add_argument(
+        "--sample-interval", metavar="<seconds>", type=float, default=1.0,
+        help="resource usage sampling interval of the build scripts, "
+        "0 disables sampling (default: 1.0)")
+
+    parser.add_argument(
+        "--plan", action="store_true", default=False,
+        help="print the cache hits and misses of the build targets and "
+        "their estimated build time, without building")
+
+    parser.add_argument(
+        "--resume", action="store_true", default=False,
+        help="do not clean build_dir and skip the targets already built "
+        "there by a previous run")
+
+    parser.add_argument(
+        "--fetch-connections", metavar="<N>", type=int,
+        default=UbuildFetcher.CONNECTIONS,
+        help="maximum number of concurrent source tarball downloads, "
+        "done before building (default: %d)" % (UbuildFetcher.CONNECTIONS,))
+
+    try:
+        nsargs = parser.parse_args(argv[1:])
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            sys.stderr.write("%s: %s\n" % (err.strerror, err.filename))
+            return 1
+        raise
+
+    if nsargs.trace:
+        _tracer.enable()
+
+    specs, exit_st = _read_specs(nsargs.spec, create_dirs=not nsargs.plan)
+    if exit_st != 0:
+        return exit_st
+
+    try:
+        if nsargs.plan:
+            _prehash(specs)
+            exit_st = _plan_specs(specs)
+        else:
+            exit_st = _fetch_specs(specs, nsargs.fetch_connections)
+            if exit_st == 0:
+                _prehash(specs)
+                exit_st = _build_specs(
+                    specs, nsargs.parallel_specs, resume=nsargs.resume,
+                    sample_interval=nsargs.sample_interval)
+    except KeyboardInterrupt:
+        exit_st = 1
+    UbuildDigests.save_all()
+
+    if nsargs.trace:
+        trace_st = _tracer.write(nsargs.trace)
+        if exit_st == 0:
+            exit_st = trace_st
+    return exit_st
+
 if __name__ == "__main__":
     sys.argv[0] = "ubuild"
     raise SystemExit(main(sys.argv))
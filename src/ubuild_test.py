@@ -20,14 +20,39 @@
 Tests for ubuild.
 """
 import copy
+import hashlib
+import io
+import json
+import logging
 import os
+import select
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 import ubuild
 
 
+_XDG_CACHE_HOME = None
+
+
+def setUpModule():
+    """
+    Keep the compiled spec cache of the tests out of the user cache
+    directory.
+    """
+    global _XDG_CACHE_HOME
+    _XDG_CACHE_HOME = tempfile.mkdtemp(prefix="ubuild.test.cache")
+    os.environ["XDG_CACHE_HOME"] = _XDG_CACHE_HOME
+
+
+def tearDownModule():
+    shutil.rmtree(_XDG_CACHE_HOME, True)
+
+
 class UbuildSpecTest(unittest.TestCase):
 
     def _testSpecParse(self, spec_content, expected):
@@ -462,6 +487,1684 @@ url = http://www.kernel.org/pub/linux/kernel/v3.x/linux-3.7.10.tar.xz
                              parser.ubuild()[k][0])
         self.assertEqual(parser.image_name(), "ubuild_armel.test.img")
 
+    def testDependsSpec(self):
+        """
+        Test the parsing of target dependencies.
+        """
+        content = """
+[ubuild]
+build_dir = %(dir)s
+compile_dir = %(dir)s
+build_image = %(script)s
+cache_dir = %(dir)s
+destination_dir = %(dir)s
+image_name = ubuild_armel.test.img
+parallel_targets = 4
+rootfs_dir = %(dir)s
+initramfs_rootfs_dir = %(dir)s
+sources_dir = %(dir)s
+
+[cross=gmp]
+build = %(script)s
+sources = gmp
+url = http://ftp.gnu.org/gnu/gmp/gmp-4.3.2.tar.bz2
+
+[cross=binutils]
+build = %(script)s
+depends = none
+sources = binutils
+url = http://ftp.gnu.org/gnu/binutils/binutils-2.23.1.tar.gz
+
+[cross=mpfr]
+build = %(script)s
+depends = gmp
+sources = mpfr
+url = http://ftp.gnu.org/gnu/mpfr/mpfr-2.4.2.tar.bz2
+
+[pkg=kernel]
+build = %(script)s
+depends = cross=mpfr cross=binutils
+sources = linux
+url = http://www.kernel.org/pub/linux/kernel/v3.x/linux-3.7.10.tar.xz
+"""
+        expected = {
+            "ubuild": {
+                "build_dir": ["%(dir)s"],
+                "compile_dir": ["%(dir)s"],
+                "build_image": [["%(script)s"]],
+                "cache_dir": ["%(dir)s"],
+                "destination_dir": ["%(dir)s"],
+                "image_name": ["ubuild_armel.test.img"],
+                "parallel_targets": [4],
+                "rootfs_dir": ["%(dir)s"],
+                "initramfs_rootfs_dir": ["%(dir)s"],
+                "sources_dir": ["%(dir)s"],
+            },
+            "cross=gmp": {
+                "build": [["%(script)s"]],
+                "sources": ["gmp"],
+                "url": [("http://ftp.gnu.org/gnu/gmp/gmp-4.3.2.tar.bz2",
+                         "gmp-4.3.2.tar.bz2")],
+            },
+            "cross=binutils": {
+                "build": [["%(script)s"]],
+                "depends": [["none"]],
+                "sources": ["binutils"],
+                "url": [("http://ftp.gnu.org/gnu/binutils/"
+                         "binutils-2.23.1.tar.gz",
+                         "binutils-2.23.1.tar.gz")],
+            },
+            "cross=mpfr": {
+                "build": [["%(script)s"]],
+                "depends": [["cross=gmp"]],
+                "sources": ["mpfr"],
+                "url": [("http://ftp.gnu.org/gnu/mpfr/mpfr-2.4.2.tar.bz2",
+                         "mpfr-2.4.2.tar.bz2")],
+            },
+            "pkg=kernel": {
+                "build": [["%(script)s"]],
+                "depends": [["cross=mpfr", "cross=binutils"]],
+                "sources": ["linux"],
+                "url": [("http://www.kernel.org/pub/linux/kernel/v3.x/"
+                         "linux-3.7.10.tar.xz",
+                         "linux-3.7.10.tar.xz")],
+            },
+        }
+        parser = self._testSpecParse(content, expected)
+        self.assertEqual(4, parser.parallel_targets())
+        self.assertEqual(None, parser.target_depends("cross=gmp"))
+        self.assertEqual([], parser.target_depends("cross=binutils"))
+        self.assertEqual(["cross=gmp"], parser.target_depends("cross=mpfr"))
+
+        # dependencies must be defined before the depending target.
+        content = content.replace("depends = gmp", "depends = binutils")
+        content = content.replace("depends = none", "depends = mpfr")
+        self.assertRaises(ubuild.SpecParser.MissingParametersError,
+                          self._testSpecParse, content, {})
+
+
+class UbuildSchedulerTest(unittest.TestCase):
+
+    class _Spec(object):
+
+        def __init__(self, build_dir, depends):
+            self._build_dir = build_dir
+            self._depends = depends
+
+        def build_dir(self):
+            return self._build_dir
+
+        def path(self):
+            return "test.spec"
+
+        def target_depends(self, target):
+            return self._depends.get(target)
+
+    def _run(self, targets, depends, workers, failing=()):
+        """
+        Run the scheduler and return the exit status and the list
+        of (event, target) tuples recorded by the build function.
+        """
+        build_dir = tempfile.mkdtemp(prefix="ubuild.test")
+        try:
+            spec = self._Spec(build_dir, depends)
+            events = []
+            lock = threading.Lock()
+
+            def _build(target, log_file):
+                with lock:
+                    events.append(("start", target))
+                if workers > 1:
+                    self.assertNotEqual(None, log_file)
+                with lock:
+                    events.append(("end", target))
+                if target in failing:
+                    return 3
+                return 0
+
+            scheduler = ubuild.UbuildScheduler(spec, targets, workers)
+            return scheduler.run(_build), events
+        finally:
+            shutil.rmtree(build_dir, True)
+
+    def testSequential(self):
+        """
+        Test that targets without dependencies are built in order.
+        """
+        targets = ["cross=a", "cross=b", "cross=c"]
+        for workers in (1, 4):
+            exit_st, events = self._run(targets, {}, workers)
+            self.assertEqual(0, exit_st)
+            self.assertEqual(
+                [("start", "cross=a"), ("end", "cross=a"),
+                 ("start", "cross=b"), ("end", "cross=b"),
+                 ("start", "cross=c"), ("end", "cross=c")],
+                events)
+
+    def testDependencies(self):
+        """
+        Test that dependencies are respected and failures stop the build.
+        """
+        targets = ["cross=a", "cross=b", "cross=c", "cross=d"]
+        depends = {
+            "cross=b": [],
+            "cross=c": ["cross=a", "cross=b"],
+            "cross=d": ["cross=c"],
+        }
+        exit_st, events = self._run(targets, depends, 2)
+        self.assertEqual(0, exit_st)
+        for dep, target in (("cross=a", "cross=c"), ("cross=b", "cross=c"),
+                            ("cross=c", "cross=d")):
+            self.assert_(events.index(("end", dep)) <
+                         events.index(("start", target)))
+
+        exit_st, events = self._run(
+            targets, depends, 2, failing=("cross=b",))
+        self.assertEqual(3, exit_st)
+        self.assert_(("start", "cross=c") not in events)
+        self.assert_(("start", "cross=d") not in events)
+
+    def testLogs(self):
+        """
+        Test that the records logged while building a target are
+        written with its build output, in the .spec file order.
+        """
+        class _Stdout(object):
+
+            def __init__(self):
+                self.buffer = io.BytesIO()
+
+            def flush(self):
+                pass
+
+        class _Handler(logging.Handler):
+
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record.getMessage())
+
+        build_dir = tempfile.mkdtemp(prefix="ubuild.test")
+        logger = logging.getLogger("ubuild.Handler")
+        handler = _Handler()
+        logger.addHandler(handler)
+        stdout = sys.stdout
+        sys.stdout = _Stdout()
+        try:
+            spec = self._Spec(build_dir, {"cross=b": []})
+            b_done = threading.Event()
+
+            def _build(target, log_file):
+                if target == "cross=a":
+                    # completes after cross=b, flushed before it.
+                    b_done.wait(10)
+                logger.warning("%s: cache miss", target)
+                os.write(log_file.fileno(),
+                         ("%s: output\n" % (target,)).encode("utf-8"))
+                logger.warning("%s: packed", target)
+                if target == "cross=b":
+                    b_done.set()
+                return 0
+
+            scheduler = ubuild.UbuildScheduler(
+                spec, ["cross=a", "cross=b"], 2)
+            self.assertEqual(0, scheduler.run(_build))
+            logger.warning("not captured")
+            out = sys.stdout.buffer.getvalue().decode("utf-8")
+        finally:
+            sys.stdout = stdout
+            logger.removeHandler(handler)
+            shutil.rmtree(build_dir, True)
+
+        self.assertEqual(
+            "cross=a: cache miss\ncross=a: output\ncross=a: packed\n"
+            "cross=b: cache miss\ncross=b: output\ncross=b: packed\n",
+            out)
+        self.assertEqual(["not captured"], handler.records)
+
+
+class UbuildJobServerTest(unittest.TestCase):
+
+    def _available(self, jobserver):
+        """
+        Return the number of tokens currently in the jobserver pipe,
+        leaving them there.
+        """
+        read_fd = int(jobserver.makeflags().split("=")[1].split(",")[0])
+        write_fd = int(jobserver.makeflags().split("=")[1].split(",")[1])
+        tokens = b""
+        while select.select([read_fd], [], [], 0)[0]:
+            tokens += os.read(read_fd, 1)
+        os.write(write_fd, tokens)
+        return len(tokens)
+
+    def testTokens(self):
+        """
+        Test jobserver tokens accounting.
+        """
+        jobserver = ubuild.UbuildJobServer(3)
+        try:
+            self.assertEqual(3, jobserver.jobs())
+            self.assertEqual(3, self._available(jobserver))
+            with jobserver.token():
+                self.assertEqual(2, self._available(jobserver))
+                with jobserver.token():
+                    self.assertEqual(1, self._available(jobserver))
+            self.assertEqual(3, self._available(jobserver))
+        finally:
+            jobserver.close()
+
+    def testMake(self):
+        """
+        Test that GNU make uses the jobserver.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix="ubuild.test")
+        jobserver = ubuild.UbuildJobServer(2)
+        try:
+            with open(os.path.join(tmp_dir, "Makefile"), "w") as make_f:
+                make_f.write("all: a b c\na b c:\n\t@echo $(MAKEFLAGS)\n")
+            env = os.environ.copy()
+            env["MAKEFLAGS"] = jobserver.makeflags()
+            try:
+                with jobserver.token():
+                    proc = subprocess.Popen(
+                        ("make", "-s", "-C", tmp_dir), env=env,
+                        stdout=subprocess.PIPE, **jobserver.popen_kwargs())
+                    out = proc.communicate()[0]
+            except OSError:
+                # make is not available
+                return
+            self.assertEqual(0, proc.returncode)
+            self.assert_(b"jobserver" in out)
+            self.assertEqual(2, self._available(jobserver))
+        finally:
+            jobserver.close()
+            shutil.rmtree(tmp_dir, True)
+
+
+class UbuildDigestsTest(unittest.TestCase):
+    """
+    UbuildDigests tests.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(prefix="ubuild.test")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir, True)
+
+    def testDigest(self):
+        """
+        Test that file digests are persisted and invalidated.
+        """
+        path = os.path.join(self._dir, "foo.tar.gz")
+        with open(path, "wb") as foo_f:
+            foo_f.write(b"foo" * 1000000)
+
+        # a same-size rewrite keeping the mtime of a file modified
+        # right before being hashed is not missed.
+        digests = ubuild.UbuildDigests(
+            os.path.join(self._dir, ubuild.UbuildDigests.INDEX_FILE))
+        self.assertEqual(hashlib.sha1(b"foo" * 1000000).hexdigest(),
+                         digests.digest(path))
+        st = os.stat(path)
+        with open(path, "r+b") as foo_f:
+            foo_f.write(b"bar")
+        if hasattr(st, "st_mtime_ns"):
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(ubuild.UbuildDigests._stat_key(path),
+                             list(digests._entries[path]["stat"]))
+        else:
+            os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertEqual(
+            hashlib.sha1(b"bar" + b"foo" * 999999).hexdigest(),
+            digests.digest(path))
+        self.assertFalse(
+            os.path.exists(os.path.join(
+                self._dir, ubuild.UbuildDigests.INDEX_FILE)))
+
+        with open(path, "wb") as foo_f:
+            foo_f.write(b"foo" * 1000000)
+        mtime = time.time() - 10
+        os.utime(path, (mtime, mtime))
+        expected = hashlib.sha1(b"foo" * 1000000).hexdigest()
+        self.assertEqual(expected, digests.digest(path))
+        self.assertEqual(
+            hashlib.md5(b"foo" * 1000000).hexdigest(),
+            digests.digest(path, "md5"))
+        digests.save()
+
+        hash_file = ubuild.UbuildDigests.__dict__["hash_file"]
+        hashed = []
+        def _hash_file(path, algorithm):
+            hashed.append(path)
+            return hash_file.__get__(None, ubuild.UbuildDigests)(
+                path, algorithm)
+
+        ubuild.UbuildDigests.hash_file = staticmethod(_hash_file)
+        try:
+            digests = ubuild.UbuildDigests(
+                os.path.join(self._dir, ubuild.UbuildDigests.INDEX_FILE))
+            self.assertEqual(expected, digests.digest(path))
+            self.assertEqual([], hashed)
+
+            with open(path, "ab") as foo_f:
+                foo_f.write(b"bar")
+            self.assertEqual(
+                hashlib.sha1(b"foo" * 1000000 + b"bar").hexdigest(),
+                digests.digest(path))
+            self.assertEqual([path], hashed)
+        finally:
+            ubuild.UbuildDigests.hash_file = hash_file
+
+        self.assert_(ubuild.UbuildDigests.get(self._dir) is
+                     ubuild.UbuildDigests.get(self._dir + "/"))
+
+
+    def testPrefetch(self):
+        """
+        Test that files hashed in background are hashed once.
+        """
+        paths = []
+        for index in range(8):
+            path = os.path.join(self._dir, "%d.tar.gz" % (index,))
+            with open(path, "wb") as tar_f:
+                tar_f.write(str(index).encode("utf-8") * 1000000)
+            mtime = time.time() - 10
+            os.utime(path, (mtime, mtime))
+            paths.append(path)
+
+        hash_file = ubuild.UbuildDigests.__dict__["hash_file"]
+        hashed = []
+        def _hash_file(path, algorithm):
+            hashed.append(path)
+            return hash_file.__get__(None, ubuild.UbuildDigests)(
+                path, algorithm)
+
+        ubuild.UbuildDigests.hash_file = staticmethod(_hash_file)
+        try:
+            digests = ubuild.UbuildDigests(
+                os.path.join(self._dir, ubuild.UbuildDigests.INDEX_FILE))
+            digests.prefetch(paths, "sha1", 4)
+            for index, path in enumerate(paths):
+                self.assertEqual(
+                    hashlib.sha1(
+                        str(index).encode("utf-8") * 1000000).hexdigest(),
+                    digests.digest(path))
+        finally:
+            ubuild.UbuildDigests.hash_file = hash_file
+        self.assertEqual(sorted(paths), sorted(hashed))
+
+        # the index is written once all the files are hashed.
+        index_path = os.path.join(self._dir, ubuild.UbuildDigests.INDEX_FILE)
+        deadline = time.time() + 10
+        while not os.path.isfile(index_path) and time.time() < deadline:
+            time.sleep(0.05)
+        digests = ubuild.UbuildDigests(index_path)
+        ubuild.UbuildDigests.hash_file = staticmethod(_hash_file)
+        try:
+            for path in paths:
+                digests.digest(path)
+        finally:
+            ubuild.UbuildDigests.hash_file = hash_file
+        self.assertEqual(len(paths), len(hashed))
+
+
+class UbuildSamplerTest(unittest.TestCase):
+    """
+    UbuildSampler tests.
+    """
+
+    def testSample(self):
+        """
+        Test the resource usage of a process tree.
+        """
+        code = "import time; x = 'x' * (64 * 1024 * 1024); time.sleep(0.5)"
+        proc = subprocess.Popen(
+            ["/bin/sh", "-c", "'%s' -c \"%s\"; true" % (
+                sys.executable, code)])
+        sampler = ubuild.UbuildSampler(proc.pid, 0.05)
+        sampler.start()
+        try:
+            _pid, status, rusage = os.wait4(proc.pid, 0)
+        finally:
+            sampler.stop()
+        proc.returncode = os.WEXITSTATUS(status)
+
+        usage = sampler.collect(rusage)
+        self.assert_(usage["user"] >= 0.0)
+        # the python child is not the root process.
+        self.assert_(usage["peak_rss"] > 64 * 1024 * 1024)
+        self.assert_(usage["max_rss"] > 64 * 1024 * 1024)
+        self.assert_("read_bytes" in usage)
+
+        total = {}
+        ubuild.UbuildSampler.add(total, usage)
+        ubuild.UbuildSampler.add(total, usage)
+        self.assertEqual(2 * usage["user"], total["user"])
+        self.assertEqual(usage["peak_rss"], total["peak_rss"])
+        self.assert_("peak rss" in ubuild.UbuildSampler.summary(total))
+
+
+class UbuildBuildTest(unittest.TestCase):
+    """
+    Build tests, using fake build scripts.
+    """
+
+    _BUILD_SCRIPT = """#!/bin/sh
+pn="${UBUILD_TARGET_NAME#*=}"
+echo "${UBUILD_TARGET_NAME}" >> "${UBUILD_TEST_BUILT}"
+sleep "${UBUILD_TEST_SLEEP:-0}"
+mkdir -p "${UBUILD_BUILD_DIR}/${pn}" || exit 1
+echo "${pn} ${TEST_VALUE}" > "${UBUILD_BUILD_DIR}/${pn}/content" || exit 1
+echo "${UBUILD_BUILD_DIR}" > "${UBUILD_BUILD_DIR}/${pn}/build_dir" || exit 1
+echo "${UBUILD_CROSS_BUILD_DIR}" > \
+    "${UBUILD_BUILD_DIR}/${pn}/cross_build_dir" || exit 1
+echo shared > "${UBUILD_BUILD_DIR}/${pn}/shared" || exit 1
+chmod 0640 "${UBUILD_BUILD_DIR}/${pn}/shared" || exit 1
+ln -sf content "${UBUILD_BUILD_DIR}/${pn}/link" || exit 1
+cp -a "${UBUILD_BUILD_DIR}/${pn}" "${UBUILD_IMAGE_DIR}/" || exit 1
+echo "src_compile 1.0 3.5 0" >> "${UBUILD_TIMINGS_FILE}"
+"""
+
+    _IMAGE_SCRIPT = """#!/bin/sh
+touch "${UBUILD_DESTINATION_DIR}/${UBUILD_IMAGE_NAME}"
+"""
+
+    _ENV = """
+TEST_VALUE="%(value)s"
+UBUILD_TEST_BUILT="%(root)s/built"
+UBUILD_TEST_SLEEP="%(sleep)s"
+export TEST_VALUE UBUILD_TEST_BUILT UBUILD_TEST_SLEEP
+"""
+
+    _SPEC = """
+[ubuild]
+build_dir = build.%(build)s
+compile_dir = compile.%(name)s
+build_image = scripts/image.sh
+cache_dir = %(cache)s
+cache_vars = TEST_VALUE
+cross_env = env
+destination_dir = dest
+env = env
+image_name = %(name)s.img
+rootfs_dir = rootfs
+initramfs_rootfs_dir = rootfs
+sources_dir = sources
+%(ubuild)s
+
+[cross=a]
+build = scripts/build.sh
+sources = a
+url = http://localhost/a.tar.gz
+
+[cross=b]
+build = scripts/build.sh
+sources = b
+url = http://localhost/b.tar.gz
+
+[pkg=c]
+build = scripts/build.sh
+sources = c
+url = http://localhost/c.tar.gz
+"""
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp(prefix="ubuild.test")
+        for name in ("cache", "dest", "rootfs", "scripts", "sources"):
+            os.mkdir(os.path.join(self._root, name))
+        for name, content in (("build.sh", self._BUILD_SCRIPT),
+                              ("image.sh", self._IMAGE_SCRIPT)):
+            path = os.path.join(self._root, "scripts", name)
+            with open(path, "w") as script_f:
+                script_f.write(content)
+            os.chmod(path, 0o755)
+        self._write_env("foo")
+
+    def tearDown(self):
+        shutil.rmtree(self._root, True)
+
+    def _write_env(self, value, sleep=0):
+        """
+        Write the environment file shared by all the specs.
+        """
+        with open(os.path.join(self._root, "env"), "w") as env_f:
+            env_f.write(self._ENV % {
+                "value": value, "root": self._root, "sleep": sleep})
+
+    def _spec(self, name, ubuild_params="", cache="cache", build=None):
+        """
+        Write and parse a .spec file, return a (SpecParser, files) tuple.
+        build_dir is build.<build> (build.<name> if build is None).
+        """
+        path = os.path.join(self._root, "%s.spec" % (name,))
+        with open(path, "w") as spec_f:
+            spec_f.write(self._SPEC % {
+                "name": name, "ubuild": ubuild_params, "cache": cache,
+                "build": build or name})
+        parser = ubuild.SpecParser(path)
+        parser.read()
+        return parser, [path]
+
+    def _built(self):
+        """
+        Return the list of targets built by the build script.
+        """
+        path = os.path.join(self._root, "built")
+        if not os.path.isfile(path):
+            return []
+        with open(path, "r") as built_f:
+            return built_f.read().split()
+
+    def _cache_files(self, cache_dir):
+        """
+        Return the list of cache files inside cache_dir, skipping the
+        ubuild internal files, like the cache index.
+        """
+        return [x for x in os.listdir(cache_dir) if not x.startswith(".")]
+
+    def _content(self, name, target):
+        """
+        Return the content of a target file in the build_dir of name.
+        """
+        path = os.path.join(self._root, "build.%s" % (name,),
+                            target, "content")
+        with open(path, "r") as content_f:
+            return content_f.read().strip()
+
+    def testEnvSource(self):
+        """
+        Test that environment files are sourced once, together.
+        """
+        sourced = os.path.join(self._root, "sourced")
+        env_file = os.path.join(self._root, "env2")
+        failing_file = os.path.join(self._root, "failing")
+        with open(failing_file, "w") as env_f:
+            env_f.write("false\n")
+
+        def _write(value):
+            with open(env_file, "w") as env_f:
+                env_f.write(
+                    "echo sourced >> '%s'\nFOO='%s'\nexport FOO\n" % (
+                        sourced, value))
+
+        def _sourced():
+            with open(sourced) as sourced_f:
+                return len(sourced_f.readlines())
+
+        _write("a b\n c ")
+        spec, files = self._spec("one")
+        env_files = [os.path.join(self._root, "env"), env_file, env_file]
+        envs = ubuild.Ubuild(spec, files)._env_source(env_files)
+        self.assertEqual(3, len(envs))
+        self.assertEqual("foo", envs[0]["TEST_VALUE"])
+        self.assertFalse("FOO" in envs[0])
+        self.assertEqual("a b\n c ", envs[1]["FOO"])
+        self.assertEqual(envs[1], envs[2])
+        self.assertEqual(self._root, envs[1]["PWD"])
+        self.assertEqual(1, _sourced())
+
+        envs = ubuild.Ubuild(spec, files)._env_source([env_file])
+        self.assertEqual("a b\n c ", envs[0]["FOO"])
+        self.assertEqual(1, _sourced())
+
+        _write("bar")
+        envs = ubuild.Ubuild(spec, files)._env_source([env_file])
+        self.assertEqual("bar", envs[0]["FOO"])
+        self.assertEqual(2, _sourced())
+
+        self.assertEqual(None, ubuild.Ubuild(spec, files)._env_source(
+            [failing_file, env_file]))
+        self.assertEqual(None, ubuild.Ubuild(spec, files)._env_source(
+            [env_file, os.path.join(self._root, "missing")]))
+
+    def testSpecCache(self):
+        """
+        Test the compiled spec cache and the included files cache.
+        """
+        include_path = os.path.join(self._root, "common.include")
+        with open(include_path, "w") as include_f:
+            include_f.write("jobs = 4\n")
+        # not modified right now, see SpecPreprocessor.RACY_NS.
+        os.utime(include_path, (1, 1))
+        spec, files = self._spec("one", "#include common.include")
+        self.assertEqual(4, spec.jobs())
+        self.assertEqual(
+            [files[0], include_path], spec._files_read)
+        cache_path = ubuild.SpecParser._cache_path(files[0])
+        self.assert_(os.path.isfile(cache_path))
+        self.assert_(ubuild.SpecPreprocessor._includes.get(
+            (include_path, "UTF-8")))
+
+        parse = ubuild.SpecPreprocessor.parse
+        parsed = []
+
+        def _parse(preproc):
+            parsed.append(preproc)
+            return parse(preproc)
+
+        ubuild.SpecPreprocessor.parse = _parse
+        try:
+            spec2 = ubuild.SpecParser(files[0])
+            spec2.read()
+            self.assertEqual([], parsed)
+            self.assertEqual(spec, spec2)
+            self.assertEqual(spec.cross_targets(), spec2.cross_targets())
+
+            # same content, new modification time.
+            os.utime(include_path, (2, 2))
+            spec2 = ubuild.SpecParser(files[0])
+            spec2.read()
+            self.assertEqual([], parsed)
+
+            with open(include_path, "w") as include_f:
+                include_f.write("jobs = 8\n")
+            spec2 = ubuild.SpecParser(files[0])
+            spec2.read()
+            self.assertEqual(1, len(parsed))
+            self.assertEqual(8, spec2.jobs())
+
+            # the files referenced by the spec are checked too.
+            os.chmod(os.path.join(self._root, "scripts", "image.sh"), 0o644)
+            spec2 = ubuild.SpecParser(files[0])
+            self.assertRaises(
+                ubuild.SpecParser.MissingParametersError, spec2.read)
+            self.assertEqual(2, len(parsed))
+        finally:
+            ubuild.SpecPreprocessor.parse = parse
+
+    def testCache(self):
+        """
+        Test that targets are built once and unpacked from the cache.
+        """
+        spec, files = self._spec("one")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(["cross=a", "cross=b", "pkg=c"], self._built())
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(["cross=a", "cross=b", "pkg=c"], self._built())
+        self.assertEqual("a foo", self._content("one", "a"))
+        self.assert_(os.path.isfile(
+            os.path.join(self._root, "dest", "one.img")))
+
+        self._write_env("bar")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(6, len(self._built()))
+        self.assertEqual("c bar", self._content("one", "c"))
+
+    def testCacheIndex(self):
+        """
+        Test the cache index and the "ubuild cache stats" command.
+        """
+        cache_dir = os.path.join(self._root, "cache")
+        spec, files = self._spec("one")
+        for _count in range(3):
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(3, len(self._built()))
+
+        index = ubuild.UbuildCacheIndex(cache_dir)
+        entries = index.entries()
+        self.assertEqual(
+            ["cross=a", "cross=b", "pkg=c"], [x["target"] for x in entries])
+        self.assertEqual(
+            sorted(self._cache_files(cache_dir)),
+            sorted([x["file"] for x in entries]))
+        for entry in entries:
+            self.assertEqual(2, entry["hits"])
+            self.assertEqual(files[0], entry["spec"])
+            self.assert_(entry["size"] > 0)
+            self.assert_(entry["unpacked_size"] > 0)
+            self.assert_(entry["build_time"] is not None)
+            inputs = json.loads(entry["inputs"])
+            variables = {"TEST_VALUE": "foo"}
+            if entry["target"].startswith("cross="):
+                variables["UBUILD_BUILD_DIR"] = os.path.join(
+                    self._root, "build.one")
+            self.assertEqual(variables, inputs["variables"])
+        self.assertEqual(
+            [("cross=a", 3, 2), ("cross=b", 3, 2), ("pkg=c", 3, 2)],
+            [tuple(x[:3]) for x in index.stats()])
+
+        # entries imported from another cache directory.
+        other_cache_dir = os.path.join(self._root, "cache.other")
+        os.mkdir(other_cache_dir)
+        ubuild.UbuildCache._known.clear()
+        for entry in entries:
+            ubuild.UbuildCache.register(
+                os.path.join(cache_dir, entry["file"]))
+        try:
+            # cross targets can only be shared with the same build_dir.
+            spec, files = self._spec(
+                "two", cache="cache.other", build="one")
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        finally:
+            ubuild.UbuildCache._known.clear()
+        self.assertEqual(3, len(self._built()))
+        other_entries = ubuild.UbuildCacheIndex(other_cache_dir).entries()
+        self.assertEqual(
+            [x["key"] for x in entries], [x["key"] for x in other_entries])
+        self.assertEqual([1] * 3, [x["hits"] for x in other_entries])
+
+        args = [sys.executable, ubuild.__file__.replace(".pyc", ".py"),
+                "cache", "stats", os.path.join(self._root, "one.spec")]
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        output = proc.communicate()[0]
+        self.assertEqual(0, proc.returncode)
+        lines = output.splitlines()
+        self.assert_(lines[0].startswith(cache_dir))
+        self.assertEqual(
+            ["cross=a", "3", "2", "66%"], lines[2].split()[:4])
+        self.assertEqual(["total", "9", "6", "66%"], lines[5].split()[:4])
+        self.assert_(lines[6].startswith("  3 cache entries"))
+
+    def _cache_gc(self, name):
+        """
+        Run ubuild cache gc on the .spec file of name, return the output.
+        """
+        args = [sys.executable, ubuild.__file__.replace(".pyc", ".py"),
+                "cache", "gc", os.path.join(self._root, "%s.spec" % (name,))]
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        output = proc.communicate()[0]
+        self.assertEqual(0, proc.returncode)
+        return output
+
+    def testCacheGc(self):
+        """
+        Test the cache size budget and the "ubuild cache gc" command.
+        """
+        for value, size in (("1024", 1024), ("1.5K", 1536),
+                            ("2g", 2 << 30), ("0", None), ("1X", None)):
+            spec, files = self._spec("one", "cache_max_size = %s" % (value,))
+            self.assertEqual(size, spec.cache_max_size())
+
+        cache_dir = os.path.join(self._root, "cache")
+        spec, files = self._spec("one")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        foo_files = set(self._cache_files(cache_dir))
+        max_size = sum([os.path.getsize(os.path.join(cache_dir, x))
+                        for x in foo_files])
+
+        # the least recently used entries are evicted, not those of
+        # the spec being built.
+        ubuild.UbuildCache._known.clear()
+        self._write_env("bar")
+        spec, files = self._spec("one", "cache_max_size = %d" % (max_size,))
+        try:
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        finally:
+            ubuild.UbuildCache._known.clear()
+        self.assertEqual(6, len(self._built()))
+        bar_files = set(self._cache_files(cache_dir))
+        self.assertEqual(3, len(bar_files))
+        self.assertEqual(set(), foo_files & bar_files)
+        self.assertEqual(
+            bar_files,
+            set([x["file"] for x in
+                 ubuild.UbuildCacheIndex(cache_dir).entries()]))
+
+        stale_tmp = os.path.join(cache_dir, "a.tar.gz_0.tar.xz.tmp")
+        fresh_tmp = os.path.join(cache_dir, "b.tar.gz_0.tar.xz.tmp")
+        for path in (stale_tmp, fresh_tmp):
+            with open(path, "w") as tmp_f:
+                tmp_f.write("tmp")
+        old = time.time() - 2 * ubuild.UbuildCache._STALE_TMP_AGE
+        os.utime(stale_tmp, (old, old))
+
+        self._spec("one", "cache_max_size = 1")
+        output = self._cache_gc("one")
+        self.assert_(output.startswith(
+            "%s: 0 cache files evicted, 3B freed" % (cache_dir,)), output)
+        self.assertFalse(os.path.exists(stale_tmp))
+        self.assert_(os.path.isfile(fresh_tmp))
+        os.remove(fresh_tmp)
+        self.assertEqual(bar_files, set(self._cache_files(cache_dir)))
+
+        self._write_env("baz")
+        output = self._cache_gc("one")
+        self.assert_(output.startswith(
+            "%s: 3 cache files evicted" % (cache_dir,)), output)
+        self.assertEqual([], self._cache_files(cache_dir))
+        self.assertEqual([], ubuild.UbuildCacheIndex(cache_dir).entries())
+
+    def testCasBackend(self):
+        """
+        Test the content-addressed cache backend.
+        """
+        for value, backend in (
+                ("tarball", {"name": "tarball", "hardlink": False}),
+                ("cas", {"name": "cas", "hardlink": False}),
+                ("cas hardlink", {"name": "cas", "hardlink": True}),
+                ("cas foo", None), ("tarball hardlink", None),
+                ("zip", None)):
+            spec, files = self._spec("one", "cache_backend = %s" % (value,))
+            self.assertEqual(backend, spec.cache_backend())
+
+        cache_dir = os.path.join(self._root, "cache")
+        store = ubuild.UbuildCasStore(cache_dir)
+        spec, files = self._spec("one", "cache_backend = cas")
+        for _count in range(2):
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(3, len(self._built()))
+        foo_files = set(self._cache_files(cache_dir))
+        self.assertEqual(
+            [ubuild.UbuildCache.MANIFEST_EXTENSION] * 3,
+            [x[x.rindex("."):] for x in foo_files])
+        # the "shared" and "build_dir" files are stored once.
+        self.assertEqual(5, len(store.blobs()))
+        self.assertEqual("a foo", self._content("one", "a"))
+        target_dir = os.path.join(self._root, "build.one", "a")
+        self.assertEqual("content", os.readlink(
+            os.path.join(target_dir, "link")))
+        shared_st = os.lstat(os.path.join(target_dir, "shared"))
+        self.assertEqual(0o640, shared_st.st_mode & 0o777)
+        self.assertEqual(1, shared_st.st_nlink)
+
+        # tarballs and manifests are unpacked whatever the backend.
+        ubuild.UbuildCache._known.clear()
+        self._write_env("bar")
+        spec, files = self._spec("one")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        spec, files = self._spec("one", "cache_backend = cas hardlink")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(6, len(self._built()))
+        self.assertEqual("a bar", self._content("one", "a"))
+
+        ubuild.UbuildCache._known.clear()
+        self._write_env("foo")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(6, len(self._built()))
+        shared_st = os.lstat(os.path.join(target_dir, "shared"))
+        # the blob, plus the a, b and c copies, all read-only.
+        self.assertEqual(4, shared_st.st_nlink)
+        self.assertEqual(0o440, shared_st.st_mode & 0o777)
+        self.assertEqual(
+            os.lstat(store.blob_path(hashlib.sha1(
+                b"shared\n").hexdigest())).st_ino,
+            shared_st.st_ino)
+
+        # unreferenced blobs are evicted with their manifests.
+        ubuild.UbuildCache._known.clear()
+        stale_tmp_age = ubuild.UbuildCache._STALE_TMP_AGE
+        ubuild.UbuildCache._STALE_TMP_AGE = -1
+        try:
+            cacher = ubuild.UbuildCache(None, spec.sources_dir(), cache_dir,
+                                        [])
+            removed, _freed = cacher.gc(0, protected=[
+                ubuild.UbuildCache.entry_key(x) for x in foo_files])
+        finally:
+            ubuild.UbuildCache._STALE_TMP_AGE = stale_tmp_age
+        self.assertEqual(3, removed)
+        self.assertEqual(foo_files, set(self._cache_files(cache_dir)))
+        self.assertEqual(5, len(store.blobs()))
+
+        fifo_dir = os.path.join(self._root, "fifo")
+        os.mkdir(fifo_dir)
+        os.mkfifo(os.path.join(fifo_dir, "fifo"))
+        self.assertRaises(
+            ubuild.UbuildCasStore.UnsupportedFileError, store.pack, fifo_dir)
+
+        # hardlinks within the tree are recreated.
+        tree_dir = os.path.join(self._root, "tree")
+        os.makedirs(os.path.join(tree_dir, "sub"))
+        with open(os.path.join(tree_dir, "one"), "w") as one_f:
+            one_f.write("hardlinked\n")
+        os.link(os.path.join(tree_dir, "one"),
+                os.path.join(tree_dir, "sub", "two"))
+        manifest, stored = store.pack(tree_dir)
+        self.assertEqual(len("hardlinked\n"), stored)
+        self.assertEqual(
+            [("sub", "d"), ("one", "f"), (os.path.join("sub", "two"), "h")],
+            [(x["path"], x["type"]) for x in manifest["entries"]])
+        self.assertEqual(0, os.lstat(store.blob_path(
+            manifest["entries"][1]["digest"])).st_mode & 0o222)
+        for hardlink in (False, True):
+            unpack_dir = os.path.join(self._root, "unpack.%s" % (hardlink,))
+            os.mkdir(unpack_dir)
+            store.unpack(manifest, unpack_dir, hardlink=hardlink)
+            one_st = os.lstat(os.path.join(unpack_dir, "one"))
+            self.assertEqual(
+                one_st.st_ino,
+                os.lstat(os.path.join(unpack_dir, "sub", "two")).st_ino)
+            self.assertEqual(3 if hardlink else 2, one_st.st_nlink)
+
+    def testWarmCache(self):
+        """
+        Test the extracted cache entries tier.
+        """
+        for value, warm in (
+                ("8G", {"max_size": 8 << 30, "hardlink": False}),
+                ("1M hardlink", {"max_size": 1 << 20, "hardlink": True}),
+                ("hardlink", None), ("1M foo", None), ("0", None)):
+            spec, files = self._spec("one", "cache_warm = %s" % (value,))
+            self.assertEqual(warm, spec.cache_warm())
+
+        cache_dir = os.path.join(self._root, "cache")
+        warm_dir = os.path.join(cache_dir, ubuild.UbuildWarmCache.STORE_DIR)
+        spec, files = self._spec("one", "cache_warm = 1G")
+        for _count in range(2):
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(3, len(self._built()))
+        cache_files = self._cache_files(cache_dir)
+        self.assertEqual(
+            sorted([ubuild.UbuildCache.entry_key(x) for x in cache_files]),
+            sorted(self._cache_files(warm_dir)))
+
+        # the extracted trees are used instead of the cache files.
+        for name in cache_files:
+            with open(os.path.join(cache_dir, name), "w"):
+                pass
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(3, len(self._built()))
+        self.assertEqual("a foo", self._content("one", "a"))
+        target_dir = os.path.join(self._root, "build.one", "a")
+        self.assertEqual("content", os.readlink(
+            os.path.join(target_dir, "link")))
+        shared_st = os.lstat(os.path.join(target_dir, "shared"))
+        self.assertEqual(0o640, shared_st.st_mode & 0o777)
+        self.assertEqual(1, shared_st.st_nlink)
+        # the extracted trees are read-only, not their copies.
+        self.assert_(os.stat(target_dir).st_mode & 0o200)
+        tree_dir = [x for x in [
+            os.path.join(warm_dir, y, "tree", "a")
+            for y in self._cache_files(warm_dir)] if os.path.isdir(x)][0]
+        self.assertEqual(0o440, os.lstat(
+            os.path.join(tree_dir, "shared")).st_mode & 0o777)
+        self.assertEqual(0, os.stat(tree_dir).st_mode & 0o222)
+
+        # the cache files are used again once the trees are evicted.
+        ubuild.UbuildWarmCache(cache_dir, 1).gc()
+        self.assertEqual([], self._cache_files(warm_dir))
+        self.assertNotEqual(0, ubuild.Ubuild(spec, files).build())
+
+        ubuild.UbuildCache._known.clear()
+        self._write_env("bar")
+        spec, files = self._spec("one", "cache_warm = 1G hardlink")
+        for count in range(3):
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+            # the extracted trees are copied, not hardlinked, from the
+            # unpacked cache files, then hardlinked, read-only, out.
+            shared_st = os.lstat(os.path.join(target_dir, "shared"))
+            self.assertEqual(1 if count < 2 else 2, shared_st.st_nlink)
+        self.assertEqual(6, len(self._built()))
+        self.assertEqual("a bar", self._content("one", "a"))
+        self.assertEqual(0o440, shared_st.st_mode & 0o777)
+        self.assert_(os.stat(target_dir).st_mode & 0o200)
+
+        # the trees of the removed cache files are removed by gc().
+        for name in cache_files:
+            os.remove(os.path.join(cache_dir, name))
+        cacher = ubuild.UbuildCache(None, spec.sources_dir(), cache_dir, [])
+        cacher.gc(None)
+        self.assertEqual(
+            sorted([ubuild.UbuildCache.entry_key(x)
+                    for x in self._cache_files(cache_dir)]),
+            sorted(self._cache_files(warm_dir)))
+        self.assertEqual(3, len(self._cache_files(warm_dir)))
+
+    def testRemoteCache(self):
+        """
+        Test the remote cache tier and its reference server.
+        """
+        for value, remote in (
+                ("http://localhost:1234/x",
+                 {"url": "http://localhost:1234/x", "readonly": False}),
+                ("https://u:p@localhost/ readonly",
+                 {"url": "https://u:p@localhost/", "readonly": True}),
+                ("ftp://localhost/", None), ("http://localhost/ foo", None),
+                ("localhost", None)):
+            spec, files = self._spec("one", "cache_remote = %s" % (value,))
+            self.assertEqual(remote, spec.cache_remote())
+
+        remote_dir = os.path.join(self._root, "remote")
+        os.mkdir(remote_dir)
+        server = ubuild.UbuildCacheServer(("127.0.0.1", 0), remote_dir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://127.0.0.1:%d/ubuild" % (server.server_address[1],)
+        cache_dir = os.path.join(self._root, "cache")
+        try:
+            for backend in ("tarball", "cas"):
+                ubuild.UbuildCache._known.clear()
+                shutil.rmtree(cache_dir)
+                os.mkdir(cache_dir)
+                self._write_env(backend)
+                spec, files = self._spec(
+                    "one", "cache_remote = %s\ncache_backend = %s" % (
+                        url, backend))
+                remote_files = set(self._cache_files(remote_dir))
+                self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+                uploaded = set(self._cache_files(remote_dir)) - remote_files
+                self.assertEqual(
+                    set(self._cache_files(cache_dir)), uploaded)
+
+                # a fresh builder only downloads the cache files.
+                ubuild.UbuildCache._known.clear()
+                shutil.rmtree(cache_dir)
+                os.mkdir(cache_dir)
+                built = len(self._built())
+                self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+                self.assertEqual(built, len(self._built()))
+                self.assertEqual(
+                    "c %s" % (backend,), self._content("one", "c"))
+                self.assertEqual(
+                    uploaded, set(self._cache_files(cache_dir)))
+            self.assertEqual(6, len(self._cache_files(remote_dir)))
+            self.assertEqual(
+                5, len(ubuild.UbuildCasStore(remote_dir).blobs()))
+
+            # read-only remote caches are not uploaded to.
+            ubuild.UbuildCache._known.clear()
+            self._write_env("readonly")
+            spec, files = self._spec(
+                "one", "cache_remote = %s readonly" % (url,))
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+            self.assertEqual(9, len(self._built()))
+            self.assertEqual(6, len(self._cache_files(remote_dir)))
+
+            # invalid paths are rejected.
+            remote = ubuild.UbuildRemoteCache(url)
+            conn = remote._connect()
+            try:
+                for name in ("..", ".ubuild_cache.db", "a/"):
+                    resp = remote._request(conn, "GET", name)
+                    resp.read()
+                    self.assertEqual(400, resp.status)
+
+                # downloaded blobs are verified.
+                digest = sorted(ubuild.UbuildCasStore(remote_dir).blobs())[0]
+                blob_path = os.path.join(self._root, "blob")
+                self.assertRaises(
+                    IOError, remote._get, conn, remote._blob_name(digest),
+                    blob_path, digest="0" * 40)
+                self.assertTrue(remote._get(
+                    conn, remote._blob_name(digest), blob_path,
+                    digest=digest))
+                self.assertEqual(
+                    ["blob"], [x for x in os.listdir(self._root)
+                               if x.startswith((".", "blob"))])
+            finally:
+                conn.close()
+        finally:
+            ubuild.UbuildCache._known.clear()
+            server.shutdown()
+            server.server_close()
+
+    def testFetch(self):
+        """
+        Test the concurrent, resumable, source tarballs download.
+        """
+        for value, checksum in (
+                ("sha256:ABCdef", ("sha256", "abcdef", None)),
+                ("md5:0123 d.tgz", ("md5", "0123", "d.tgz")),
+                ("sha256", None), ("foo:0123", None), ("sha1:xyz", None)):
+            spec, files = self._spec(
+                "one", "[pkg=d]\nbuild = scripts/build.sh\nsources = d\n"
+                "url = http://localhost/d.tgz\nchecksum = %s" % (value,))
+            self.assertEqual(
+                checksum, spec["pkg=d"].get("checksum", [None])[0])
+            if checksum is not None and checksum[2] is None:
+                self.assertEqual({"d.tgz": checksum[:2]},
+                                 spec.target_checksums("pkg=d"))
+        self.assertRaises(
+            ubuild.SpecParser.MissingParametersError, self._spec, "one",
+            "[pkg=d]\nbuild = scripts/build.sh\nsources = d\n"
+            "url = http://localhost/d.tgz\nchecksum = md5:01 e.tgz")
+
+        mirror_dir = os.path.join(self._root, "mirror")
+        os.mkdir(mirror_dir)
+        tarballs = {}
+        for name in ("a", "b", "c"):
+            tarballs[name] = os.urandom(1024 * 1024 + 100)
+            with open(os.path.join(mirror_dir, "%s.tar.gz" % (name,)),
+                      "wb") as tarball_f:
+                tarball_f.write(tarballs[name])
+        server = ubuild.UbuildCacheServer(("127.0.0.1", 0), mirror_dir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://127.0.0.1:%d/mirror/" % (server.server_address[1],)
+        sources_dir = os.path.join(self._root, "sources")
+
+        def _write(digest):
+            path = os.path.join(self._root, "one.spec")
+            content = self._SPEC % {
+                "name": "one", "ubuild": "", "cache": "cache",
+                "build": "one"}
+            with open(path, "w") as spec_f:
+                spec_f.write(content.replace("http://localhost/", url))
+                spec_f.write("checksum = sha256:%s\n" % (digest,))
+            return path
+
+        def _read(name):
+            with open(os.path.join(sources_dir, name), "rb") as source_f:
+                return source_f.read()
+
+        try:
+            # a partial download is resumed.
+            with open(os.path.join(sources_dir, "a.tar.gz.part"),
+                      "wb") as part_f:
+                part_f.write(b"x" * 1000)
+            path = _write(hashlib.sha256(b"wrong").hexdigest())
+            self.assertEqual(1, ubuild.main(["ubuild", "fetch", path]))
+            self.assertEqual(b"x" * 1000 + tarballs["a"][1000:],
+                             _read("a.tar.gz"))
+            self.assertEqual(tarballs["b"], _read("b.tar.gz"))
+            self.assertEqual(
+                ["a.tar.gz", "b.tar.gz"],
+                sorted([x for x in os.listdir(sources_dir)
+                        if not x.startswith(".")]))
+
+            path = _write(hashlib.sha256(tarballs["c"]).hexdigest())
+            self.assertEqual(0, ubuild.main(
+                ["ubuild", "fetch", "--connections", "1", path]))
+            self.assertEqual(tarballs["c"], _read("c.tar.gz"))
+
+            # existing tarballs are verified too.
+            with open(os.path.join(sources_dir, "c.tar.gz"), "ab") as c_f:
+                c_f.write(b"x")
+            with open(path, "r") as spec_f:
+                specs, exit_st = ubuild._read_specs([spec_f])
+            self.assertEqual(1, ubuild._fetch_specs(specs, 2))
+
+            # the server supports Range requests.
+            remote = ubuild.UbuildRemoteCache(url)
+            conn = remote._connect()
+            try:
+                for header, status, data in (
+                        ("bytes=10-19", 206, tarballs["a"][10:20]),
+                        ("bytes=%d-" % (10 ** 7,), 416, b"")):
+                    conn.putrequest("GET", "/a.tar.gz")
+                    conn.putheader("Range", header)
+                    conn.endheaders()
+                    resp = conn.getresponse()
+                    self.assertEqual(status, resp.status)
+                    self.assertEqual(data, resp.read())
+            finally:
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testProcessLock(self):
+        """
+        Test that cache entries being produced by another process are
+        waited for and reused.
+        """
+        cache_dir = os.path.join(self._root, "cache")
+        spec, files = self._spec("one")
+        plan = ubuild.Ubuild(spec, files).plan()
+        self.assertEqual("cross=a", plan[0][0])
+        entry_path = plan[0][1]
+
+        lock = ubuild.UbuildFileLock(
+            cache_dir, ubuild.UbuildCache.entry_key(entry_path))
+        self.assert_(lock.acquire(blocking=False))
+        status = []
+        try:
+            thread = threading.Thread(
+                target=lambda: status.append(
+                    ubuild.Ubuild(spec, files).build()))
+            thread.daemon = True
+            thread.start()
+            time.sleep(1.0)
+            self.assertEqual([], self._built())
+            self.assertFalse(ubuild.UbuildFileLock(
+                cache_dir, ubuild.UbuildCache.entry_key(entry_path)).acquire(
+                    blocking=False))
+
+            # "the other process" packs the entry.
+            image_dir = os.path.join(self._root, "image")
+            os.makedirs(os.path.join(image_dir, "a"))
+            with open(os.path.join(image_dir, "a", "content"), "w") as f:
+                f.write("a other\n")
+            subprocess.check_call(
+                ["tar", "-c", "-J", "-f", entry_path, "-C", image_dir, "."])
+        finally:
+            lock.release()
+        thread.join(30)
+        self.assertEqual([0], status)
+        self.assertEqual(["cross=b", "pkg=c"], self._built())
+        self.assertEqual("a other", self._content("one", "a"))
+
+    def testDeferredPack(self):
+        """
+        Test that targets are packed in background, while the next
+        targets are built, holding their cache entry reservation.
+        """
+        cache_dir = os.path.join(self._root, "cache")
+        spec, files = self._spec("one")
+        pack = ubuild.UbuildCache.pack
+        packed = []
+
+        def _pack(cacher, *args, **kwargs):
+            deadline = time.time() + 10
+            while len(self._built()) < 3 and time.time() < deadline:
+                time.sleep(0.05)
+            packed.append(len(self._built()))
+            return pack(cacher, *args, **kwargs)
+
+        ubuild.UbuildCache.pack = _pack
+        try:
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        finally:
+            ubuild.UbuildCache.pack = pack
+        self.assertEqual([3, 3, 3], packed)
+        self.assertEqual(3, len(self._cache_files(cache_dir)))
+        self.assertEqual(
+            [("cross=a", 1, 0), ("cross=b", 1, 0), ("pkg=c", 1, 0)],
+            [tuple(x[:3]) for x in ubuild.UbuildCacheIndex(
+                cache_dir).stats()])
+
+        # background failures are logged, and the reservations released.
+        logged = []
+
+        def _failing_pack(cacher, *args, **kwargs):
+            raise OSError(28, "No space left on device")
+
+        def _exception(msg, *args):
+            logged.append(msg % args)
+
+        self._write_env("bar")
+        spec, files = self._spec("one")
+        logger = logging.getLogger("ubuild.Handler")
+        exception = logger.exception
+        ubuild.UbuildCache.pack = _failing_pack
+        logger.exception = _exception
+        try:
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        finally:
+            ubuild.UbuildCache.pack = pack
+            logger.exception = exception
+        self.assertEqual(3, len(logged))
+        self.assert_(logged[0].startswith("[cross=a] background task"))
+        self.assertEqual(3, len(self._cache_files(cache_dir)))
+
+    def testLookahead(self):
+        """
+        Test that the cache entry of the next target is looked up while
+        the current one is unpacked.
+        """
+        spec, files = self._spec("one")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+
+        prefetch = ubuild.UbuildCache.prefetch
+        unpack = ubuild.UbuildCache.unpack
+        prefetched = []
+        overlapped = []
+
+        def _prefetch(cacher, *args, **kwargs):
+            cache_file = prefetch(cacher, *args, **kwargs)
+            prefetched.append((cacher._seed, cache_file is not None))
+            return cache_file
+
+        def _unpack(cacher, *args, **kwargs):
+            if cacher._seed == "cross=a":
+                deadline = time.time() + 10
+                while not prefetched and time.time() < deadline:
+                    time.sleep(0.05)
+                overlapped.append(list(prefetched))
+            return unpack(cacher, *args, **kwargs)
+
+        ubuild.UbuildCache.prefetch = _prefetch
+        ubuild.UbuildCache.unpack = _unpack
+        try:
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        finally:
+            ubuild.UbuildCache.prefetch = prefetch
+            ubuild.UbuildCache.unpack = unpack
+        self.assertEqual(3, len(self._built()))
+        # pkg=c is the first target of the pkg phase.
+        self.assertEqual([("cross=b", True)], prefetched)
+        self.assertEqual([[("cross=b", True)]], overlapped)
+        self.assertEqual("b foo", self._content("one", "b"))
+
+    def testCompression(self):
+        """
+        Test the cache compression codecs.
+        """
+        cache_dir = os.path.join(self._root, "cache")
+        spec, files = self._spec("one")
+        self.assertEqual(None, spec.cache_compression())
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(
+            [".tar.xz"] * 3,
+            [x[x.rindex(".tar"):] for x in self._cache_files(cache_dir)])
+
+        spec, files = self._spec(
+            "one", "cache_compression = zstd level=19 threads=0")
+        self.assertEqual(
+            {"codec": "zstd", "level": 19, "threads": 0},
+            spec.cache_compression())
+        # existing cache files are still used.
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(3, len(self._built()))
+
+        for codec, extension in (("zstd", ".tar.zst"), ("none", ".tar")):
+            shutil.rmtree(cache_dir)
+            os.mkdir(cache_dir)
+            spec, files = self._spec("one", "cache_compression = %s" % (
+                codec,))
+            self._write_env(codec)
+            for _count in range(2):
+                self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+            self.assertEqual(
+                [extension] * 3,
+                [x[x.rindex(".tar"):] for x in self._cache_files(cache_dir)])
+            self.assertEqual("c %s" % (codec,), self._content("one", "c"))
+        self.assertEqual(9, len(self._built()))
+
+        for value in ("gzip", "xz level=10", "zstd threads=a", "xz foo=1"):
+            spec, files = self._spec("one", "cache_compression = %s" % (
+                value,))
+            self.assertEqual(None, spec.cache_compression())
+        # compression is multi-threaded by default.
+        spec, files = self._spec("one", "cache_compression = zstd")
+        self.assertEqual(
+            {"codec": "zstd", "level": 3, "threads": 0},
+            spec.cache_compression())
+
+    def testCacheHash(self):
+        """
+        Test the cache key hash algorithm.
+        """
+        if "blake2b" not in getattr(hashlib, "algorithms_available", ()):
+            spec, files = self._spec("one", "cache_hash = blake2b")
+            self.assertEqual("sha1", spec.cache_hash())
+            return
+
+        with open(os.path.join(self._root, "sources", "a.tar.gz"),
+                  "wb") as tar_f:
+            tar_f.write(b"a")
+        cache_dir = os.path.join(self._root, "cache")
+        spec, files = self._spec("one")
+        self.assertEqual("sha1", spec.cache_hash())
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        sha1_entries = set(self._cache_files(cache_dir))
+
+        spec, files = self._spec("one", "cache_hash = blake2b")
+        self.assertEqual("blake2b", spec.cache_hash())
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(6, len(self._built()))
+        entries = set(self._cache_files(cache_dir)) - sha1_entries
+        self.assertEqual(3, len(entries))
+        self.assertEqual(
+            sorted([len(x) for x in sha1_entries]),
+            sorted([len(x) for x in entries]))
+
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        self.assertEqual(6, len(self._built()))
+
+    def testResume(self):
+        """
+        Test that resumed builds skip the targets already built.
+        """
+        spec, files = self._spec("one")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        build_dir = os.path.join(self._root, "build.one")
+        self.assert_(os.path.isfile(
+            os.path.join(build_dir, ".ubuild_state.json")))
+
+        # drop the cache, resumed targets must not need it.
+        shutil.rmtree(os.path.join(self._root, "cache"))
+        os.mkdir(os.path.join(self._root, "cache"))
+        shutil.rmtree(os.path.join(build_dir, "c"))
+        self.assertEqual(0, ubuild.Ubuild(spec, files, resume=True).build())
+        self.assertEqual(
+            ["cross=a", "cross=b", "pkg=c", "pkg=c"], self._built())
+        self.assertEqual("a foo", self._content("one", "a"))
+        self.assertEqual("c foo", self._content("one", "c"))
+
+        self._write_env("bar")
+        self.assertEqual(0, ubuild.Ubuild(spec, files, resume=True).build())
+        self.assertEqual(7, len(self._built()))
+        self.assertEqual("a bar", self._content("one", "a"))
+
+    def testReport(self):
+        """
+        Test the JSON build report.
+        """
+        spec, files = self._spec("one")
+        report_path = os.path.join(self._root, "dest", "one.img.report.json")
+        for result in ("built", "cached"):
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+            with open(report_path, "r") as report_f:
+                report = json.load(report_f)
+
+            self.assertEqual(0, report["exit_status"])
+            self.assertEqual(files, report["spec"])
+            for step in ("setup", "cross_targets", "pkg_targets",
+                         "build_image"):
+                self.assert_(report["steps"][step] >= 0.0)
+            self.assertEqual(
+                ["cross=a", "cross=b", "pkg=c"],
+                sorted(report["targets"].keys()))
+            for record in report["targets"].values():
+                self.assertEqual(0, record["exit_status"])
+                self.assertEqual(result, record["result"])
+                self.assert_("lookup" in record["steps"])
+                if result == "built":
+                    self.assert_("user" in record["resources"])
+                    self.assertEqual(
+                        2.5, record["phases"]["src_compile"])
+                    self.assert_("pack" in record["steps"])
+                else:
+                    self.assert_("unpack" in record["steps"])
+
+    def testTrace(self):
+        """
+        Test the build timeline recording.
+        """
+        tracer = ubuild._tracer
+        ubuild._tracer = ubuild.UbuildTracer()
+        try:
+            ubuild._tracer.enable()
+            spec, files = self._spec("one")
+            self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+            trace_path = os.path.join(self._root, "trace.json")
+            self.assertEqual(0, ubuild._tracer.write(trace_path))
+        finally:
+            ubuild._tracer = tracer
+
+        with open(trace_path, "r") as trace_f:
+            events = json.load(trace_f)["traceEvents"]
+        spans = dict((x["name"], x) for x in events if x["ph"] == "X")
+        for name in ("cross=a", "pkg=c", "build.sh", "env", "lookup",
+                     "pack", "src_compile", "build_image", "image.sh"):
+            self.assert_(name in spans, name)
+        self.assertEqual("target", spans["pkg=c"]["cat"])
+        self.assertEqual(
+            "built", spans["pkg=c"]["args"]["result"])
+        self.assert_(spans["cross=a"]["ts"] <= spans["pkg=c"]["ts"])
+        self.assert_(
+            [x for x in events if x["name"] == "thread_name"])
+
+    def _plan(self, name):
+        """
+        Run ubuild --plan on the .spec file of name, return the output
+        lines.
+        """
+        args = [sys.executable, ubuild.__file__.replace(".pyc", ".py"),
+                "--plan", os.path.join(self._root, "%s.spec" % (name,))]
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        output = proc.communicate()[0]
+        self.assertEqual(0, proc.returncode)
+        return output.splitlines()
+
+    def testPlan(self):
+        """
+        Test the prediction of the cache hits and build durations.
+        """
+        spec, files = self._spec("one")
+        build_dir = os.path.join(self._root, "build.one")
+        os.rmdir(build_dir)
+
+        lines = self._plan("one")
+        self.assertFalse(os.path.exists(build_dir))
+        self.assertEqual(5, len(lines))
+        self.assert_(lines[1].split()[:2] == ["MISS", "cross=a"])
+        self.assertEqual("?", lines[3].split()[-1])
+        self.assert_("3 misses" in lines[4])
+        self.assert_("3 targets without history" in lines[4])
+
+        spec, files = self._spec("one")
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        lines = self._plan("one")
+        self.assert_(lines[3].split()[:2] == ["HIT", "pkg=c"])
+        self.assert_(lines[3].split()[2].startswith("c.tar.gz_"))
+        # no history of cached builds yet.
+        self.assertEqual("?", lines[3].split()[-1])
+        self.assert_("3 hits" in lines[4])
+
+        self.assertEqual(0, ubuild.Ubuild(spec, files).build())
+        lines = self._plan("one")
+        self.assert_(lines[3].split()[-1].startswith("~"))
+        self.assertFalse("history" in lines[4])
+
+    def testParallelSpecs(self):
+        """
+        Test that specs built concurrently share the cache entries.
+        """
+        self._write_env("foo", sleep=0.2)
+        specs = [self._spec("one"), self._spec("two")]
+        self.assertEqual(0, ubuild._build_specs(specs, 2))
+        # cross targets are tied to build_dir, see testSharedEntries.
+        self.assertEqual(
+            ["cross=a", "cross=a", "cross=b", "cross=b", "pkg=c"],
+            sorted(self._built()))
+        for name in ("one", "two"):
+            self.assertEqual("b foo", self._content(name, "b"))
+            self.assert_(os.path.isfile(
+                os.path.join(self._root, "dest", "%s.img" % (name,))))
+
+        specs.append((specs[0][0], ["three.spec"]))
+        self.assertEqual(2, ubuild._build_specs(specs, 2))
+
+    def testSharedEntries(self):
+        """
+        Test that identical targets of specs using different cache
+        directories are built once, except for the cross targets of
+        specs using different build directories.
+        """
+        for parallel_specs in (1, 2):
+            self._write_env(str(parallel_specs), sleep=0.2)
+            specs = [self._spec("one", cache="cache.one"),
+                     self._spec("two", cache="cache.two")]
+            self.assertEqual(0, ubuild._build_specs(specs, parallel_specs))
+            self.assertEqual(
+                ["cross=a", "cross=a", "cross=b", "cross=b", "pkg=c"],
+                sorted(self._built()))
+            for name in ("one", "two"):
+                build_dir = os.path.join(self._root, "build.%s" % (name,))
+                self.assertEqual(
+                    "a %d" % (parallel_specs,), self._content(name, "a"))
+                # the cross targets of each spec have been built (not
+                # unpacked from the cache of the other) in its build_dir.
+                with open(os.path.join(build_dir, "a", "build_dir"),
+                          "r") as build_dir_f:
+                    self.assertEqual(build_dir, build_dir_f.read().strip())
+                cache_dir = os.path.join(self._root, "cache.%s" % (name,))
+                self.assertEqual(3, len(self._cache_files(cache_dir)))
+                shutil.rmtree(cache_dir)
+            os.remove(os.path.join(self._root, "built"))
+
+        # specs sharing build_dir, built one after the other, share
+        # the cross targets too.
+        specs = [self._spec("one", cache="cache.one"),
+                 self._spec("two", cache="cache.two", build="one")]
+        self.assertEqual(0, ubuild._build_specs(specs, 1))
+        self.assertEqual(
+            ["cross=a", "cross=b", "pkg=c"], sorted(self._built()))
+        self.assertEqual(
+            3, len(self._cache_files(os.path.join(self._root, "cache.two"))))
+
+    def testMatrix(self):
+        """
+        Test that the variants of a matrix spec share the pkg targets
+        whose cache_vars do not change and build the cross targets
+        once, into a shared build_dir.
+        """
+        matrix = """
+[matrix=OTHER_VALUE]
+value = x
+value = y: why not
+"""
+        spec, files = self._spec("one", ubuild_params=matrix)
+        self.assertEqual(
+            [("OTHER_VALUE", [("x", "x"), ("y", "why not")])],
+            spec.matrix())
+        with open(files[0], "r") as spec_f:
+            specs, exit_st = ubuild._read_specs([spec_f])
+        self.assertEqual(0, exit_st)
+        self.assertEqual(["x", "y"], [x.variant() for x, _f in specs])
+        self.assertEqual({"OTHER_VALUE": "why not"}, specs[1][0].variables())
+        self.assertEqual("y.one.img", specs[1][0].image_name())
+        self.assertEqual(None, spec.variant())
+        self.assertEqual([], ubuild._check_isolation(specs))
+        cross_build_dir = os.path.join(self._root, "build.one")
+        self.assertEqual(
+            [cross_build_dir] * 2, [x.cross_build_dir() for x, _f in specs])
+
+        def _read(build_dir, target, name):
+            with open(os.path.join(build_dir, target, name), "r") as read_f:
+                return read_f.read().strip()
+
+        self.assertEqual(0, ubuild._build_specs(specs, 2))
+        self.assertEqual(
+            ["cross=a", "cross=b", "pkg=c"], sorted(self._built()))
+        for target in ("a", "b"):
+            self.assertEqual(
+                cross_build_dir, _read(cross_build_dir, target, "build_dir"))
+        for label in ("x", "y"):
+            self.assertEqual("c foo", self._content("one." + label, "c"))
+            build_dir = os.path.join(self._root, "build.one." + label)
+            self.assertEqual(["c"], sorted(
+                [x for x in os.listdir(build_dir) if not x.startswith(".")]))
+            self.assertEqual(
+                cross_build_dir, _read(build_dir, "c", "cross_build_dir"))
+            self.assert_(os.path.isfile(
+                os.path.join(self._root, "dest", label + ".one.img")))
+        os.remove(os.path.join(self._root, "built"))
+
+        # TEST_VALUE is a cache variable, overriding the env file one:
+        # the cross targets are built per TEST_VALUE.
+        matrix += """
+[matrix=TEST_VALUE]
+value = bar
+value = baz
+"""
+        spec, files = self._spec("one", ubuild_params=matrix)
+        variants = spec.variants()
+        self.assertEqual(["x.bar", "x.baz", "y.bar", "y.baz"],
+                         [x.variant() for x in variants])
+        self.assertEqual(
+            ["bar", "baz", "bar", "baz"],
+            [os.path.basename(x.cross_build_dir()).split(".")[-1]
+             for x in variants])
+        specs = [(x, files) for x in variants]
+        self.assertEqual(0, ubuild._build_specs(specs, 1))
+        self.assertEqual(
+            ["cross=a"] * 2 + ["cross=b"] * 2 + ["pkg=c"] * 2,
+            sorted(self._built()))
+        self.assertEqual("a baz", _read(
+            os.path.join(self._root, "build.one.baz"), "a", "content"))
+
+        # labels are mandatory for values that cannot be used as such.
+        self.assertRaises(ubuild.SpecParser.MissingParametersError,
+                          self._spec, "two",
+                          ubuild_params="[matrix=FOO]\nvalue = -O2 -pipe")
+        self.assertRaises(ubuild.SpecParser.MissingParametersError,
+                          self._spec, "two",
+                          ubuild_params="[matrix=FOO]\nvalue = a\nvalue = a")
+
 
 if __name__ == "__main__":
     unittest.main()